@@ -0,0 +1,60 @@
+import sys
+import shutil
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+import features.process_price_history as process
+from synthetic_data import make_price_histories, add_next_day, get_today_and_historical_best_rows
+
+'''
+Compare the cost of a run that updates the processed price history only with the prices of today
+with the cost of rebuilding it from scratch, as the history grows.
+Run from the project root: python benchmarks/bench_processed_price_history.py
+'''
+
+
+def benchmark_history_length(n_products: int, n_days: int, repetitions: int = 3) -> dict:
+    price_history_list_df = make_price_histories(n_products, n_days)
+    updated_price_history_list_df, today = add_next_day(price_history_list_df)
+    today_price_history_list_df, historical_best_price_list_df = get_today_and_historical_best_rows(updated_price_history_list_df, today)
+
+    with tempfile.TemporaryDirectory() as temporary_path:
+        base_path = f"{temporary_path}/base"
+        process.rebuild_processed_price_history(price_history_list_df, base_path)
+
+        update_times, rebuild_times = [], []
+        for _ in range(repetitions):
+            # Each repetition starts from the view of the previous day
+            update_path = f"{temporary_path}/update"
+            shutil.rmtree(update_path, ignore_errors=True)
+            shutil.copytree(base_path, update_path)
+
+            _start_time = perf_counter()
+            process.update_processed_price_history(today_price_history_list_df, historical_best_price_list_df, update_path)
+            update_times.append(perf_counter() - _start_time)
+
+            _start_time = perf_counter()
+            process.rebuild_processed_price_history(updated_price_history_list_df, f"{temporary_path}/rebuild")
+            rebuild_times.append(perf_counter() - _start_time)
+
+        # The updated view must be identical to the rebuilt one
+        updated_df = process.read_processed_price_history(update_path).reset_index(drop=True)
+        rebuilt_df = process.read_processed_price_history(f"{temporary_path}/rebuild").reset_index(drop=True)
+        assert updated_df.equals(rebuilt_df), "Incremental update differs from the full rebuild"
+
+    return {'products': n_products, 'days': n_days, 'rows': n_products * n_days * 5,
+            'update_ms': 1000*min(update_times), 'rebuild_ms': 1000*min(rebuild_times)}
+
+
+def main():
+    print(f"{'products':>9}{'days':>7}{'rows':>10}{'update ms':>11}{'rebuild ms':>12}")
+
+    for n_days in [30, 180, 365, 730, 1095]:
+        result = benchmark_history_length(n_products=50, n_days=n_days)
+        print(f"{result['products']:>9}{result['days']:>7}{result['rows']:>10}{result['update_ms']:>11.1f}{result['rebuild_ms']:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import sys
+import re
+from math import ceil
+from pathlib import Path
+from timeit import repeat
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+from data.web_scraper import WebScraper
+
+'''
+Compare the previous extraction path (full page parsed by html.parser, patterns compiled at every search)
+with the current one (only product cards parsed by lxml, patterns compiled at import) on the synthetic store pages of benchmarks/fixtures,
+built with the markup the scraper expects from each store, not saved from the live stores.
+Run from the project root: python benchmarks/bench_web_scraper.py
+'''
+
+FIXTURES_PATH = Path(__file__).resolve().parent / 'fixtures'
+
+
+def extract_offers_previous_path(page_source: str, store: str) -> list[tuple[str, int]]:
+    store_parameters = WebScraper.get_store_parameters(store)
+    soup = BeautifulSoup(page_source, 'html.parser')
+    offers = []
+
+    for element in soup.find_all(store_parameters['tag_products'], attrs={store_parameters['attribute_products']: re.compile(store_parameters['value_products'])}):
+        ad_title = element.find(store_parameters['tag_title'], attrs={store_parameters['attribute_title']: re.compile(store_parameters['value_title'])}).text.strip()
+
+        if (store == 'pichau'):
+            ad_price_tag = element.find_all(store_parameters['tag_price'])[4]
+        else:
+            ad_price_tag = element.find(store_parameters['tag_price'], attrs={store_parameters['attribute_price']: re.compile(store_parameters['value_price'])})
+
+        ad_price_str = re.search(r"(\d{1,3}\.)+\d{1,3},{0,1}\d*", ad_price_tag.text.strip()).group()
+        offers.append((ad_title, ceil(float(ad_price_str.translate({ord('.'): None, ord(','): ord('.')})))))
+
+    return offers
+
+
+def extract_offers_current_path(page_source: str, store: str) -> list[tuple[str, int]]:
+    web_scraper = WebScraper(WebScraper.parse_page(page_source, store), store)
+
+    return [(web_scraper.get_title(element), web_scraper.get_price(element)) for element in web_scraper.get_products()]
+
+
+def benchmark_store(store: str, repetitions: int = 5) -> dict:
+    page_source = (FIXTURES_PATH / f'{store}.html').read_text(encoding='utf-8')
+
+    # Both paths must extract exactly the same offers
+    previous_offers = extract_offers_previous_path(page_source, store)
+    current_offers = extract_offers_current_path(page_source, store)
+    assert previous_offers == current_offers, f"Offers extracted from {store} differ between paths"
+
+    previous_time = min(repeat(lambda: extract_offers_previous_path(page_source, store), number=1, repeat=repetitions))
+    current_time = min(repeat(lambda: extract_offers_current_path(page_source, store), number=1, repeat=repetitions))
+
+    return {'store': store, 'offers': len(current_offers), 'page_kb': len(page_source) // 1024,
+            'previous_ms': 1000*previous_time, 'current_ms': 1000*current_time, 'speedup': previous_time/current_time}
+
+
+def main():
+    print(f"{'store':<15}{'offers':>8}{'page KB':>9}{'previous ms':>13}{'current ms':>12}{'speedup':>9}")
+
+    for store in WebScraper.store_names:
+        result = benchmark_store(store)
+        print(f"{result['store']:<15}{result['offers']:>8}{result['page_kb']:>9}{result['previous_ms']:>13.1f}{result['current_ms']:>12.1f}{result['speedup']:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
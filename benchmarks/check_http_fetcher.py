@@ -0,0 +1,83 @@
+import sys
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Thread
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+from data.http_page_fetcher import HttpPageFetcher
+from data.web_scraper import WebScraper
+
+'''
+Check the HTTP fetch strategy offline: the synthetic page of each store in benchmarks/fixtures is served by a local HTTP server, fetched by HttpPageFetcher
+and extracted by WebScraper, which must find the same offers as in the page read from disk. A page with a wrong charset and a missing page
+must fail without stopping the others.
+Run from the project root: python benchmarks/check_http_fetcher.py
+'''
+
+FIXTURES_PATH = Path(__file__).resolve().parent / 'fixtures'
+
+# Latin-1 bytes served as UTF-8, as sent by stores that declare the wrong charset
+WRONG_CHARSET_PATH = '/wrong_charset.html'
+WRONG_CHARSET_BODY = 'Placa de vídeo por R$ 4.137,99'.encode('latin-1')
+
+
+class FixtureRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serve the synthetic store pages, plus a page whose body doesn't match its declared charset
+    """
+
+    def do_GET(self):
+        if self.path != WRONG_CHARSET_PATH:
+            return super().do_GET()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(WRONG_CHARSET_BODY)))
+        self.end_headers()
+        self.wfile.write(WRONG_CHARSET_BODY)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def extract_offers(page_source: str, store: str) -> list[tuple[str, int]]:
+    web_scraper = WebScraper(WebScraper.parse_page(page_source, store), store)
+
+    return [(web_scraper.get_title(element), web_scraper.get_price(element)) for element in web_scraper.get_products()]
+
+
+def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(FixtureRequestHandler, directory=str(FIXTURES_PATH)))
+    Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    try:
+        store_urls = {store: f'{base_url}/{store}.html' for store in WebScraper.store_names}
+        failing_urls = [f'{base_url}{WRONG_CHARSET_PATH}', f'{base_url}/missing.html']
+        page_sources = HttpPageFetcher('benchmark').fetch_page_sources(list(store_urls.values()) + failing_urls)
+    finally:
+        server.shutdown()
+
+    success_bool = True
+    print(f"{'store':<15}{'offers':>8}  result")
+
+    for store, url in store_urls.items():
+        expected_offers = extract_offers((FIXTURES_PATH / f'{store}.html').read_text(encoding='utf-8'), store)
+        fetched_offers = extract_offers(page_sources[url], store) if page_sources.get(url) is not None else None
+
+        _is_match = (fetched_offers == expected_offers) and bool(expected_offers)
+        success_bool &= _is_match
+        print(f"{store:<15}{len(fetched_offers or []):>8}  {'ok' if _is_match else 'different offers from the fixture'}")
+
+    for url in failing_urls:
+        _is_failed = page_sources.get(url) is None
+        success_bool &= _is_failed
+        print(f"{url.removeprefix(base_url):<23}  {'failed as expected' if _is_failed else 'should have failed'}")
+
+    sys.exit(0 if success_bool else 1)
+
+
+if __name__ == '__main__':
+    main()
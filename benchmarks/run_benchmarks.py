@@ -0,0 +1,274 @@
+import sys
+import io
+import re
+import json
+import shutil
+import os
+import argparse
+import yaml
+import platform
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+from typing import Callable
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+import pandas as pd
+import features.process_price_history as process
+from data.web_scraper import WebScraper
+from data.page_parser_pool import PageParserPool
+from data.tracked_products_loader import TrackedProductsLoader
+from features.price_history_updater import PriceHistoryUpdater
+from features.price_summary_index import PriceSummaryIndex, PRICE_SUMMARY_INDEX_NAME
+from visualization.dashboard_data import DashboardData
+from synthetic_data import make_price_histories, make_best_offers, InMemoryPriceHistoryStorage
+
+'''
+Offline benchmark suite of the hot paths of the pipeline, saved as JSON so the results of two commits can be compared:
+- scraping: parse and offer extraction of the synthetic page of each store, not saved from the live store
+- history: daily update of the synthetic price histories, their concatenation and processing
+- dashboard: data preparation of the web application, without Streamlit
+- config: loading and validation of the tracked products, compiled from YAML and read from the cache
+Run from the project root: python benchmarks/run_benchmarks.py [--products 1000 --days 1095] [--compare benchmarks/results/<commit>.json]
+'''
+
+FIXTURES_PATH = Path(__file__).resolve().parent / 'fixtures'
+RESULTS_PATH = Path(__file__).resolve().parent / 'results'
+SUITES = ['scraping', 'history', 'dashboard', 'config']
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Time the hot paths of the pipeline on synthetic pages and price histories")
+    parser.add_argument('--products', type=int, default=1000, help="Number of synthetic products, each with one offer per store per day")
+    parser.add_argument('--days', type=int, default=1095, help="Length of the synthetic price histories in days")
+    parser.add_argument('--repetitions', type=int, default=3, help="Times each benchmark is repeated, the minimum and median times are reported")
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=SUITES, help="Benchmark suites to run")
+    parser.add_argument('--output', help="Path of the JSON results, by default benchmarks/results/<commit>.json")
+    parser.add_argument('--compare', help="JSON results of a previous run, to show the change of each benchmark")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Relative slowdown reported as a regression by --compare")
+
+    return parser.parse_args()
+
+
+def time_function(function: Callable[[], object], repetitions: int, setup: Callable[[], object] | None = None) -> dict:
+    ''' Minimum and median time of the function in milliseconds, calling setup before each repetition without timing it '''
+    times = []
+
+    for _ in range(repetitions):
+        if setup is not None:
+            setup()
+
+        # The pipeline reports each step on the console, which would be timed too
+        with redirect_stdout(io.StringIO()):
+            _start_time = perf_counter()
+            function()
+            times.append(perf_counter() - _start_time)
+
+    return {'min_ms': 1000*min(times), 'median_ms': 1000*median(times), 'repetitions': repetitions}
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def build_price_summary_index(price_history_list_df: list[pd.DataFrame], data_path: str) -> None:
+    price_summary_index = PriceSummaryIndex(data_path)
+
+    for price_history_df in price_history_list_df:
+        price_summary_index.build_product_summary(price_history_df)
+
+    price_summary_index.save()
+
+
+def benchmark_scraping(repetitions: int) -> list[dict]:
+    results = []
+
+    for store in WebScraper.store_names:
+        page_source = (FIXTURES_PATH / f'{store}.html').read_text(encoding='utf-8')
+        soup = WebScraper.parse_page(page_source, store)
+        n_offers = len(WebScraper(soup, store).get_products())
+
+        def extract_offers():
+            web_scraper = WebScraper(soup, store)
+            return [(web_scraper.get_title(element), web_scraper.get_price(element)) for element in web_scraper.get_products()]
+
+        parameters = {'store': store, 'offers': n_offers, 'page_kb': len(page_source) // 1024}
+        results.append({'benchmark': f'scraping.parse.{store}', **parameters, **time_function(lambda: WebScraper.parse_page(page_source, store), repetitions)})
+        results.append({'benchmark': f'scraping.extract.{store}', **parameters, **time_function(extract_offers, repetitions)})
+
+    # A round of pages of every store parsed in the fetching thread and in the parser processes, started before timing
+    page_sources = [((FIXTURES_PATH / f'{store}.html').read_text(encoding='utf-8'), store) for store in WebScraper.store_names] * 4
+    products_matchers = [('RTX 4070', re.compile(r'(?=.*?rtx)(?=.*?4070)', re.IGNORECASE | re.DOTALL))]
+
+    for workers in [0, os.cpu_count() or 1]:
+        page_parser_pool = PageParserPool(workers)
+        page_parser_pool.submit(*page_sources[0], products_matchers).result()
+
+        def parse_round():
+            futures = [page_parser_pool.submit(page_source, store, products_matchers) for page_source, store in page_sources]
+            return [future.result() for future in futures]
+
+        results.append({'benchmark': f'scraping.parser_pool.{workers}', 'pages': len(page_sources), 'workers': workers, **time_function(parse_round, repetitions)})
+        page_parser_pool.shutdown()
+
+    return results
+
+
+def benchmark_history(price_history_list_df: list[pd.DataFrame], data_path: str, repetitions: int) -> list[dict]:
+    parameters = {'products': len(price_history_list_df), 'rows': sum(len(price_history_df) for price_history_df in price_history_list_df)}
+    best_offers = make_best_offers(price_history_list_df)
+    price_history_storage = InMemoryPriceHistoryStorage(price_history_list_df, data_path)
+
+    # Every repetition is the first run of the day, starting from the summaries of the day before
+    build_price_summary_index(price_history_list_df, data_path)
+    summary_index_path = Path(data_path) / PRICE_SUMMARY_INDEX_NAME
+    shutil.copyfile(summary_index_path, f"{data_path}/summary_index_of_yesterday.parquet")
+
+    def update_price_histories():
+        PriceHistoryUpdater(best_offers, price_history_storage, data_path).update_all_products_price_history()
+
+    results = [{'benchmark': 'history.update_all_products_price_history', **parameters,
+                **time_function(update_price_histories, repetitions, setup=lambda: shutil.copyfile(f"{data_path}/summary_index_of_yesterday.parquet", summary_index_path))}]
+
+    price_history_df = process.concat_price_history_dfs(price_history_list_df)
+    results.append({'benchmark': 'history.concat_price_history_dfs', **parameters,
+                    **time_function(lambda: process.concat_price_history_dfs(price_history_list_df), repetitions)})
+    results.append({'benchmark': 'history.process_price_history', **parameters,
+                    **time_function(lambda: process.process_price_history(price_history_df), repetitions)})
+
+    return results
+
+
+def benchmark_dashboard(price_history_list_df: list[pd.DataFrame], data_path: str, repetitions: int) -> list[dict]:
+    processed_path = f"{data_path}/processed_price_histories"
+    process.rebuild_processed_price_history(price_history_list_df, processed_path)
+
+    parameters = {'products': len(price_history_list_df), 'rows': sum(len(price_history_df) for price_history_df in price_history_list_df)}
+    results = [{'benchmark': 'dashboard.load', **parameters, **time_function(lambda: DashboardData('benchmark', processed_path), repetitions)}]
+
+    dashboard_data = DashboardData('benchmark', processed_path)
+    products = dashboard_data.get_products()
+    first_month, last_month = dashboard_data.best_prices_df['Dateref'].iloc[0], dashboard_data.best_prices_df['Dateref'].iloc[-1]
+
+    # Selections of a few and of many products, as compared in the web application
+    for n_selected in [5, 20]:
+        selected_products = products[:n_selected]
+        selection = {**parameters, 'selected_products': len(selected_products)}
+
+        results.append({'benchmark': f'dashboard.get_best_prices_of_products.{n_selected}', **selection,
+                        **time_function(lambda: dashboard_data.get_best_prices_of_products(selected_products), repetitions)})
+        results.append({'benchmark': f'dashboard.get_price_metrics_df.{n_selected}', **selection,
+                        **time_function(lambda: dashboard_data.get_price_metrics_df(selected_products, first_month, last_month), repetitions)})
+        results.append({'benchmark': f'dashboard.get_price_metrics_df.last_month.{n_selected}', **selection,
+                        **time_function(lambda: dashboard_data.get_price_metrics_df(selected_products, last_month, last_month), repetitions)})
+
+        # The chart series and rollups are cached by the data, so they are cleared to time the first selection
+        def clear_chart_cache():
+            dashboard_data.product_rollups.clear()
+            dashboard_data.chart_series.clear()
+
+        for rollup in ['Daily', 'Weekly', 'Monthly']:
+            results.append({'benchmark': f'dashboard.get_chart_df.{rollup.lower()}.{n_selected}', **selection,
+                            **time_function(lambda: dashboard_data.get_chart_df(selected_products, first_month, last_month, rollup, 'Average', 500),
+                                            repetitions, setup=clear_chart_cache)})
+
+    return results
+
+
+def benchmark_config(n_products: int, data_path: str, repetitions: int) -> list[dict]:
+    # Products with a URL of every store, split into files of 500 products as a large catalog would be
+    tracked_products_list = [{'name': f'Product {i}', 'keywords': ['product', str(i)],
+                              **{f'url_{store}': f'https://www.{store.replace("_", "")}.com.br/busca?q=product+{i}' for store in WebScraper.store_names}}
+                             for i in range(n_products)]
+
+    config_path = Path(data_path) / 'tracked_products'
+    config_path.mkdir(parents=True, exist_ok=True)
+    for i in range(0, n_products, 500):
+        (config_path / f'products_{i // 500:03d}.yaml').write_text(yaml.safe_dump(tracked_products_list[i:i+500], allow_unicode=True), encoding='utf-8')
+
+    cache_path = Path(data_path) / 'config_cache'
+    tracked_products_loader = TrackedProductsLoader([str(config_path / '*.yaml')], str(cache_path))
+    parameters = {'products': n_products, 'files': len(list(config_path.glob('*.yaml')))}
+
+    results = [{'benchmark': 'config.tracked_products.compile', **parameters,
+                **time_function(tracked_products_loader.load, repetitions, setup=lambda: shutil.rmtree(cache_path, ignore_errors=True))}]
+
+    tracked_products_loader.load(verbose=False)
+    results.append({'benchmark': 'config.tracked_products.cached', **parameters, **time_function(tracked_products_loader.load, repetitions)})
+
+    return results
+
+
+def compare_results(results: list[dict], previous_results_path: str, threshold: float) -> None:
+    with open(previous_results_path, 'r') as file:
+        previous_report = json.load(file)
+
+    previous_results_dict = {result['benchmark']: result for result in previous_report['results']}
+    print(f"\nCompared with {previous_report['commit']} ({previous_results_path})")
+    print(f"{'benchmark':<50}{'previous ms':>13}{'current ms':>12}{'change':>9}")
+
+    for result in results:
+        previous_result = previous_results_dict.get(result['benchmark'])
+        if previous_result is None:
+            continue
+
+        change = result['min_ms'] / previous_result['min_ms'] - 1
+        flag = '  regression' if change > threshold else ''
+        print(f"{result['benchmark']:<50}{previous_result['min_ms']:>13.1f}{result['min_ms']:>12.1f}{100*change:>8.0f}%{flag}")
+
+
+def main():
+    args = parse_arguments()
+    results: list[dict] = []
+
+    if 'scraping' in args.suites:
+        print("Running scraping benchmarks")
+        results += benchmark_scraping(args.repetitions)
+
+    if 'history' in args.suites or 'dashboard' in args.suites:
+        # Histories end yesterday, so the update benchmark adds the prices of today
+        print(f"Generating {args.products} synthetic price histories of {args.days} days")
+        price_history_list_df = make_price_histories(args.products, args.days, first_day=date.today() - timedelta(days=args.days))
+
+        with tempfile.TemporaryDirectory() as temporary_path:
+            if 'history' in args.suites:
+                print("Running history benchmarks")
+                results += benchmark_history(price_history_list_df, temporary_path, args.repetitions)
+
+            if 'dashboard' in args.suites:
+                print("Running dashboard benchmarks")
+                results += benchmark_dashboard(price_history_list_df, temporary_path, args.repetitions)
+
+    if 'config' in args.suites:
+        print("Running config benchmarks")
+        with tempfile.TemporaryDirectory() as temporary_path:
+            results += benchmark_config(args.products, temporary_path, args.repetitions)
+
+    report = {'commit': get_commit(), 'created_at': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'pandas': pd.__version__, 'platform': platform.platform(),
+              'parameters': {'products': args.products, 'days': args.days, 'repetitions': args.repetitions, 'suites': args.suites},
+              'results': results}
+
+    output_path = Path(args.output) if args.output else RESULTS_PATH / f"{report['commit']}.json"
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    print(f"{'benchmark':<50}{'min ms':>10}{'median ms':>11}")
+    for result in results:
+        print(f"{result['benchmark']:<50}{result['min_ms']:>10.1f}{result['median_ms']:>11.1f}")
+    print(f"Results saved in {output_path}")
+
+    if args.compare:
+        compare_results(results, args.compare, args.threshold)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+from datetime import date, timedelta
+from features.price_history_schema import apply_price_history_schema
+from features.price_history_storage import PriceHistoryStorage
+
+'''
+Synthetic price histories shaped like the ones saved by PriceHistoryUpdater, used by the benchmarks
+'''
+
+STORES = ['kabum', 'amazon', 'mercado_livre', 'terabyte', 'pichau']
+
+
+def make_price_histories(n_products: int, n_days: int, first_day: date = date(2022, 1, 1), seed: int = 0) -> list[pd.DataFrame]:
+    ''' Price history of each product with one offer per store per day and the daily and historical best price flags '''
+    rng = np.random.default_rng(seed)
+    days = pd.date_range(first_day, periods=n_days, freq='D')
+    price_history_list_df = []
+
+    for product_number in range(n_products):
+        product_name = f"Product {product_number:04d}"
+        base_price = rng.integers(1000, 10000)
+
+        # Titles repeat, so the rows share the same string objects instead of keeping one copy each, as a real history read from disk would not
+        titles = np.array([f"{product_name} offer {i}" for i in range(97)], dtype=object)
+
+        price_history_df = pd.DataFrame({'Product Name': product_name,
+                                         'Store': np.tile(STORES, n_days),
+                                         'Price': (base_price * rng.uniform(0.8, 1.2, n_days * len(STORES))).astype(int),
+                                         'Title': titles[np.arange(n_days * len(STORES)) % len(titles)],
+                                         'Date': np.repeat(days, len(STORES))})
+
+        price_history_list_df.append(add_best_price_flags(apply_price_history_schema(price_history_df)))
+
+    return price_history_list_df
+
+
+def add_best_price_flags(price_history_df: pd.DataFrame) -> pd.DataFrame:
+    # Same rules of PriceHistoryUpdater: first lowest price of each day and most recent lowest daily best price
+    index_daily_best_price = price_history_df.groupby('Date', sort=False).Price.idxmin()
+    price_history_df['Flag Daily Best Price'] = price_history_df.index.isin(index_daily_best_price)
+
+    daily_best_df = price_history_df[price_history_df['Flag Daily Best Price']]
+    index_historical_best_price = daily_best_df.index[daily_best_df['Price'] == daily_best_df['Price'].min()][-1]
+    price_history_df['Flag Historical Best Price'] = price_history_df.index == index_historical_best_price
+
+    return price_history_df
+
+
+def add_next_day(price_history_list_df: list[pd.DataFrame], seed: int = 1) -> tuple[list[pd.DataFrame], pd.Timestamp]:
+    ''' Append the offers of the day after the last one to each price history, as a new scrape would do, returning the updated histories and the new day '''
+    rng = np.random.default_rng(seed)
+    next_day = price_history_list_df[0]['Date'].iloc[-1] + timedelta(days=1)
+    updated_price_history_list_df = []
+
+    for price_history_df in price_history_list_df:
+        next_day_df = price_history_df.tail(len(STORES)).copy()
+        next_day_df['Date'] = next_day
+        # Prices follow the same distribution of the history, so a new historical best price is as rare as in a real history
+        next_day_df['Price'] = (price_history_df['Price'].median() * rng.uniform(0.8, 1.2, len(STORES))).astype(int)
+
+        updated_price_history_df = pd.concat([price_history_df, next_day_df], ignore_index=True)
+        updated_price_history_list_df.append(add_best_price_flags(apply_price_history_schema(updated_price_history_df)))
+
+    return updated_price_history_list_df, next_day
+
+
+def get_today_and_historical_best_rows(price_history_list_df: list[pd.DataFrame], today: pd.Timestamp) -> tuple[list[pd.DataFrame], list[pd.DataFrame]]:
+    ''' Rows of today and row of the historical best price of each product, as kept by PriceHistoryUpdater '''
+    today_price_history_list_df = [price_history_df[price_history_df['Date'] == today] for price_history_df in price_history_list_df]
+    historical_best_price_list_df = [price_history_df[price_history_df['Flag Historical Best Price']] for price_history_df in price_history_list_df]
+
+    return today_price_history_list_df, historical_best_price_list_df
+
+
+def make_best_offers(price_history_list_df: list[pd.DataFrame], seed: int = 2) -> list[dict]:
+    ''' Best offer of each store for each product, as returned by a scrape, with prices following the distribution of each history '''
+    rng = np.random.default_rng(seed)
+    best_offers = []
+
+    for price_history_df in price_history_list_df:
+        product_name = price_history_df['Product Name'].iloc[0]
+        median_price = price_history_df['Price'].median()
+
+        for store, price in zip(STORES, (median_price * rng.uniform(0.8, 1.2, len(STORES))).astype(int)):
+            best_offers.append({'Product Name': product_name, 'Store': store, 'Price': int(price), 'Title': f"{product_name} offer 0"})
+
+    return best_offers
+
+
+class InMemoryPriceHistoryStorage(PriceHistoryStorage):
+    """
+    Storage backend that serves the synthetic price histories from memory and discards the saved ones,
+    so the benchmarks of the price history update measure the update itself and not the disk
+    """
+
+    def __init__(self, price_history_list_df: list[pd.DataFrame], data_path: str = 'data'):
+        super().__init__(data_path)
+        self.price_histories_dict = {price_history_df['Product Name'].iloc[0]: price_history_df for price_history_df in price_history_list_df}
+
+
+    def read_price_history(self, product_name: str) -> pd.DataFrame:
+        return self.price_histories_dict.get(product_name, pd.DataFrame())
+
+
+    def read_since(self, product_name: str, start_date: pd.Timestamp) -> pd.DataFrame:
+        return self.select_since(self.read_price_history(product_name), start_date)
+
+
+    def read_day(self, product_name: str, day: pd.Timestamp) -> pd.DataFrame:
+        return self.select_day(self.read_price_history(product_name), day)
+
+
+    def save_price_history(self, product_name: str, price_history_df: pd.DataFrame, today: pd.Timestamp) -> None:
+        pass
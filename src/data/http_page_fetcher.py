@@ -0,0 +1,57 @@
+import asyncio
+from termcolor import colored
+
+
+class HttpPageFetcher:
+    """
+    Fetch the HTML of stores that deliver their product cards in the initial page, using a single asynchronous HTTP session
+    with connection pooling and keep-alive instead of rendering the page in a browser
+    """
+
+    def __init__(self, user_agent: str, max_connections: int = 10, timeout: float = 30):
+        self.headers = {'User-Agent': user_agent, 'Accept-Language': 'pt-BR,pt;q=0.9,en;q=0.8'}
+        self.max_connections = max_connections
+        self.timeout = timeout
+
+
+    def fetch_page_sources(self, urls: list[str]) -> dict[str, str | None]:
+        ''' Fetch all URLs concurrently and return the HTML of each one, or None if the request failed '''
+        # Each URL is requested only once, even if several products share it
+        unique_urls = list(dict.fromkeys(urls))
+
+        if not unique_urls:
+            return {}
+
+        page_sources = asyncio.run(self.fetch_all(unique_urls))
+
+        return dict(zip(unique_urls, page_sources))
+
+
+    async def fetch_all(self, urls: list[str]) -> list[str | None]:
+        # aiohttp is only imported when a store is fetched by plain HTTP
+        import aiohttp
+
+        # Connections are kept alive and reused by every request to the same store
+        connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=30)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        async with aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=timeout) as session:
+            return await asyncio.gather(*[self.fetch_page_source(session, url) for url in urls])
+
+
+    async def fetch_page_source(self, session: 'aiohttp.ClientSession', url: str) -> str | None:
+        import aiohttp
+
+        try:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                return await response.text()
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            print(colored(f"Warning: HTTP request to {url} failed ({error})", "yellow"))
+            return None
+
+        # A page declaring a wrong or unknown charset can't be decoded, so it fails like a page that didn't load
+        except (UnicodeDecodeError, LookupError) as error:
+            print(colored(f"Warning: HTTP response of {url} could not be decoded ({error})", "yellow"))
+            return None
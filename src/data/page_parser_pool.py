@@ -0,0 +1,137 @@
+from data.web_scraper import WebScraper
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from threading import Lock
+from time import perf_counter
+import re
+
+
+def extract_matching_offers(page_source: str, store: str, products_matchers: list[tuple[str, re.Pattern | None]]) -> dict:
+    '''
+    Parse the page and match its ads with the products that share it, in a parser process.
+    The counters of the page are returned with the offers, since the metrics of the run live in the main process
+    '''
+    page_offers_dict: dict[str, dict[str, int]] = {product_name: {} for product_name, _ in products_matchers}
+    matched_ads_dict: dict[str, int] = {product_name: 0 for product_name, _ in products_matchers}
+
+    # Every matching ad with its position in the page, including ads that repeat a title, for the offer log
+    page_ads: list[tuple[str, str, int, int]] = []
+
+    # Parse only the product cards of the page
+    _start_time = perf_counter()
+    soup = WebScraper.parse_page(page_source, store)
+    parse_seconds = perf_counter() - _start_time
+
+    # Instance responsible for gathering data from different store sites
+    web_scraper = WebScraper(soup, store)
+
+    _start_time = perf_counter()
+
+    # Find all product elements from HTML
+    _product_elements = web_scraper.get_products() or []
+    _rejected_prices, _rejected_titles = 0, 0
+    page_min_price: int | None = None
+
+    for position, element in enumerate(_product_elements, start=1):
+        # Get title and price from ads
+        ad_title = web_scraper.get_title(element)
+        ad_price = web_scraper.get_price(element)
+
+        # Check if ad price is non-zero
+        if not check_ad_price(ad_price):
+            _rejected_prices += 1
+            continue
+
+        page_min_price = ad_price if page_min_price is None else min(page_min_price, ad_price)
+
+        _is_matched_ad = False
+        for product_name, matcher in products_matchers:
+            # Check if ad title correspond to desired product name by means of keywords
+            if not check_ad_title(ad_title, matcher):
+                continue
+
+            # Add ad title and price in offers dictionary of the product, keeping the lowest price of ads with the same title
+            product_offers = page_offers_dict[product_name]
+            product_offers[ad_title] = min(ad_price, product_offers.get(ad_title, ad_price))
+            page_ads.append((product_name, ad_title, ad_price, position))
+            matched_ads_dict[product_name] += 1
+            _is_matched_ad = True
+
+        _rejected_titles += not _is_matched_ad
+
+    return {'page_offers': page_offers_dict, 'page_min_price': page_min_price, 'parse_seconds': parse_seconds, 'match_seconds': perf_counter() - _start_time,
+            'ads_seen': len(_product_elements), 'rejected_prices': _rejected_prices, 'rejected_titles': _rejected_titles, 'matched_ads': matched_ads_dict,
+            'page_ads': page_ads}
+
+
+def check_ad_title(ad_title: str | None, matcher: re.Pattern | None) -> bool:
+    if ad_title is None:
+        return False
+
+    if matcher is None:
+        return True
+
+    return matcher.match(ad_title) is not None
+
+
+def check_ad_price(ad_price: int) -> bool:
+    return (ad_price != 0)
+
+
+class PageParserPool:
+    """
+    Pool of processes that parse the fetched pages and match their ads with the tracked products, so parsing uses every core
+    and runs while the fetching threads wait for the next pages. The processes are only started by the first page to parse
+    """
+
+    def __init__(self, workers: int):
+        # Without workers, pages are parsed by the thread that fetched them
+        self.workers = workers
+        self.executor: ProcessPoolExecutor | None = None
+        self._lock = Lock()
+
+
+    def submit(self, page_source: str, store: str, products_matchers: list[tuple[str, re.Pattern | None]]) -> Future:
+        ''' Parse the page in a parser process, returning the future of the extracted offers '''
+        if self.workers == 0:
+            future = Future()
+
+            try:
+                future.set_result(extract_matching_offers(page_source, store, products_matchers))
+            except Exception as error:
+                future.set_exception(error)
+
+            return future
+
+        try:
+            return self.get_executor().submit(extract_matching_offers, page_source, store, products_matchers)
+        except BrokenProcessPool:
+            # A parser process died, so the pool is replaced and the page submitted again
+            self.discard_executor()
+            return self.get_executor().submit(extract_matching_offers, page_source, store, products_matchers)
+
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            # Processes are spawned instead of forked, since the fetching threads and the browsers are running, and it behaves the same on Windows
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('spawn'))
+
+            return self.executor
+
+
+    def discard_executor(self) -> None:
+        with self._lock:
+            executor, self.executor = self.executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self.executor = self.executor, None
+
+        if executor is not None:
+            executor.shutdown()
@@ -0,0 +1,189 @@
+from datetime import datetime, timedelta
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock
+from time import time
+import gzip
+import json
+import os
+
+# Objects written less than this long ago may not be in their URL index yet, so they are never collected as unreferenced
+OBJECT_GRACE_SECONDS = 600
+
+# Minimum time between two collections of old snapshots, so a daemon scraping every few minutes doesn't scan the snapshots every time
+GARBAGE_COLLECTION_INTERVAL_SECONDS = 3600
+
+
+class PageSnapshotCache:
+    """
+    Store the HTML of every fetched page compressed on disk, so a page fetched within the TTL is reused instead of fetched again,
+    and a whole run can be replayed offline from the latest snapshots.
+    Each URL keeps only its latest snapshots within the retention, and pages no snapshot refers to anymore are removed
+    """
+
+    def __init__(self, ttl_minutes: float, replay: bool = False, snapshots_path: str = 'data/snapshots', save_snapshots: bool = True,
+                 retention_days: float = 7, keep_per_url: int = 3):
+        self.ttl = timedelta(minutes=ttl_minutes)
+        self.replay = replay
+
+        # Without saving, pages are never reused, but the snapshots saved before can still be replayed
+        self.save_snapshots = save_snapshots
+
+        # Snapshots older than the retention (0 keeps them regardless of age) or beyond the latest ones of their URL are removed
+        self.retention = timedelta(days=retention_days) if retention_days > 0 else None
+        self.keep_per_url = max(keep_per_url, 1)
+
+        # Compressed pages are stored once per content, and each URL keeps an index of its snapshots by fetch time
+        self.objects_path = Path(snapshots_path) / 'objects'
+        self.index_path = Path(snapshots_path) / 'index'
+        self.objects_path.mkdir(parents=True, exist_ok=True)
+        self.index_path.mkdir(parents=True, exist_ok=True)
+
+        # Latest snapshot of each URL looked up or saved by this process, so the index of a URL is read at most once
+        self.latest_snapshots_dict: dict[str, dict | None] = {}
+        self._lock = Lock()
+        self.last_garbage_collection: float | None = None
+
+
+    def get_url_index_path(self, url: str) -> Path:
+        return self.index_path / f"{sha256(url.encode()).hexdigest()}.jsonl"
+
+
+    def read_snapshot_entries(self, url_index_path: Path) -> list[dict]:
+        try:
+            with open(url_index_path, 'r', encoding='utf-8') as file:
+                return [json.loads(line) for line in file.read().splitlines() if line]
+        except (FileNotFoundError, json.JSONDecodeError):
+            return []
+
+
+    def get_retained_entries(self, snapshot_entries: list[dict]) -> list[dict]:
+        ''' Latest snapshots of a URL within the retention '''
+        if self.retention is not None:
+            _oldest_fetched_at = datetime.now() - self.retention
+            snapshot_entries = [entry for entry in snapshot_entries if datetime.fromisoformat(entry['fetched_at']) >= _oldest_fetched_at]
+
+        return snapshot_entries[-self.keep_per_url:]
+
+
+    def write_snapshot_entries(self, url_index_path: Path, snapshot_entries: list[dict]) -> None:
+        if not snapshot_entries:
+            url_index_path.unlink(missing_ok=True)
+            return
+
+        # Write to a temporary file first, so a crash never leaves a truncated index behind
+        _temporary_path = url_index_path.with_suffix(f".{os.getpid()}.tmp")
+        _temporary_path.write_text(''.join(json.dumps(entry) + '\n' for entry in snapshot_entries), encoding='utf-8')
+        os.replace(_temporary_path, url_index_path)
+
+
+    def save_page_source(self, url: str, page_source: str) -> None:
+        if not self.save_snapshots or self.replay:
+            return
+
+        content_bytes = page_source.encode('utf-8')
+        content_hash = sha256(content_bytes).hexdigest()
+        object_path = self.objects_path / f"{content_hash}.html.gz"
+
+        # Identical pages fetched at different times share the same compressed file
+        if not object_path.exists():
+            # Write to a temporary file first, so a crash never leaves a truncated snapshot behind
+            _temporary_path = object_path.with_suffix(f".{os.getpid()}.tmp")
+            _temporary_path.write_bytes(gzip.compress(content_bytes, compresslevel=6))
+            os.replace(_temporary_path, object_path)
+        else:
+            # A page saved again is marked as recent, so a collection running meanwhile in another process doesn't remove it
+            object_path.touch()
+
+        snapshot_entry = {'url': url, 'fetched_at': datetime.now().isoformat(timespec='seconds'), 'content': content_hash}
+        url_index_path = self.get_url_index_path(url)
+
+        # The index is rewritten with the retained snapshots only, so it never grows beyond the latest ones of the URL
+        with self._lock:
+            self.write_snapshot_entries(url_index_path, self.get_retained_entries(self.read_snapshot_entries(url_index_path) + [snapshot_entry]))
+            self.latest_snapshots_dict[url] = snapshot_entry
+
+
+    def get_latest_snapshot(self, url: str) -> dict | None:
+        with self._lock:
+            if url not in self.latest_snapshots_dict:
+                snapshot_entries = self.read_snapshot_entries(self.get_url_index_path(url))
+                self.latest_snapshots_dict[url] = snapshot_entries[-1] if snapshot_entries else None
+
+            return self.latest_snapshots_dict[url]
+
+
+    def limit_ttl(self, max_ttl_minutes: float) -> bool:
+        ''' Lower the TTL to the given minutes if it is longer, returning whether it was lowered '''
+        _max_ttl = timedelta(minutes=max_ttl_minutes)
+
+        if self.ttl <= _max_ttl:
+            return False
+
+        self.ttl = _max_ttl
+        return True
+
+
+    def has_valid_snapshot(self, url: str) -> bool:
+        ''' Check if there is a snapshot of the URL that can be used instead of fetching the page '''
+        snapshot_entry = self.get_latest_snapshot(url)
+
+        if snapshot_entry is None:
+            return False
+
+        # In replay mode every snapshot is valid, no matter how old it is
+        if self.replay:
+            return True
+
+        return (datetime.now() - datetime.fromisoformat(snapshot_entry['fetched_at'])) <= self.ttl
+
+
+    def load_page_source(self, url: str) -> str | None:
+        ''' Get the HTML of the latest valid snapshot of the URL, or None if the page must be fetched '''
+        if not self.has_valid_snapshot(url):
+            return None
+
+        snapshot_entry = self.get_latest_snapshot(url)
+        object_path = self.objects_path / f"{snapshot_entry['content']}.html.gz"
+
+        try:
+            return gzip.decompress(object_path.read_bytes()).decode('utf-8')
+        except (FileNotFoundError, gzip.BadGzipFile, EOFError):
+            return None
+
+
+    def collect_garbage(self) -> None:
+        '''
+        Remove the snapshots beyond the retention from the index of every URL, including URLs no longer tracked, and then the pages no snapshot refers to.
+        It runs at most once per interval, and never in replay mode, which must not change the snapshots it replays
+        '''
+        if self.replay:
+            return
+
+        if (self.last_garbage_collection is not None) and (time() - self.last_garbage_collection < GARBAGE_COLLECTION_INTERVAL_SECONDS):
+            return
+
+        self.last_garbage_collection = time()
+        referenced_contents = set()
+
+        with self._lock:
+            for url_index_path in self.index_path.glob('*.jsonl'):
+                snapshot_entries = self.read_snapshot_entries(url_index_path)
+                retained_entries = self.get_retained_entries(snapshot_entries)
+
+                if len(retained_entries) < len(snapshot_entries):
+                    self.write_snapshot_entries(url_index_path, retained_entries)
+
+                referenced_contents.update(entry['content'] for entry in retained_entries)
+
+            self.latest_snapshots_dict.clear()
+
+        for object_path in self.objects_path.glob('*.html.gz'):
+            if object_path.name.removesuffix('.html.gz') in referenced_contents:
+                continue
+
+            try:
+                if time() - object_path.stat().st_mtime > OBJECT_GRACE_SECONDS:
+                    object_path.unlink()
+            except FileNotFoundError:
+                continue
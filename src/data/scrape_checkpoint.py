@@ -0,0 +1,120 @@
+from datetime import date
+from pathlib import Path
+from threading import Lock
+from termcolor import colored
+import json
+import os
+
+SCRAPE_CHECKPOINT_NAME = 'scrape_checkpoint.jsonl'
+
+
+class ScrapeCheckpoint:
+    """
+    Journal of the scrape of the day: the best offer of each pair of product and store is appended as soon as it is found,
+    and the pairs whose offers were saved in the price history are appended after each save,
+    so a run interrupted at any point can be resumed on the same day without scraping the finished pairs again.
+    A run that finishes marks the checkpoint as complete, so the next run of the day scrapes every pair again
+    """
+
+    def __init__(self, data_path: str = 'data', fresh: bool = False):
+        self.checkpoint_path = Path(data_path) / SCRAPE_CHECKPOINT_NAME
+        self.today = date.today().isoformat()
+        self.lock = Lock()
+
+        # Pairs of product and store finished today, and only the best offers not saved in the price history yet, so memory doesn't grow with the offers
+        self.done_pairs: set[tuple[str, str]] = set()
+        self.unsaved_best_offers_dict: dict[tuple[str, str], dict] = {}
+
+        if not fresh:
+            self.read_checkpoint()
+
+        # A checkpoint of another day or of a finished run, or a fresh start, is replaced by an empty one
+        if not self.done_pairs:
+            self.start_checkpoint()
+
+
+    def read_checkpoint(self) -> None:
+        if not self.checkpoint_path.exists():
+            return
+
+        with open(self.checkpoint_path, 'r', encoding='utf-8') as file:
+            lines = file.readlines()
+
+        # A header cut by a crash leaves nothing to resume
+        try:
+            header = json.loads(lines[0]) if lines else {}
+        except json.JSONDecodeError:
+            return
+
+        if not isinstance(header, dict) or header.get('date') != self.today:
+            return
+
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may have been cut by a crash while it was written
+                continue
+
+            if 'best_offer' in entry:
+                best_offer = entry['best_offer']
+                self.done_pairs.add((best_offer['Product Name'], best_offer['Store']))
+                self.unsaved_best_offers_dict[(best_offer['Product Name'], best_offer['Store'])] = best_offer
+            elif 'saved' in entry:
+                for product_name, store in entry['saved']:
+                    self.unsaved_best_offers_dict.pop((product_name, store), None)
+            elif entry.get('complete'):
+                # The run of this checkpoint finished, so a new run scrapes every pair again and keeps the lowest price of the day
+                self.done_pairs, self.unsaved_best_offers_dict = set(), {}
+                return
+
+
+    def start_checkpoint(self) -> None:
+        self.done_pairs, self.unsaved_best_offers_dict = set(), {}
+        self.checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(self.checkpoint_path, 'w', encoding='utf-8') as file:
+            file.write(json.dumps({'date': self.today}) + '\n')
+
+
+    def append_entry(self, entry: dict) -> None:
+        ''' Append an entry and force it to disk, so it survives a crash right after it '''
+        with self.lock:
+            with open(self.checkpoint_path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+
+
+    def record_best_offer(self, best_offer: dict) -> None:
+        self.done_pairs.add((best_offer['Product Name'], best_offer['Store']))
+        self.append_entry({'best_offer': best_offer})
+
+
+    def record_saved_offers(self, best_offers: list[dict]) -> None:
+        _saved_pairs = [(best_offer['Product Name'], best_offer['Store']) for best_offer in best_offers]
+        for pair in _saved_pairs:
+            self.unsaved_best_offers_dict.pop(pair, None)
+
+        self.append_entry({'saved': _saved_pairs})
+
+
+    def mark_complete(self) -> None:
+        ''' Mark the scrape of the checkpoint as finished, once every best offer is saved in the price history '''
+        self.append_entry({'complete': True})
+
+
+    def get_unsaved_best_offers(self) -> list[dict]:
+        ''' Best offers found by an interrupted run but not saved in the price history yet '''
+        return list(self.unsaved_best_offers_dict.values())
+
+
+    def get_pending_scraping_jobs(self, scraping_jobs: list[tuple[dict, dict]]) -> list[tuple[dict, dict]]:
+        ''' Jobs without a best offer today, including the ones that failed in a previous run '''
+        pending_scraping_jobs = [(product_info, site_info) for product_info, site_info in scraping_jobs
+                                 if (product_info['name'], site_info['name']) not in self.done_pairs]
+
+        if len(pending_scraping_jobs) < len(scraping_jobs):
+            print(colored(f"Resuming the scrape of today: {len(scraping_jobs) - len(pending_scraping_jobs)} of {len(scraping_jobs)} pairs of product and store are already done", 'green'))
+
+        return pending_scraping_jobs
@@ -0,0 +1,113 @@
+from datetime import datetime
+from termcolor import colored
+import heapq
+import itertools
+import json
+import random
+import time
+import yaml
+
+
+class ScrapeScheduler:
+    """
+    Keep a queue with the next run time of each pair of product and store, so a long-running process scrapes each pair on its own interval,
+    with a random jitter that spreads the requests to the same store over time
+    """
+
+    def __init__(self, scraping_jobs: list[tuple[dict, dict]], scheduler_parameters: dict):
+        self.default_interval_minutes: float = scheduler_parameters.get('default_interval_minutes', 1440)
+        self.jitter_fraction: float = scheduler_parameters.get('jitter_fraction', 0)
+        self.interval_rules: list[dict] = scheduler_parameters.get('intervals') or []
+
+        # Jobs due within this window are scraped together, so the jitter doesn't split them in many small scrapes
+        self.batch_window_seconds: float = scheduler_parameters.get('batch_window_seconds', 0)
+
+        # Jobs by product and store, and a heap of (next run time, order of the job, key of the job), so the next job is always on top
+        self.scraping_jobs_dict: dict[tuple[str, str], tuple[dict, dict]] = {}
+        self.next_run_queue: list[tuple[float, int, tuple[str, str]]] = []
+        self.job_order_counter = itertools.count()
+
+        # Every job is due at start, in the order set by the user
+        _now = time.time()
+        for product_info, site_info in scraping_jobs:
+            _job_key = (product_info['name'], site_info['name'])
+            self.scraping_jobs_dict[_job_key] = (product_info, site_info)
+            heapq.heappush(self.next_run_queue, (_now, next(self.job_order_counter), _job_key))
+
+
+    def get_interval_minutes(self, product_name: str, store: str) -> float:
+        ''' Interval of the most specific rule that matches the pair: product and store, then product, then store, then the default interval '''
+        best_specificity, interval_minutes = 0, self.default_interval_minutes
+
+        for rule in self.interval_rules:
+            if rule.get('product', product_name) != product_name or rule.get('store', store) != store:
+                continue
+
+            specificity = 2*('product' in rule) + ('store' in rule)
+            if specificity > best_specificity:
+                best_specificity, interval_minutes = specificity, rule['interval_minutes']
+
+        return interval_minutes
+
+
+    def pop_due_jobs(self) -> list[tuple[dict, dict]]:
+        ''' Remove from the queue and return the jobs whose next run time has come or is within the batch window, in the order they become due '''
+        due_jobs = []
+        _now = time.time()
+
+        if not self.next_run_queue or self.next_run_queue[0][0] > _now:
+            return due_jobs
+
+        while self.next_run_queue and self.next_run_queue[0][0] <= _now + self.batch_window_seconds:
+            _, _, _job_key = heapq.heappop(self.next_run_queue)
+            due_jobs.append(self.scraping_jobs_dict[_job_key])
+
+        return due_jobs
+
+
+    def reschedule_jobs(self, scraping_jobs: list[tuple[dict, dict]]) -> None:
+        ''' Put the jobs back in the queue, to run again after their interval counted from now '''
+        _now = time.time()
+
+        for product_info, site_info in scraping_jobs:
+            _interval_seconds = 60 * self.get_interval_minutes(product_info['name'], site_info['name'])
+            _jitter_seconds = random.uniform(-self.jitter_fraction, self.jitter_fraction) * _interval_seconds
+            heapq.heappush(self.next_run_queue, (_now + _interval_seconds + _jitter_seconds, next(self.job_order_counter), (product_info['name'], site_info['name'])))
+
+
+    def get_min_rescrape_minutes(self) -> float | None:
+        ''' Shortest time between two scrapes of the same pair, with the largest negative jitter and the batch window taking it earlier, None if there are no jobs '''
+        if not self.scraping_jobs_dict:
+            return None
+
+        _min_interval_minutes = min(self.get_interval_minutes(product_name, store) for product_name, store in self.scraping_jobs_dict)
+        return max(0.0, _min_interval_minutes * (1 - self.jitter_fraction) - self.batch_window_seconds / 60)
+
+
+    def get_seconds_until_next_run(self) -> float:
+        if not self.next_run_queue:
+            return float('inf')
+
+        return max(0.0, self.next_run_queue[0][0] - time.time())
+
+
+    def get_next_run_queue(self) -> list[dict]:
+        ''' Next run time of each pair of product and store, soonest first '''
+        return [{'product': product_name, 'store': store, 'next_run': datetime.fromtimestamp(next_run_time).isoformat(timespec='seconds')}
+                for next_run_time, _, (product_name, store) in sorted(self.next_run_queue)]
+
+
+    def save_next_run_queue(self, queue_path: str) -> None:
+        ''' Save the queue in a JSON file, in order to check when each product will be scraped again '''
+        next_run_queue = self.get_next_run_queue()
+
+        with open(queue_path, 'w', encoding='utf-8') as file:
+            json.dump(next_run_queue, file, indent=2)
+
+        if next_run_queue:
+            print(colored(f"Next scrape: {next_run_queue[0]['product']} in {next_run_queue[0]['store']} at {next_run_queue[0]['next_run']}", 'green'))
+
+
+def read_scheduler_config() -> dict:
+    with open('config/scheduler.yaml', 'r') as file:
+        return yaml.safe_load(file) or {}
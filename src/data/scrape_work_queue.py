@@ -0,0 +1,172 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+import sqlite3
+import time
+
+SCRAPE_WORK_QUEUE_NAME = 'scrape_queue.db'
+SCRAPE_MERGE_LOCK_NAME = 'scrape_merge.lock'
+
+
+class ScrapeWorkQueue:
+    """
+    Queue of the pairs of product and store to scrape in a day, shared by independent worker processes through a SQLite database in the data directory.
+    Each worker leases the jobs of a few products at a time, and jobs whose lease expires, because their worker crashed, are leased again by another one.
+    The price history is updated by one worker at a time, holding the merge lock
+    """
+
+    def __init__(self, data_path: str = 'data', lease_minutes: float = 15, max_attempts: int = 2):
+        self.queue_path = Path(data_path) / SCRAPE_WORK_QUEUE_NAME
+        self.merge_lock_path = Path(data_path) / SCRAPE_MERGE_LOCK_NAME
+        self.lease_seconds = 60 * lease_minutes
+
+        # Times a job is leased before it is left as failed for the day
+        self.max_attempts = max_attempts
+
+        self.queue_path.parent.mkdir(parents=True, exist_ok=True)
+        self.create_tables()
+
+
+    def connect(self, path: Path | None = None, timeout: float = 30) -> sqlite3.Connection:
+        # Transactions are opened explicitly, so each lease is taken and updated while holding the write lock
+        connection = sqlite3.connect(path or self.queue_path, timeout=timeout, isolation_level=None)
+
+        # The rollback journal only relies on file locks, unlike write-ahead logging that needs memory shared by the processes of one host,
+        # so workers of several hosts can share the queue in a network directory
+        connection.execute('PRAGMA journal_mode=DELETE')
+
+        return connection
+
+
+    def create_tables(self) -> None:
+        connection = self.connect()
+
+        try:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS scrape_jobs (
+                    run_date TEXT NOT NULL,
+                    product_name TEXT NOT NULL,
+                    store TEXT NOT NULL,
+                    job_order INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker_id TEXT,
+                    lease_expires_at REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (run_date, product_name, store)
+                )
+            ''')
+            connection.execute('CREATE INDEX IF NOT EXISTS idx_run_date_status ON scrape_jobs (run_date, status)')
+        finally:
+            connection.close()
+
+
+    def enqueue_jobs(self, scraping_jobs: list[tuple[dict, dict]], run_date: str) -> None:
+        ''' Add the jobs of the day, keeping the ones already added by another worker, so every worker can start in any order '''
+        rows = [(run_date, product_info['name'], site_info['name'], job_order) for job_order, (product_info, site_info) in enumerate(scraping_jobs)]
+        connection = self.connect()
+
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('INSERT OR IGNORE INTO scrape_jobs (run_date, product_name, store, job_order) VALUES (?, ?, ?, ?)', rows)
+
+            # Jobs of past days are no longer needed
+            connection.execute('DELETE FROM scrape_jobs WHERE run_date < ?', (run_date,))
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+
+    def reset_jobs(self, run_date: str) -> None:
+        ''' Forget the jobs of the day, so they are all scraped again '''
+        connection = self.connect()
+
+        try:
+            connection.execute('DELETE FROM scrape_jobs WHERE run_date = ?', (run_date,))
+        finally:
+            connection.close()
+
+
+    def lease_jobs(self, worker_id: str, run_date: str, batch_products: int) -> list[tuple[str, str]]:
+        '''
+        Lease the available jobs of the next products to the worker, with all their stores, so the stores of a product are scraped and saved together.
+        Jobs are available if they are pending, if their lease expired or if they failed fewer times than the limit
+        '''
+        _now = time.time()
+        _available_condition = '''run_date = ? AND attempts < ? AND (status = 'pending' OR status = 'failed' OR (status = 'leased' AND lease_expires_at < ?))'''
+        connection = self.connect()
+
+        try:
+            # The write lock is taken before reading, so two workers never lease the same job
+            connection.execute('BEGIN IMMEDIATE')
+            product_names = [row[0] for row in connection.execute(f'''
+                SELECT product_name FROM scrape_jobs WHERE {_available_condition}
+                GROUP BY product_name ORDER BY MIN(job_order) LIMIT ?
+            ''', (run_date, self.max_attempts, _now, batch_products))]
+
+            if not product_names:
+                connection.execute('COMMIT')
+                return []
+
+            _placeholders = ', '.join('?' * len(product_names))
+            leased_jobs = [(product_name, store) for product_name, store in connection.execute(f'''
+                UPDATE scrape_jobs SET status = 'leased', worker_id = ?, lease_expires_at = ?, attempts = attempts + 1
+                WHERE {_available_condition} AND product_name IN ({_placeholders})
+                RETURNING product_name, store
+            ''', (worker_id, _now + self.lease_seconds, run_date, self.max_attempts, _now, *product_names))]
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+        return leased_jobs
+
+
+    def complete_jobs(self, worker_id: str, run_date: str, leased_jobs: list[tuple[str, str]], done_jobs: set[tuple[str, str]]) -> None:
+        ''' Mark the leased jobs with a best offer as done and the others as failed, unless another worker leased them meanwhile '''
+        rows = [('done' if (product_name, store) in done_jobs else 'failed', run_date, product_name, store, worker_id) for product_name, store in leased_jobs]
+        connection = self.connect()
+
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('''
+                UPDATE scrape_jobs SET status = ?, lease_expires_at = NULL
+                WHERE run_date = ? AND product_name = ? AND store = ? AND worker_id = ? AND status = 'leased'
+            ''', rows)
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+
+    def get_seconds_until_lease_expiry(self, run_date: str) -> float | None:
+        ''' Seconds until the next lease held by another worker expires, None if no job is leased, so the worker can stop '''
+        connection = self.connect()
+
+        try:
+            next_expiry, = connection.execute("SELECT MIN(lease_expires_at) FROM scrape_jobs WHERE run_date = ? AND status = 'leased'", (run_date,)).fetchone()
+        finally:
+            connection.close()
+
+        return None if next_expiry is None else max(0.0, next_expiry - time.time())
+
+
+    def get_job_counts(self, run_date: str) -> dict[str, int]:
+        connection = self.connect()
+
+        try:
+            return dict(connection.execute('SELECT status, COUNT(*) FROM scrape_jobs WHERE run_date = ? GROUP BY status', (run_date,)).fetchall())
+        finally:
+            connection.close()
+
+
+    @contextmanager
+    def merge_lock(self) -> Iterator[None]:
+        '''
+        Hold the lock that lets a single worker at a time update the price history, the summary index and the processed price history.
+        It is an exclusive transaction on a separate SQLite file, so it works on every platform and is released by the system if the worker crashes
+        '''
+        connection = self.connect(self.merge_lock_path, timeout=3600)
+
+        try:
+            connection.execute('BEGIN EXCLUSIVE')
+            yield
+        finally:
+            connection.close()
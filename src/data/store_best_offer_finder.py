@@ -1,125 +1,425 @@
-from bs4 import BeautifulSoup
 from data.web_scraper import WebScraper
-from selenium.webdriver.support.wait import WebDriverWait
-from selenium.webdriver.support import expected_conditions as ec
-from selenium.webdriver.common.by import By
+from data.web_driver_pool import WebDriverPool
+from data.http_page_fetcher import HttpPageFetcher
+from data.page_snapshot_cache import PageSnapshotCache
+from data.page_parser_pool import PageParserPool
+from monitoring.run_metrics import run_metrics
+from concurrent.futures import Future, ThreadPoolExecutor
 from termcolor import colored
+from time import perf_counter
+from typing import Callable, TYPE_CHECKING
 import re
 
+# The offer log needs pandas and PyArrow, which are only imported by runs that keep it
+if TYPE_CHECKING:
+    from features.offer_log import OfferLog
+
 class StoreBestOfferFinder:
     """
     Retrieve offers with titles matching the desired product keywords and prices that are available, then identify the best offer on the site
     """
 
-    def __init__(self, driver, tracked_products_list): 
-        self.driver = driver
+    def __init__(self, driver_pool: WebDriverPool, http_page_fetcher: HttpPageFetcher, fetch_strategies: dict[str, str], page_snapshot_cache: PageSnapshotCache, tracked_products_list,
+                 max_pages: int = 1, page_parser_pool: PageParserPool | None = None, offer_log: 'OfferLog | None' = None):
+        self.driver_pool = driver_pool
+        self.http_page_fetcher = http_page_fetcher
+        self.fetch_strategies = fetch_strategies
+        self.page_snapshot_cache = page_snapshot_cache
         self.tracked_products_list = tracked_products_list
 
-        # Auxiliary attributes to avoid pass arguments in methods
-        self.product_info = {}
-        self.site_info = {}
+        # Result pages crawled at most in each store listing, for stores with a pagination rule
+        self.max_pages = max_pages
+
+        # Processes that parse the fetched pages, or the fetching threads themselves if no pool is given
+        self.page_parser_pool = page_parser_pool if page_parser_pool is not None else PageParserPool(0)
+
+        # Log of every matching ad, if enabled
+        self.offer_log = offer_log
+
+        # URLs of the pages fetched by this process and not yet parsed, so only their ads are logged and not those of pages reused from a snapshot
+        self.fetched_page_urls: set[str] = set()
+
+        # HTML of the pages fetched by HTTP, requested all at once before the browser pages
+        self.http_page_sources: dict[str, str | None] = {}
+
+        # Seconds waited for each rendered page to become ready, per store, and the number of pages that timed out
+        self.page_wait_times: dict[str, list[float]] = {}
+        self.page_timeouts: dict[str, int] = {}
+
+
+    def get_store_best_offers(self, scraping_jobs: list[tuple[dict, dict]], on_best_offer: Callable[[dict], None] | None = None) -> list[dict]:
+        '''
+        Get the best offer of each pair of product and store, keeping the web drivers open for the next scrapes.
+        Each best offer is also handed to on_best_offer as soon as its listing is crawled, before the other listings finish
+        '''
+        best_offers_dict: dict[tuple[str, str, str], dict] = {}
+
+        # Wait times are reported for each scrape
+        self.page_wait_times, self.page_timeouts = {}, {}
+
+        # Products that share the same store page are scraped together, so each page is fetched and parsed only once
+        page_jobs = self.group_scraping_jobs_by_page(scraping_jobs)
+
+        def get_listing_best_offers(site_info: dict, products_info: list[dict], listing_offers: dict[str, dict[str, int]]) -> None:
+            for product_info in products_info:
+                store_offers = listing_offers[product_info['name']]
+
+                if self.check_web_scrapping_results(store_offers, product_info, site_info):
+                    # Get the minimum price from store
+                    best_store_offer = self.get_best_store_offer(store_offers, product_info, site_info)
+                    best_offers_dict[(product_info['name'], site_info['name'], site_info['url'])] = best_store_offer
+                    run_metrics.increment('best_offers_total', store=site_info['name'])
+
+                    if on_best_offer is not None:
+                        on_best_offer(best_store_offer)
+
+        self.crawl_listings(page_jobs, get_listing_best_offers)
+
+        self.report_page_wait_times()
+
+        # The matching ads of this scrape are written to the offer log as a single segment
+        if self.offer_log is not None:
+            self.offer_log.flush()
+
+        # Add the best offer of each store in a list, in the same order as the jobs, regardless of which page loads first
+        best_offers = [best_offers_dict[_job_key] for product_info, site_info in scraping_jobs
+                       if (_job_key := (product_info['name'], site_info['name'], site_info['url'])) in best_offers_dict]
+
+        return best_offers
+
+
+    def split_scraping_jobs_in_batches(self, scraping_jobs: list[tuple[dict, dict]], batch_products: int) -> list[list[tuple[dict, dict]]]:
+        ''' Split the jobs in batches of products, keeping all the stores of a product in the same batch, in the order set by the user '''
+        product_jobs_dict: dict[str, list[tuple[dict, dict]]] = {}
+
+        for product_info, site_info in scraping_jobs:
+            product_jobs_dict.setdefault(product_info['name'], []).append((product_info, site_info))
+
+        product_jobs_list = list(product_jobs_dict.values())
+
+        return [[job for product_jobs in product_jobs_list[batch_start:batch_start + batch_products] for job in product_jobs]
+                for batch_start in range(0, len(product_jobs_list), batch_products)]
+
+
+    def crawl_listings(self, page_jobs: list[tuple[dict, list[dict]]], on_listing_crawled: Callable[[dict, list[dict], dict[str, dict[str, int]]], None]) -> None:
+        '''
+        Crawl the result pages of every listing in rounds: the first pages of all listings, then the next pages of the listings that may still have
+        better offers, all fetched concurrently in each round, so crawling more pages adds rounds instead of a page at a time.
+        The offers of each listing are handed to on_listing_crawled as soon as its last page is crawled, and then released
+        '''
+        page_offers_dict = {(site_info['name'], site_info['url']): {product_info['name']: {} for product_info in products_info} for site_info, products_info in page_jobs}
+        pages_crawled_dict = {_listing_key: 0 for _listing_key in page_offers_dict}
+
+        # Each round job is a listing, a page of it and the products matched against the page
+        round_jobs = [((site_info['name'], site_info['url']), 1, site_info, products_info) for site_info, products_info in page_jobs]
+
+        # Fetch the pages concurrently, one per web driver of the pool
+        with ThreadPoolExecutor(max_workers=self.driver_pool.pool_size) as executor:
+            while round_jobs:
+                self.fetch_http_page_sources([page_site_info for _, _, page_site_info, _ in round_jobs])
+                # Each thread hands its page to the parser pool and moves on to the next fetch, so parsing overlaps with the pages still loading
+                round_futures = list(executor.map(lambda job: self.try_submit_matching_offers(job[2], job[3]), round_jobs))
+                round_results = [self.get_available_matching_offers(page_site_info, products_info, future, page_number)
+                                 for (_, page_number, page_site_info, products_info), future in zip(round_jobs, round_futures)]
+
+                # Page minimum prices of each listing in this round, by page number, None for pages without ads
+                round_min_prices_dict: dict[tuple[str, str], dict[int, int | None]] = {}
+
+                for (_listing_key, page_number, _, _), (page_offers, page_min_price) in zip(round_jobs, round_results):
+                    for product_name, offers in page_offers.items():
+                        listing_offers = page_offers_dict[_listing_key][product_name]
+                        for ad_title, ad_price in offers.items():
+                            listing_offers[ad_title] = min(ad_price, listing_offers.get(ad_title, ad_price))
+
+                    round_min_prices_dict.setdefault(_listing_key, {})[page_number] = page_min_price
+                    pages_crawled_dict[_listing_key] = max(pages_crawled_dict[_listing_key], page_number)
+
+                round_jobs = []
+
+                for site_info, products_info in page_jobs:
+                    _listing_key = (site_info['name'], site_info['url'])
+                    if _listing_key not in round_min_prices_dict:
+                        continue
+
+                    next_pages = self.get_next_pages(site_info, pages_crawled_dict[_listing_key], round_min_prices_dict[_listing_key], page_offers_dict[_listing_key])
+                    round_jobs += [(_listing_key, page_number, page_site_info, products_info) for page_number, page_site_info in next_pages]
+
+                    # The listing is complete
+                    if not next_pages:
+                        on_listing_crawled(site_info, products_info, page_offers_dict.pop(_listing_key))
+
+
+    def get_next_pages(self, site_info: dict, pages_crawled: int, round_min_prices: dict[int, int | None], listing_offers: dict[str, dict[str, int]]) -> list[tuple[int, dict]]:
+        '''
+        Next result pages of the listing to crawl, with their site info. A listing ends at the page limit or at a page without ads,
+        and a listing sorted by price ends as soon as its last page costs more than the best offer of every product, since the next pages only cost more.
+        Listings sorted by price are crawled a few pages per round, the others have all their remaining pages fetched at once
+        '''
+        if (pages_crawled >= self.max_pages) or (WebScraper.get_page_url(site_info['name'], site_info['url'], 2) is None):
+            return []
+
+        # The end of the listing was reached, or a page could not be loaded
+        if any(page_min_price is None for page_min_price in round_min_prices.values()):
+            return []
+
+        if WebScraper.is_price_sorted(site_info['name'], site_info['url']):
+            _last_page_min_price = round_min_prices[max(round_min_prices)]
+            _best_prices = [min(offers.values()) for offers in listing_offers.values() if offers]
+
+            if (len(_best_prices) == len(listing_offers)) and (_last_page_min_price >= max(_best_prices)):
+                run_metrics.increment('pages_skipped_total', self.max_pages - pages_crawled, store=site_info['name'])
+                return []
+
+            _last_page_number = min(pages_crawled + self.driver_pool.pool_size, self.max_pages)
+        else:
+            _last_page_number = self.max_pages
+
+        next_pages = [(page_number, {'name': site_info['name'], 'url': WebScraper.get_page_url(site_info['name'], site_info['url'], page_number)})
+                      for page_number in range(pages_crawled + 1, _last_page_number + 1)]
+
+        # A replay only has the pages crawled by the original run
+        if self.page_snapshot_cache.replay:
+            next_pages = [(page_number, page_site_info) for page_number, page_site_info in next_pages if self.page_snapshot_cache.has_valid_snapshot(page_site_info['url'])]
+
+        return next_pages
+
+
+    def fetch_http_page_sources(self, pages_site_info: list[dict]) -> None:
+        ''' Fetch the pages of stores that don't need a browser concurrently through a single HTTP session, except the ones with a valid snapshot '''
+        if self.page_snapshot_cache.replay:
+            return
+
+        _http_urls = [site_info['url'] for site_info in pages_site_info
+                      if (self.get_fetch_strategy(site_info) == 'http') and not self.page_snapshot_cache.has_valid_snapshot(site_info['url'])]
+
+        with run_metrics.time_stage('http_fetch'):
+            self.http_page_sources = self.http_page_fetcher.fetch_page_sources(_http_urls)
 
 
-    def get_store_best_offers_for_all_products(self) -> list[dict]:
-        ''' Get the name and price information from each best store offer '''
-        best_offers = []
+    def get_scraping_jobs(self) -> list[tuple[dict, dict]]:
+        scraping_jobs = []
 
         # Sweep products list to get prices from each one
         for product in self.tracked_products_list:
-            self.product_info = {'name': product['name'], 'keywords': product['keywords']}
+            product_info = {'name': product['name'], 'keywords': product['keywords'], 'matcher': self.compile_keywords_matcher(product['keywords'])}
 
             # Sweep product key and value to get the respective URLs set by the user
             for site_name, site_url in product.items():
                 if site_name not in ['name', 'keywords']:
                     # Remove prefix "url_" from key in product dict
                     adjusted_site_name = site_name.replace('url_', '')
-                    self.site_info = {'name': adjusted_site_name, 'url': site_url}
-                    
-                    # Get the name and price information from each available product ad that matches the desired product in the given URL
-                    store_offers: dict[str, int] = self.get_available_matching_offers()
+                    site_info = {'name': adjusted_site_name, 'url': site_url}
 
-                    if self.check_web_scrapping_results(store_offers):
-                        # Get the minimum price from store
-                        best_store_offer = self.get_best_store_offer(store_offers)
+                    scraping_jobs.append((product_info, site_info))
 
-                        # Add the best offer of each store in a list
-                        best_offers.append(best_store_offer)
+        return scraping_jobs
 
-        # Close the WebDriver after completing the web scraping
-        self.driver.quit()
 
-        return best_offers
-    
+    def group_scraping_jobs_by_page(self, scraping_jobs: list[tuple[dict, dict]]) -> list[tuple[dict, list[dict]]]:
+        ''' Group the products by store page, keeping the pages in the order they first appear '''
+        page_jobs_dict: dict[tuple[str, str], tuple[dict, list[dict]]] = {}
+
+        for product_info, site_info in scraping_jobs:
+            _page_key = (site_info['name'], site_info['url'])
+            page_jobs_dict.setdefault(_page_key, (site_info, []))[1].append(product_info)
+
+        return list(page_jobs_dict.values())
+
+
+    def compile_keywords_matcher(self, keywords: list[str] | None) -> re.Pattern | None:
+        ''' Compile the keywords of a product into a single pattern that matches titles containing all of them, in any order '''
+        if keywords is None:
+            return None
+
+        return re.compile(''.join(fr'(?=.*?{keyword})' for keyword in keywords), re.IGNORECASE | re.DOTALL)
+
+
+    def get_fetch_strategy(self, site_info: dict) -> str:
+        return self.fetch_strategies.get(site_info['name'], 'browser')
+
+
+    def get_page_source(self, site_info: dict) -> str | None:
+        ''' Get HTML from URL, reusing its snapshot if it is still valid, returning None if the page could not be loaded '''
+        with run_metrics.time_stage('snapshot_load', store=site_info['name']):
+            page_source = self.page_snapshot_cache.load_page_source(site_info['url'])
+
+        if page_source is not None:
+            run_metrics.increment('pages_total', store=site_info['name'], source='snapshot')
+            return page_source
+
+        # In replay mode pages are never fetched
+        if self.page_snapshot_cache.replay:
+            run_metrics.increment('failures_total', stage='snapshot_load', store=site_info['name'])
+            print(colored(f"Error: There is no snapshot of {site_info['name']}'s page to replay: {site_info['url']}", "red"))
+            return None
 
-    def get_available_matching_offers(self) -> dict[str, int]:
-        store_offers_dict = {}
-        _delay = 60
+        page_source = self.fetch_page_source(site_info)
+
+        if page_source is not None:
+            run_metrics.increment('pages_total', store=site_info['name'], source=self.get_fetch_strategy(site_info))
+        else:
+            run_metrics.increment('failures_total', stage='page_fetch', store=site_info['name'])
+
+        # Keep a snapshot of the page, so it can be parsed again without fetching it
+        if page_source is not None:
+            self.page_snapshot_cache.save_page_source(site_info['url'], page_source)
+            self.fetched_page_urls.add(site_info['url'])
+
+        return page_source
+
+
+    def fetch_page_source(self, site_info: dict) -> str | None:
+        ''' Fetch HTML from URL by means of the fetch strategy of the store '''
+        if self.get_fetch_strategy(site_info) == 'http':
+            return self.http_page_sources.get(site_info['url'])
+
+        # Render the page with a web driver of the pool, Selenium is only imported by stores fetched in the browser
+        from selenium.common.exceptions import TimeoutException
+
+        try:
+            return self.driver_pool.run_with_driver(lambda driver: self.render_page_source(driver, site_info))
+        except TimeoutException:
+            self.page_timeouts[site_info['name']] = self.page_timeouts.get(site_info['name'], 0) + 1
+            run_metrics.increment('failures_total', stage='ready_wait', store=site_info['name'])
+            print(colored(f"Error: The offers of {site_info['name']}'s site didn't load in time: {site_info['url']}", "red"))
+            return None
+
+
+    def render_page_source(self, driver, site_info: dict) -> str:
+        from selenium.webdriver.support.wait import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as ec
+        from selenium.webdriver.common.by import By
+
+        # Readiness condition of the store: the CSS selector of a loaded offer and how long to wait for it
+        store_parameters = WebScraper.get_store_parameters(site_info['name'])
+        _ready_selector = store_parameters.get('ready_selector', 'span')
+        _ready_timeout = store_parameters.get('ready_timeout', 60)
 
         # Set URL to scrap
-        self.driver.get(self.site_info['url'])
-
-        # Wait for all span elements that contains prices loading
-        wait = WebDriverWait(self.driver, _delay)
-        wait.until(ec.presence_of_all_elements_located((By.TAG_NAME,'span'))) 
-
-        # Get HTML from url
-        soup = BeautifulSoup(self.driver.page_source, 'html.parser')
-
-        # Instance responsible for gathering data from different store sites
-        web_scraper = WebScraper(soup, self.site_info['name'])
-
-        # Find all product elements from HTML
-        _product_elements = web_scraper.get_products()
-        
-        for element in _product_elements:
-            # Get title and price from ads
-            ad_title = web_scraper.get_title(element)
-            ad_price = web_scraper.get_price(element)
-
-            # Check if ad title correspond to desired product name by means of keywords
-            if not self.check_ad_title(ad_title):
-                continue
-
-            # Check if ad price is non-zero
-            if not self.check_ad_price(ad_price):
-                continue
-                
-            # Add ad title and price in offers dictionary
-            store_offers_dict[ad_title] = ad_price
-    
-        return store_offers_dict
-    
-
-    def check_ad_title(self, ad_title: str) -> bool:
-        if self.product_info['keywords'] is None:
-            return True
+        with run_metrics.time_stage('page_load', store=site_info['name']):
+            driver.get(site_info['url'])
 
-        for keyword in self.product_info['keywords']:
-            _match = re.search(fr'{keyword}', ad_title, re.IGNORECASE)
-            if _match is None:
-                return False
+        # Wait for the first product card with a price to be rendered
+        _start_time = perf_counter()
+        with run_metrics.time_stage('ready_wait', store=site_info['name']):
+            wait = WebDriverWait(driver, _ready_timeout)
+            wait.until(ec.presence_of_element_located((By.CSS_SELECTOR, _ready_selector)))
+        self.page_wait_times.setdefault(site_info['name'], []).append(perf_counter() - _start_time)
 
-        return True
+        return driver.page_source
 
 
-    def check_ad_price(self, ad_price: int) -> bool:
-        return (ad_price != 0)
+    def submit_matching_offers(self, site_info: dict, products_info: list[dict]) -> Future | None:
+        '''
+        Fetch the page of the given URL and hand it to the parser pool, returning as soon as it is submitted,
+        so the thread fetches the next page while this one is parsed. None if the page could not be loaded
+        '''
+        _store = site_info['name']
+        _start_time = perf_counter()
 
+        # Get HTML from URL, either rendered by the browser or requested by HTTP
+        page_source = self.get_page_source(site_info)
 
-    def check_web_scrapping_results(self, store_offers: dict[str, int]) -> bool:
+        # The page could not be loaded
+        if page_source is None:
+            return None
+
+        # Only the name and the keywords matcher of each product are sent to the parser process
+        products_matchers = [(product_info['name'], product_info['matcher']) for product_info in products_info]
+        future = self.page_parser_pool.submit(page_source, _store, products_matchers)
+        future.add_done_callback(lambda done_future: self.record_page_metrics(_store, done_future, _start_time))
+
+        return future
+
+
+    def try_submit_matching_offers(self, site_info: dict, products_info: list[dict]) -> Future | None:
+        ''' Submit the page like submit_matching_offers, failing only this page on an unexpected error, so the other pages of the round are still crawled '''
+        try:
+            return self.submit_matching_offers(site_info, products_info)
+
+        except Exception as error:
+            run_metrics.increment('failures_total', stage='page_fetch', store=site_info['name'])
+            print(colored(f"Error: The page of {site_info['name']}'s site failed ({type(error).__name__}: {error}): {site_info['url']}", "red"))
+            return None
+
+
+    def record_page_metrics(self, store: str, future: Future, start_time: float) -> None:
+        ''' Record the counters and timings returned by the parser process, once the page is parsed '''
+        if future.cancelled() or (future.exception() is not None):
+            return
+
+        page_result = future.result()
+        run_metrics.observe('stage_duration_seconds', page_result['parse_seconds'], stage='parse', store=store)
+        run_metrics.observe('stage_duration_seconds', page_result['match_seconds'], stage='match', store=store)
+
+        for product_name, matched_ads in page_result['matched_ads'].items():
+            if matched_ads:
+                run_metrics.increment('ads_matched_total', matched_ads, store=store, product=product_name)
+
+        run_metrics.increment('ads_seen_total', page_result['ads_seen'], store=store)
+        run_metrics.increment('ads_rejected_total', page_result['rejected_prices'], store=store, reason='price')
+        run_metrics.increment('ads_rejected_total', page_result['rejected_titles'], store=store, reason='title')
+        run_metrics.observe('page_duration_seconds', perf_counter() - start_time, store=store)
+
+
+    def get_available_matching_offers(self, site_info: dict, products_info: list[dict], future: Future | None, page_number: int = 1) -> tuple[dict[str, dict[str, int]], int | None]:
+        '''
+        Get the name and price information from each available product ad in the given URL,
+        separated by the products that share the page and whose keywords match the ad,
+        and the lowest price of all ads of the page, None if the page has no ad with a price
+        '''
+        page_offers_dict = {product_info['name']: {} for product_info in products_info}
+
+        # The page could not be loaded
+        if future is None:
+            return page_offers_dict, None
+
+        # The ads of a page reused from a snapshot were already logged by the scrape that fetched it
+        _fetched_page = site_info['url'] in self.fetched_page_urls
+        self.fetched_page_urls.discard(site_info['url'])
+
+        # Wait for the parser process, a page that can't be parsed ends its listing like a page that can't be loaded
+        try:
+            page_result = future.result()
+        except Exception as error:
+            run_metrics.increment('failures_total', stage='parse', store=site_info['name'])
+            print(colored(f"Error: The page of {site_info['name']}'s site could not be parsed: {error}", "red"))
+            return page_offers_dict, None
+
+        # Keep every matching ad of the page, not only the best offer of each product
+        if (self.offer_log is not None) and _fetched_page:
+            self.offer_log.record_page_ads(site_info['name'], page_number, page_result['page_ads'])
+
+        return page_result['page_offers'], page_result['page_min_price']
+
+
+    def check_web_scrapping_results(self, store_offers: dict[str, int], product_info: dict, site_info: dict) -> bool:
         if store_offers:
-            print(colored(f"Successfully took the prices of product '{self.product_info['name']}' from {self.site_info['name']}'s site", 'green'))
+            print(colored(f"Successfully took the prices of product '{product_info['name']}' from {site_info['name']}'s site", 'green'))
             return True
         else:
-            print(colored(f"Error: No price for product '{self.product_info['name']}' was found in {self.site_info['name']}'s site. Check if the URL is correct: {self.site_info['url']}", "red"))
+            run_metrics.increment('failures_total', stage='no_offers', store=site_info['name'], product=product_info['name'])
+            print(colored(f"Error: No price for product '{product_info['name']}' was found in {site_info['name']}'s site. Check if the URL is correct: {site_info['url']}", "red"))
             print(colored("Otherwise, the HTML of the site may have been changed and the code needs maintenance", "red"))
             return False
-       
 
-    def get_best_store_offer(self, store_offers: dict[str,int]) -> dict:
+
+    def report_page_wait_times(self) -> None:
+        ''' Show how long the rendered pages of each store took to become ready, in order to tune the readiness timeouts '''
+        for store in sorted(set(self.page_wait_times) | set(self.page_timeouts)):
+            wait_times = self.page_wait_times.get(store, [])
+            timeouts = self.page_timeouts.get(store, 0)
+
+            if wait_times:
+                print(f"Page wait times of {store}: {len(wait_times)} pages, mean {sum(wait_times)/len(wait_times):.2f} s, max {max(wait_times):.2f} s, {timeouts} timeouts")
+            else:
+                print(f"Page wait times of {store}: {timeouts} timeouts")
+
+
+    def get_best_store_offer(self, store_offers: dict[str,int], product_info: dict, site_info: dict) -> dict:
         best_name = min(store_offers, key=store_offers.get)
         best_price = store_offers[best_name]
-        
-        best_store_offer = {'Product Name': self.product_info['name'], 'Store': self.site_info['name'], 'Price': best_price, 'Title': best_name}
+
+        best_store_offer = {'Product Name': product_info['name'], 'Store': site_info['name'], 'Price': best_price, 'Title': best_name}
 
         return best_store_offer
\ No newline at end of file
@@ -0,0 +1,174 @@
+from data.web_scraper import WebScraper
+from pathlib import Path
+from termcolor import colored
+import glob
+import hashlib
+import json
+import os
+import yaml
+
+TRACKED_PRODUCTS_CACHE_PATH = 'data/config_cache'
+DEFAULT_TRACKED_PRODUCTS_FILES = ['config/tracked_products.yaml', 'config/tracked_products/*.yaml']
+
+# Version of the compiled form of a file, so files compiled by an older validation are compiled again
+TRACKED_PRODUCTS_CACHE_VERSION = 1
+
+# The libyaml loader is several times faster than the pure Python one, which is only used if PyYAML was built without libyaml
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class TrackedProductsLoader:
+    """
+    Read the tracked products from every file matching the patterns set by the user, so a large catalog can be split into several files.
+    Each file is parsed and validated once, and its products and validation messages are cached by the hash of its content,
+    so the next runs skip parsing and validating the files that didn't change
+    """
+
+    def __init__(self, file_patterns: list[str] | None = None, cache_path: str = TRACKED_PRODUCTS_CACHE_PATH):
+        self.file_patterns = file_patterns or DEFAULT_TRACKED_PRODUCTS_FILES
+        self.cache_path = Path(cache_path)
+
+        # Parameters a product accepts: its name, its keywords and a URL for each registered store
+        self.valid_parameters = {'name', 'keywords'} | {f'url_{store}' for store in WebScraper.store_names}
+
+        # Files are validated against the registered stores and their URL patterns, so changing them compiles every file again
+        _validator_parameters = {'version': TRACKED_PRODUCTS_CACHE_VERSION, 'stores': {store: WebScraper.stores[store]['url_pattern'] for store in WebScraper.store_names}}
+        self.validator_hash = hashlib.sha256(json.dumps(_validator_parameters, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+    def get_file_paths(self) -> list[str]:
+        ''' Files matching the patterns, in the order of the patterns and sorted by name within each one, without repeating files '''
+        file_paths_dict: dict[str, None] = {}
+
+        for file_pattern in self.file_patterns:
+            for file_path in sorted(glob.glob(file_pattern, recursive=True)):
+                file_paths_dict.setdefault(os.path.normpath(file_path))
+
+        return list(file_paths_dict)
+
+
+    def load(self, verbose: bool = True) -> tuple[list[dict], bool]:
+        ''' Products of every file and whether all of them are valid, showing the validation messages of each file if verbose '''
+        file_paths = self.get_file_paths()
+
+        if not file_paths:
+            if verbose:
+                print(colored(f"Error: No tracked products file matches {self.file_patterns}", "red"))
+            return [], False
+
+        tracked_products_list: list[dict] = []
+        product_files_dict: dict[str, str] = {}
+        success_bool = True
+        cache_keys = set()
+
+        for file_path in file_paths:
+            cache_key, compiled_file = self.load_file(file_path)
+            cache_keys.add(cache_key)
+            success_bool &= compiled_file['success']
+
+            if verbose:
+                for message, color in compiled_file['messages']:
+                    print(colored(message, color))
+
+            for product in compiled_file['products']:
+                # A product set in two files would mix the prices of both in the same price history
+                if product.get('name') in product_files_dict:
+                    if verbose:
+                        print(colored(f"Warning: Product '{product['name']}' in {file_path} was already set in {product_files_dict[product['name']]}. It will be ignored", "yellow"))
+                    continue
+
+                product_files_dict[product.get('name')] = file_path
+                tracked_products_list.append(product)
+
+        self.remove_stale_cache_files(cache_keys)
+
+        if success_bool and verbose:
+            print(f"Successfully processed the list of {len(tracked_products_list)} tracked products")
+
+        return tracked_products_list, success_bool
+
+
+    def load_file(self, file_path: str) -> tuple[str, dict]:
+        ''' Compiled form of a file, read from the cache if the file didn't change since it was compiled '''
+        file_bytes = Path(file_path).read_bytes()
+
+        # The path is part of the key since the validation messages name the file
+        cache_key = hashlib.sha256(f'{self.validator_hash}:{file_path}:'.encode('utf-8') + file_bytes).hexdigest()
+        cache_file_path = self.cache_path / f'{cache_key}.json'
+
+        try:
+            with open(cache_file_path, 'r', encoding='utf-8') as file:
+                return cache_key, json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+        compiled_file = self.compile_file(file_bytes, file_path)
+        self.save_cache_file(cache_file_path, compiled_file)
+
+        return cache_key, compiled_file
+
+
+    def compile_file(self, file_bytes: bytes, file_path: str) -> dict:
+        ''' Parse and validate the products of a file, keeping the messages of the validation to be shown when the file is read from the cache '''
+        try:
+            raw_tracked_products_list = yaml.load(file_bytes, Loader=YAML_LOADER) or []
+        except yaml.YAMLError as error:
+            return {'products': [], 'success': False, 'messages': [(f"Error: Invalid YAML in {file_path} ({error})", "red")]}
+
+        if not isinstance(raw_tracked_products_list, list) or not all(isinstance(product, dict) for product in raw_tracked_products_list):
+            return {'products': [], 'success': False, 'messages': [(f"Error: {file_path} must be a list of products", "red")]}
+
+        success_bool, messages = self.check_monitored_product_list(raw_tracked_products_list, file_path)
+
+        return {'products': raw_tracked_products_list, 'success': success_bool, 'messages': messages}
+
+
+    def check_monitored_product_list(self, raw_tracked_products_list: list[dict], file_path: str) -> tuple[bool, list[tuple[str, str]]]:
+        success_bool = True
+        messages = []
+
+        for product in raw_tracked_products_list:
+            for parameter, value in product.items():
+                # Check if it is a valid parameter
+                if (parameter not in self.valid_parameters):
+                    success_bool = False
+                    messages.append((f"Error: Wrong parameter name '{parameter}' for product '{product.get('name')}' in {file_path}", "red"))
+
+                # Check if the user set a name for product
+                elif (parameter == 'name') and (value is None):
+                    success_bool = False
+                    messages.append((f"Error: No name was set for a product in {file_path}", "red"))
+
+                # Check if the URLs are valid, with the pattern of the store compiled only once
+                elif parameter.startswith('url_'):
+                    if not WebScraper.is_valid_store_url(parameter.removeprefix('url_'), value):
+                        success_bool = False
+                        messages.append((f"Error: Invalid '{parameter}' was set for product '{product.get('name')}' in {file_path}", "red"))
+
+            # Return warning if a product doesn't have at least one valid URL
+            if not any(parameter.startswith('url_') for parameter in product):
+                messages.append((f"Warning: No valid URL was set for product '{product.get('name')}' in {file_path}", "yellow"))
+
+        return success_bool, messages
+
+
+    def save_cache_file(self, cache_file_path: Path, compiled_file: dict) -> None:
+        cache_file_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file of the process first, so workers compiling the same file never read a truncated cache
+        _temporary_path = cache_file_path.with_suffix(f'.{os.getpid()}.tmp')
+        _temporary_path.write_text(json.dumps(compiled_file, ensure_ascii=False), encoding='utf-8')
+        _temporary_path.replace(cache_file_path)
+
+
+    def remove_stale_cache_files(self, cache_keys: set[str]) -> None:
+        ''' Remove the compiled forms of files that changed or no longer exist '''
+        for cache_file_path in self.cache_path.glob('*.json'):
+            if cache_file_path.stem not in cache_keys:
+                cache_file_path.unlink(missing_ok=True)
+
+
+def read_tracked_products_files() -> list[str] | None:
+    ''' Patterns of the tracked products files set in config/browser.yaml, the default files if not set '''
+    with open('config/browser.yaml', 'r') as file:
+        return (yaml.load(file, Loader=YAML_LOADER) or {}).get('tracked_products_files')
@@ -1,11 +1,19 @@
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service as ChromeService
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.edge.service import Service as EdgeService
-from webdriver_manager.microsoft import EdgeChromiumDriverManager
+from data.web_driver_pool import WebDriverPool
+from data.http_page_fetcher import HttpPageFetcher
+from data.page_parser_pool import PageParserPool
+from data.tracked_products_loader import TrackedProductsLoader
 from termcolor import colored
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, Any
+import json
+import os
 import yaml
-import re
+
+# Selenium and the web driver managers are imported only when a browser is started, so runs that don't render pages start faster
+
+# Driver binary resolved for each browser, reused by the next runs instead of looked up again
+DRIVER_PATHS_CACHE_PATH = 'data/driver_paths.json'
 
 
 class WebDriverConfiger:
@@ -15,7 +23,7 @@ class WebDriverConfiger:
 
     def __init__(self):
         # Read YAML config files
-        raw_browser_parameters, raw_tracked_products_list = self.read_config_files() 
+        raw_browser_parameters = self.read_config_files()
 
         # Get browser name that will be used and set all characters to lowercase
         self.browser_name = raw_browser_parameters['browser'].lower()
@@ -23,75 +31,183 @@ class WebDriverConfiger:
         # Get user agent
         self.user_agent = raw_browser_parameters['user_agent']
 
+        # Get the number of web drivers that fetch pages concurrently
+        self.pool_size = self.get_pool_size(raw_browser_parameters)
+
+        # Get whether images, fonts and style sheets are blocked in the browser to render pages faster
+        self.block_resources: bool = raw_browser_parameters.get('block_resources', False)
+
+        # Get for how many minutes a fetched page is reused instead of fetched again
+        self.snapshot_ttl_minutes: float = raw_browser_parameters.get('snapshot_ttl_minutes', 0)
+
+        # Get whether fetched pages are saved as snapshots, and for how long and how many snapshots of each URL are kept
+        self.save_snapshots: bool = raw_browser_parameters.get('save_snapshots', True)
+        self.snapshot_retention_days: float = raw_browser_parameters.get('snapshot_retention_days', 7)
+        self.snapshot_keep_per_url: int = raw_browser_parameters.get('snapshot_keep_per_url', 3)
+
+        # Get how many result pages of each store listing are crawled
+        self.max_pages = self.get_max_pages(raw_browser_parameters)
+
+        # Get how many processes parse the fetched pages
+        self.parser_workers = self.get_parser_workers(raw_browser_parameters)
+
+        # Get how the pages of each store are fetched: rendered in a browser or requested by plain HTTP
+        self.fetch_strategies = self.get_fetch_strategies(raw_browser_parameters)
+
+        # Get the driver binary set by the user, and whether the web driver manager may be consulted to find it
+        self.configured_driver_path: str | None = raw_browser_parameters.get('driver_path') or None
+        self.driver_offline: bool = raw_browser_parameters.get('driver_offline', False)
+        self.driver_path: str | None = None
+
+        # Read the tracked products from the files set by the user, validating only the files changed since the last run
+        raw_tracked_products_list, success_bool = TrackedProductsLoader(raw_browser_parameters.get('tracked_products_files')).load()
+
         # Check if the parameters set by the user for monitored products are valid
-        if self.check_monitored_product_list(raw_tracked_products_list):
+        if success_bool:
             self.tracked_products_list = raw_tracked_products_list
             
-            # Create web driver corresponding to the chosen browser
-            self.driver= self.set_browser_driver()
+            # Create a pool of web drivers corresponding to the chosen browser, the drivers are only started when needed
+            self.driver_pool = WebDriverPool(self.set_browser_driver, self.pool_size)
+
+            # Create the HTTP client for stores that don't need a browser to render their offers
+            self.http_page_fetcher = HttpPageFetcher(self.user_agent)
+
+            # Create the pool of processes that parse the fetched pages, the processes are only started by the first page to parse
+            self.page_parser_pool = PageParserPool(self.parser_workers)
             
             
-    def read_config_files(self) -> tuple[dict, list[dict]]:
+    def read_config_files(self) -> dict:
         with open('config/browser.yaml', 'r') as file:
             raw_browser_name: dict = yaml.safe_load(file)
 
-        with open('config/tracked_products.yaml', 'r') as file:
-            raw_tracked_products_list: list[dict] = yaml.safe_load(file)
-    
-        return raw_browser_name, raw_tracked_products_list
-
-
-    def check_monitored_product_list(self, raw_tracked_products_list: list[dict]) -> bool:
-        _valid_parameters_list = ['name', 'keywords', 'url_kabum', 'url_amazon', 'url_pichau', 'url_terabyte', 'url_mercado_livre']
-        success_bool = True
-
-        for product in raw_tracked_products_list:
-            for parameter, value in product.items():
-                # Check if it is a valid parameter
-                if (parameter not in _valid_parameters_list):
-                    success_bool = False
-                    print(colored(f"Error: Wrong parameter name '{parameter}' for product '{product['name']}' in config/tracked_products.yaml", "red"))
-
-                # Check if the user set a name for product
-                elif (parameter == 'name') and (value is None):
-                    success_bool = False
-                    print(colored(f"Error: No name was set for a product in config/tracked_products.yaml", "red"))
-                    
-                # Check if the URLs are valid
-                elif (re.search("url_", parameter)):
-                    if not (self.is_valid_url(parameter, value)):
-                        success_bool = False
-                        print(colored(f"Error: Invalid '{parameter}' was set for product '{product['name']}' in config/tracked_products.yaml", "red"))
-
-            # Return warning if a product doesn't have at least one valid URL
-            _bool_have_url = [True for parameter in product if parameter.startswith("url_")]
-            if not _bool_have_url: 
-                print(colored(f"Warning: No valid URL was set for product '{product['name']}' in config/tracked_products.yaml", "yellow"))
-                
-        if success_bool:
-            print("Successfully processed the list of tracked products")
+        return raw_browser_name
 
-        return success_bool
 
-    
-    def is_valid_url(self, site_name: str, site_url: str | None) -> bool:
-        # Check if the user has set a blank URL
-        if site_url is None:
-            return False
-        
-        # Auxiliary variable to identify the site name in URL check
-        _site_name_adjusted = site_name.replace('url', '').replace('_', '')
-
-        # Check if URL correspond to the site
-        _match = re.search(f'.*{_site_name_adjusted}.*\.com', site_url, re.IGNORECASE)
-
-        if _match is None:
-            return False
+    def get_pool_size(self, raw_browser_parameters: dict) -> int:
+        pool_size = raw_browser_parameters.get('pool_size', 1)
+
+        # Fall back to a single web driver if the pool size is not a positive integer
+        if not isinstance(pool_size, int) or (pool_size < 1):
+            print(colored(f"Warning: Invalid pool_size '{pool_size}' in config/browser.yaml. Using a single web driver", "yellow"))
+            pool_size = 1
+
+        return pool_size
+
+
+    def get_max_pages(self, raw_browser_parameters: dict) -> int:
+        max_pages = raw_browser_parameters.get('max_pages', 1)
+
+        # Without a valid limit, only the page set by the user is crawled
+        if not isinstance(max_pages, int) or (max_pages < 1):
+            print(colored(f"Warning: Invalid max_pages '{max_pages}' in config/browser.yaml. Crawling only the first page", "yellow"))
+            max_pages = 1
+
+        return max_pages
+
+
+    def get_parser_workers(self, raw_browser_parameters: dict) -> int:
+        parser_workers = raw_browser_parameters.get('parser_workers', os.cpu_count() or 1)
+
+        # Fall back to parsing in the threads that fetch the pages if the number of workers is not a non-negative integer
+        if not isinstance(parser_workers, int) or (parser_workers < 0):
+            print(colored(f"Warning: Invalid parser_workers '{parser_workers}' in config/browser.yaml. Parsing the pages in the fetching threads", "yellow"))
+            parser_workers = 0
+
+        return parser_workers
+
+
+    def get_fetch_strategies(self, raw_browser_parameters: dict) -> dict[str, str]:
+        _valid_strategies = ['browser', 'http']
+        fetch_strategies = {}
+
+        # Stores without a fetch strategy are rendered in the browser
+        raw_fetch_strategies: dict = raw_browser_parameters.get('fetch_strategy') or {}
+
+        for store, strategy in raw_fetch_strategies.items():
+            if strategy not in _valid_strategies:
+                print(colored(f"Warning: Invalid fetch strategy '{strategy}' for store '{store}' in config/browser.yaml. Using 'browser'", "yellow"))
+                strategy = 'browser'
+
+            fetch_strategies[store] = strategy
+
+        return fetch_strategies
+
+
+    def read_driver_paths_cache(self) -> dict[str, str]:
+        try:
+            with open(DRIVER_PATHS_CACHE_PATH, 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+
+    def save_driver_path_in_cache(self, driver_path: str) -> None:
+        driver_paths_dict = self.read_driver_paths_cache()
+        driver_paths_dict[self.browser_name] = driver_path
+
+        Path(DRIVER_PATHS_CACHE_PATH).parent.mkdir(parents=True, exist_ok=True)
+        with open(DRIVER_PATHS_CACHE_PATH, 'w') as file:
+            json.dump(driver_paths_dict, file, indent=2)
+
+
+    def install_driver(self) -> str:
+        ''' Look up the driver matching the installed browser with the web driver manager, downloading it if needed '''
+        match self.browser_name:
+            case 'chrome':
+                from webdriver_manager.chrome import ChromeDriverManager
+                return ChromeDriverManager().install()
+            case 'edge':
+                from webdriver_manager.microsoft import EdgeChromiumDriverManager
+                return EdgeChromiumDriverManager().install()
+
+
+    def get_driver_path(self, refresh: bool = False) -> str:
+        '''
+        Path of the driver binary: the one set by the user, otherwise the one cached by a previous run,
+        otherwise the one found by the web driver manager, which is never consulted in offline mode
+        '''
+        if (self.driver_path is not None) and not refresh:
+            return self.driver_path
+
+        _start_time = perf_counter()
+        _cached_driver_path = self.read_driver_paths_cache().get(self.browser_name)
+
+        if self.configured_driver_path is not None:
+            self.driver_path, _source = self.configured_driver_path, 'config/browser.yaml'
+
+        elif (_cached_driver_path is not None) and Path(_cached_driver_path).exists() and not refresh:
+            self.driver_path, _source = _cached_driver_path, DRIVER_PATHS_CACHE_PATH
+
+        elif self.driver_offline:
+            print(colored(f"Error: No {self.browser_name} driver is cached and driver_offline is set in config/browser.yaml. Set driver_path or run once without driver_offline", "red"))
+            raise FileNotFoundError(f"No cached {self.browser_name} driver")
+
         else:
-            return True
-        
+            self.driver_path, _source = self.install_driver(), 'web driver manager'
+            self.save_driver_path_in_cache(self.driver_path)
 
-    def set_browser_driver(self) -> webdriver.ChromeOptions | webdriver.EdgeOptions:
+        print(f"Resolved the {self.browser_name} driver from {_source} in {perf_counter() - _start_time:.2f} s")
+
+        return self.driver_path
+
+
+    def start_driver(self, create_driver: Callable[[str], Any]) -> Any:
+        ''' Start a driver with the resolved binary, looking it up again if the cached one no longer matches the browser '''
+        from selenium.common.exceptions import SessionNotCreatedException
+
+        try:
+            return create_driver(self.get_driver_path())
+
+        except SessionNotCreatedException:
+            # The browser may have been updated since the driver was cached
+            if (self.configured_driver_path is not None) or self.driver_offline:
+                raise
+
+            print(colored(f"Warning: The cached {self.browser_name} driver doesn't match the browser. Looking it up again", "yellow"))
+            return create_driver(self.get_driver_path(refresh=True))
+
+
+    def set_browser_driver(self) -> Any:
         _success_bool = True
 
         match self.browser_name:
@@ -110,22 +226,54 @@ class WebDriverConfiger:
         return driver
     
 
-    def webDriverChrome(self) -> webdriver.ChromeOptions:
+    def webDriverChrome(self) -> Any:
+        from selenium import webdriver
+        from selenium.webdriver.chrome.service import Service as ChromeService
+
         _options = webdriver.ChromeOptions()
         _options.add_argument('--headless') # Doesn't open the browser during the process
         _options.add_argument('log-level=3') # Suppress warning messages
         _options.add_argument(f'user-agent={self.user_agent}')
+        _options.page_load_strategy = 'eager' # Doesn't wait for images and style sheets, the offers are awaited by the store readiness condition
         #_options.add_experimental_option("detach", True) # Keeps browser open
-        driver = webdriver.Chrome(service=ChromeService(ChromeDriverManager().install()), options=_options)
+        self.set_resource_blocking_options(_options)
+        driver = self.start_driver(lambda driver_path: webdriver.Chrome(service=ChromeService(driver_path), options=_options))
+        self.block_page_resources(driver)
 
         return driver
 
 
-    def webDriverEdge(self) -> webdriver.EdgeOptions:
+    def webDriverEdge(self) -> Any:
+        from selenium import webdriver
+        from selenium.webdriver.edge.service import Service as EdgeService
+
         _options = webdriver.EdgeOptions()
         _options.add_argument('--headless')
         _options.add_argument('log-level=3')
         _options.add_argument(f'user-agent={self.user_agent}')
-        driver = webdriver.Edge(service=EdgeService(EdgeChromiumDriverManager().install()), options=_options)
+        _options.page_load_strategy = 'eager'
+        self.set_resource_blocking_options(_options)
+        driver = self.start_driver(lambda driver_path: webdriver.Edge(service=EdgeService(driver_path), options=_options))
+        self.block_page_resources(driver)
+
+        return driver
+
+
+    def set_resource_blocking_options(self, options: Any) -> None:
+        if not self.block_resources:
+            return
+
+        # Don't download images, they are never used in web scraping
+        options.add_argument('--blink-settings=imagesEnabled=false')
+        options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+
+
+    def block_page_resources(self, driver: Any) -> None:
+        if not self.block_resources:
+            return
 
-        return driver
\ No newline at end of file
+        # Block fonts and style sheets through the Chrome DevTools Protocol, available in both Chromium-based browsers
+        _blocked_url_patterns = ['*.css', '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+                                 '*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.svg', '*.ico']
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': _blocked_url_patterns})
\ No newline at end of file
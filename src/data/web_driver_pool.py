@@ -0,0 +1,137 @@
+from queue import Queue, Empty
+from threading import Lock
+from typing import Callable, Any
+from termcolor import colored
+from monitoring.run_metrics import run_metrics
+
+
+class WebDriverPool:
+    """
+    Keep a bounded pool of web drivers shared by concurrent page fetches, creating drivers on demand and replacing the ones that crash
+    """
+
+    def __init__(self, create_driver: Callable[[], Any], pool_size: int, max_retries: int = 1):
+        self.create_driver = create_driver
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+
+        # Drivers waiting to be lent and every driver alive in the pool
+        self.idle_drivers: Queue = Queue()
+        self.live_drivers: list = []
+
+        # Slots reserved by drivers still starting, so browsers start outside the lock while the pool stays within its size limit
+        self.starting_drivers = 0
+        self._lock = Lock()
+
+
+    def acquire_driver(self):
+        ''' Lend an idle driver, or create one while the pool is below its size limit, returning None if the driver could not be started '''
+        while True:
+            try:
+                return self.idle_drivers.get_nowait()
+            except Empty:
+                pass
+
+            # Reserve a slot only while the pool is below its size limit, the driver is started after the lock is released
+            with self._lock:
+                _is_slot_reserved = len(self.live_drivers) + self.starting_drivers < self.pool_size
+                if _is_slot_reserved:
+                    self.starting_drivers += 1
+
+            if _is_slot_reserved:
+                return self.start_driver()
+
+            # Otherwise wait for a driver to be released by another fetch, checking again for a free slot left by a driver that crashed and couldn't be replaced
+            try:
+                return self.idle_drivers.get(timeout=1)
+            except Empty:
+                continue
+
+
+    def start_driver(self):
+        ''' Start a driver in a reserved slot, which becomes a live driver or is given back if the browser could not be started '''
+        # Any error starting the browser only fails the page that needed it, the slot stays free for the next page to try again
+        try:
+            with run_metrics.time_stage('driver_start'):
+                driver = self.create_driver()
+
+        except Exception as error:
+            with self._lock:
+                self.starting_drivers -= 1
+
+            run_metrics.increment('failures_total', stage='driver_start')
+            print(colored(f"Error: Web driver could not be started ({error})", "red"))
+            return None
+
+        with self._lock:
+            self.starting_drivers -= 1
+            self.live_drivers.append(driver)
+
+        return driver
+
+
+    def release_driver(self, driver) -> None:
+        self.idle_drivers.put(driver)
+
+
+    def discard_driver(self, driver) -> None:
+        ''' Shut down a crashed driver and remove it from the pool, so a new one can be created in its place '''
+        self.quit_driver(driver)
+
+        with self._lock:
+            self.live_drivers.remove(driver)
+
+
+    def run_with_driver(self, task: Callable[[Any], Any]) -> Any:
+        '''
+        Lend a driver to the task and give it back afterwards. If the driver crashes, it is replaced and the task is retried.
+        Timeouts are raised to the caller, since they are caused by the page and not by the driver.
+        '''
+        from selenium.common.exceptions import WebDriverException, TimeoutException
+
+        driver = self.acquire_driver()
+
+        try:
+            for attempt in range(self.max_retries + 1):
+                # The page fails if no driver could be started for it
+                if driver is None:
+                    return None
+
+                try:
+                    return task(driver)
+
+                except TimeoutException:
+                    raise
+
+                except WebDriverException as error:
+                    run_metrics.increment('failures_total', stage='driver')
+                    print(colored(f"Warning: Web driver crashed ({error.msg}). Replacing it (attempt {attempt + 1} of {self.max_retries + 1})", "yellow"))
+                    self.discard_driver(driver)
+                    driver = None
+                    driver = self.acquire_driver()
+
+            return None
+
+        finally:
+            if driver is not None:
+                self.release_driver(driver)
+
+
+    def quit_driver(self, driver) -> None:
+        from selenium.common.exceptions import WebDriverException
+
+        try:
+            driver.quit()
+        except WebDriverException:
+            # The driver process may already be dead, nothing left to close
+            pass
+
+
+    def quit_all(self) -> None:
+        ''' Close every web driver of the pool after completing the web scraping '''
+        with self._lock:
+            for driver in self.live_drivers:
+                self.quit_driver(driver)
+
+            self.live_drivers.clear()
+            self.idle_drivers = Queue()
@@ -1,4 +1,7 @@
 from bs4 import BeautifulSoup, Tag
+from lxml import etree, html
+from typing import Callable
+from urllib.parse import urlsplit, urlunsplit, unquote_plus
 import re
 from math import ceil
 
@@ -10,24 +13,44 @@ class WebScraper:
 
     kabum = {'tag_products': 'article', 'attribute_products': 'class', 'value_products': 'productCard',
             'tag_title': 'span', 'attribute_title': 'class', 'value_title': 'nameCard',
-            'tag_price': 'span', 'attribute_price': 'class', 'value_price': 'priceCard'}
+            'tag_price': 'span', 'attribute_price': 'class', 'value_price': 'priceCard',
+            'ready_selector': 'article[class*="productCard"] span[class*="priceCard"]', 'ready_timeout': 20,
+            'page_parameter': 'page_number', 'price_sorted_pattern': r'[?&]sort=price(&|$)', 'url_pattern': r'kabum.*\.com'}
 
     amazon = {'tag_products': 'div', 'attribute_products': 'class', 'value_products': 'a-section a-spacing-base',
             'tag_title': 'span', 'attribute_title': 'class', 'value_title': 'a-size-base-plus a-color-base a-text-normal',
-            'tag_price': 'span', 'attribute_price': 'class', 'value_price': 'a-offscreen'}
+            'tag_price': 'span', 'attribute_price': 'class', 'value_price': 'a-offscreen',
+            'ready_selector': 'div[class*="a-section a-spacing-base"] span[class*="a-offscreen"]', 'ready_timeout': 20,
+            'page_parameter': 'page', 'price_sorted_pattern': r'[?&]s=price-asc-rank', 'url_pattern': r'amazon.*\.com'}
     
     mercado_livre = {'tag_products': 'li', 'attribute_products': 'class', 'value_products': 'ui-search-layout__item',
             'tag_title': 'h2', 'attribute_title': 'class', 'value_title': 'ui-search-item__title',
-            'tag_price': 'span', 'attribute_price': 'class', 'value_price': 'andes-money-amount__fraction'}
+            'tag_price': 'span', 'attribute_price': 'class', 'value_price': 'andes-money-amount__fraction',
+            'ready_selector': 'li[class*="ui-search-layout__item"] span[class*="andes-money-amount__fraction"]', 'ready_timeout': 15,
+            'page_offset_format': '_Desde_{offset}', 'page_size': 48, 'price_sorted_pattern': r'_OrderId_PRICE(?!\*DESC)', 'url_pattern': r'mercadolivre.*\.com'}
     
     terabyte = {'tag_products': 'div', 'attribute_products': 'class', 'value_products': 'commerce_columns_item_inner',
             'tag_title': 'a', 'attribute_title': 'class', 'value_title': 'prod-name',
-            'tag_price': 'div', 'attribute_price': 'class', 'value_price': 'prod-new-price'}
+            'tag_price': 'div', 'attribute_price': 'class', 'value_price': 'prod-new-price',
+            'ready_selector': 'div[class*="commerce_columns_item_inner"] div[class*="prod-new-price"]', 'ready_timeout': 15, 'url_pattern': r'terabyte.*\.com'}
         
     pichau = {'tag_products': 'div', 'attribute_products': 'class', 'value_products': 'MuiCardContent-root',
             'tag_title': 'h2', 'attribute_title': 'class', 'value_title': 'MuiTypography-root',
-            'tag_price': 'div', 'attribute_price': 'class', 'value_price': ''}
-    
+            'tag_price': 'div', 'attribute_price': 'class', 'value_price': '',
+            'ready_selector': 'div[class*="MuiCardContent-root"] h2', 'ready_timeout': 20,
+            'page_parameter': 'page', 'price_sorted_pattern': r'[?&]sort=price-asc', 'url_pattern': r'pichau.*\.com'}
+
+    # Stores available to the tracked products, set as url_[store] in config/tracked_products.yaml
+    # A new store only needs its parameters above, including the pattern its URLs must match, and an entry here
+    stores: dict[str, dict] = {'kabum': kabum, 'amazon': amazon, 'mercado_livre': mercado_livre, 'terabyte': terabyte, 'pichau': pichau}
+    store_names = list(stores)
+
+    # Pattern of the price in the ad text, e.g. "R$ 4.137,99"
+    price_pattern = re.compile(r"(\d{1,3}\.)+\d{1,3},{0,1}\d*")
+
+    # Patterns and product card strainer of each store, compiled only once when the module is imported
+    compiled_store_parameters: dict[str, dict] = {}
+
 
     def __init__(self, soup: BeautifulSoup, store: str):
         self.soup = soup
@@ -36,40 +59,144 @@ class WebScraper:
         self.store = store
         store_parameters = self.set_up_store_parameters()
         
+        compiled_parameters = WebScraper.compiled_store_parameters.get(store) or WebScraper.compile_store_parameters(store_parameters)
+
         self.tag_products = store_parameters['tag_products']
         self.attr_products = store_parameters['attribute_products']
-        self.value_products = store_parameters['value_products']
+        self.pattern_products = compiled_parameters['pattern_products']
 
         self.tag_title = store_parameters['tag_title']
         self.attr_title = store_parameters['attribute_title']
-        self.value_title = store_parameters['value_title']
+        self.pattern_title = compiled_parameters['pattern_title']
 
         self.tag_price = store_parameters['tag_price']
         self.attr_price = store_parameters['attribute_price']
-        self.value_price = store_parameters['value_price']
+        self.pattern_price = compiled_parameters['pattern_price']
 
 
     def set_up_store_parameters(self) -> dict[str, str]:
-        match self.store:
-            case 'kabum':
-                store_parameters = WebScraper.kabum
-            case 'amazon':
-                store_parameters = WebScraper.amazon
-            case 'mercado_livre':
-                store_parameters = WebScraper.mercado_livre
-            case 'terabyte':
-                store_parameters = WebScraper.terabyte
-            case 'pichau':
-                store_parameters = WebScraper.pichau
-            case _:
-                store_parameters = {}
-
-        return store_parameters
-        
+        return WebScraper.get_store_parameters(self.store)
+
+
+    @staticmethod
+    def get_store_parameters(store: str) -> dict[str, str]:
+        return WebScraper.stores.get(store, {})
+
+
+    @staticmethod
+    def compile_store_parameters(store_parameters: dict) -> dict:
+        pattern_products = re.compile(store_parameters['value_products'])
+
+        compiled_parameters = {'pattern_products': pattern_products,
+                               'pattern_title': re.compile(store_parameters['value_title']),
+                               'pattern_price': re.compile(store_parameters['value_price']),
+                               'xpath_products': WebScraper.compile_products_xpath(store_parameters),
+                               'pattern_url': re.compile(store_parameters['url_pattern'], re.IGNORECASE)}
+
+        return compiled_parameters
+
+
+    @staticmethod
+    def compile_products_xpath(store_parameters: dict) -> Callable[[html.HtmlElement], list]:
+        ''' XPath of the outermost product cards, matching the attribute with the same regular expression used by BeautifulSoup '''
+        _card = f"{store_parameters['tag_products']}[re:test(@{store_parameters['attribute_products']}, $pattern)]"
+
+        products_xpath = etree.XPath(f"//{_card}[not(ancestor::{_card})]", namespaces={'re': 'http://exslt.org/regular-expressions'})
+
+        # Bind the store pattern so the XPath can be called only with the page root
+        return lambda root: products_xpath(root, pattern=store_parameters['value_products'])
+
+
+    @classmethod
+    def compile_all_store_parameters(cls) -> None:
+        for store in cls.store_names:
+            cls.compiled_store_parameters[store] = cls.compile_store_parameters(cls.get_store_parameters(store))
+
+
+    @staticmethod
+    def is_valid_store_url(store: str, url: str | None) -> bool:
+        ''' Check if the URL belongs to the store, with the pattern compiled once for every product '''
+        compiled_parameters = WebScraper.compiled_store_parameters.get(store)
+
+        if (compiled_parameters is None) or (url is None):
+            return False
+
+        return compiled_parameters['pattern_url'].search(url) is not None
+
+
+    @staticmethod
+    def parse_page(page_source: str, store: str) -> BeautifulSoup:
+        '''
+        Locate the product cards in the page with lxml and build the BeautifulSoup only with their subtrees,
+        skipping menus, scripts and styles that make up most of the page
+        '''
+        compiled_parameters = WebScraper.compiled_store_parameters.get(store)
+
+        if compiled_parameters is None:
+            return BeautifulSoup(page_source, 'lxml')
+
+        try:
+            root = html.document_fromstring(page_source)
+        except (etree.ParserError, ValueError):
+            # Empty page or page with an encoding declaration, which lxml only accepts as bytes
+            return BeautifulSoup(page_source, 'lxml')
+
+        card_elements = compiled_parameters['xpath_products'](root)
+        cards_page_source = ''.join(html.tostring(card_element, encoding='unicode', with_tail=False) for card_element in card_elements)
+
+        return BeautifulSoup(cards_page_source, 'lxml')
+
+
+    @staticmethod
+    def get_page_url(store: str, url: str, page_number: int) -> str | None:
+        '''
+        URL of a result page of the store listing, set by the page number in the query (e.g. page_number=2 in Kabum) or by the offset of
+        the first ad in the path (e.g. _Desde_49 in Mercado Livre), or None if the store has no pagination rule
+        '''
+        store_parameters = WebScraper.get_store_parameters(store)
+        scheme, netloc, path, query, fragment = urlsplit(url)
+
+        if 'page_parameter' in store_parameters:
+            # Only the page parameter is replaced, or appended if missing, so the rest of the query keeps its order and encoding
+            _page_segment = f"{store_parameters['page_parameter']}={page_number}"
+            _query_segments = [segment for segment in query.split('&') if segment]
+            _page_indexes = [index for index, segment in enumerate(_query_segments) if unquote_plus(segment.partition('=')[0]) == store_parameters['page_parameter']]
+
+            if _page_indexes:
+                _query_segments[_page_indexes[0]] = _page_segment
+            else:
+                _query_segments.append(_page_segment)
+
+            return urlunsplit((scheme, netloc, path, '&'.join(_query_segments), fragment))
+
+        if 'page_offset_format' in store_parameters:
+            _offset_segment = store_parameters['page_offset_format'].format(offset=(page_number - 1)*store_parameters['page_size'] + 1)
+            _offset_pattern = re.escape(store_parameters['page_offset_format']).replace(r'\{offset\}', r'\d+')
+
+            # The offset replaces the one already in the path, otherwise it goes before the filters at the end of the path
+            if re.search(_offset_pattern, path):
+                path = re.sub(_offset_pattern, _offset_segment, path)
+            elif '_NoIndex_' in path:
+                path = path.replace('_NoIndex_', f'{_offset_segment}_NoIndex_', 1)
+            else:
+                path = f'{path}{_offset_segment}'
+
+            return urlunsplit((scheme, netloc, path, query, fragment))
+
+        return None
+
+
+    @staticmethod
+    def is_price_sorted(store: str, url: str) -> bool:
+        ''' Whether the listing of the URL is sorted from the lowest price, so its later pages only have higher prices '''
+        price_sorted_pattern = WebScraper.get_store_parameters(store).get('price_sorted_pattern')
+
+        return (price_sorted_pattern is not None) and (re.search(price_sorted_pattern, url) is not None)
+
 
     def get_products(self) -> list | None:
         try:
-            ad_products = self.soup.find_all(self.tag_products, attrs = {self.attr_products: re.compile(self.value_products)})
+            ad_products = self.soup.find_all(self.tag_products, attrs = {self.attr_products: self.pattern_products})
         
         except AttributeError:
             ad_products = None
@@ -79,7 +206,7 @@ class WebScraper:
 
     def get_title(self, element: Tag) -> str | None:
         try:
-            ad_title_tag = element.find(self.tag_title, attrs = {self.attr_title: re.compile(self.value_title)})
+            ad_title_tag = element.find(self.tag_title, attrs = {self.attr_title: self.pattern_title})
             ad_title = ad_title_tag.text.strip()
         
         except AttributeError:
@@ -94,12 +221,12 @@ class WebScraper:
             if (self.store == 'pichau'):
                 ad_price_tag = element.find_all(self.tag_price)[4]
             else:
-                ad_price_tag = element.find(self.tag_price, attrs = {self.attr_price: re.compile(self.value_price)})
+                ad_price_tag = element.find(self.tag_price, attrs = {self.attr_price: self.pattern_price})
             
             raw_ad_price_str = ad_price_tag.text.strip()
             
             # Search for price pattern in ad
-            ad_price_match = re.search(r"(\d{1,3}\.)+\d{1,3},{0,1}\d*", raw_ad_price_str)
+            ad_price_match = WebScraper.price_pattern.search(raw_ad_price_str)
 
             # Price data processing
             ad_price_str = ad_price_match.group()
@@ -109,4 +236,8 @@ class WebScraper:
         except (AttributeError, IndexError):
             ad_price = 0
 
-        return ad_price
\ No newline at end of file
+        return ad_price
+
+
+# Compile the web scraping parameters of all stores once, instead of at every search in the page
+WebScraper.compile_all_store_parameters()
@@ -0,0 +1,152 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from datetime import date, datetime
+from pathlib import Path
+from threading import Lock
+import os
+
+OFFER_LOG_NAME = 'offer_log'
+
+# Every matching ad of a run: names and titles repeat across rows and runs, so they are dictionary encoded, and prices are whole reais
+OFFER_LOG_SCHEMA = pa.schema([
+    ('Product Name', pa.dictionary(pa.int32(), pa.string())),
+    ('Store', pa.dictionary(pa.int32(), pa.string())),
+    ('Title', pa.dictionary(pa.int32(), pa.string())),
+    ('Price', pa.int32()),
+    ('Seen At', pa.timestamp('s')),
+    ('Page', pa.int16()),
+    ('Position', pa.int16()),
+])
+
+
+class OfferLog:
+    """
+    Append-only log of every ad matching a tracked product, with its title, price, when it was seen and its position in the store listing,
+    kept as compressed Parquet segments so the spread of prices and the offers of each seller can be analysed without reparsing pages.
+    Segments of past months are compacted into one file per month, so years of offers stay in a few files
+    """
+
+    def __init__(self, data_path: str = 'data'):
+        self.log_path = Path(data_path) / OFFER_LOG_NAME
+        self.segments_path = self.log_path / 'segments'
+        self.lock = Lock()
+
+        # Offers recorded since the last flush, column by column
+        self.pending_columns: dict[str, list] = {field.name: [] for field in OFFER_LOG_SCHEMA}
+
+
+    def record_page_ads(self, store: str, page_number: int, page_ads: list[tuple[str, str, int, int]]) -> None:
+        ''' Record the matching ads of a page, as tuples of product name, title, price and position in the page, including repeated titles '''
+        _seen_at = datetime.now().replace(microsecond=0)
+
+        with self.lock:
+            for product_name, ad_title, ad_price, position in page_ads:
+                self.pending_columns['Product Name'].append(product_name)
+                self.pending_columns['Store'].append(store)
+                self.pending_columns['Title'].append(ad_title)
+                self.pending_columns['Price'].append(ad_price)
+                self.pending_columns['Seen At'].append(_seen_at)
+                self.pending_columns['Page'].append(page_number)
+                self.pending_columns['Position'].append(position)
+
+
+    def flush(self) -> None:
+        ''' Write the offers recorded since the last flush as a new segment '''
+        with self.lock:
+            pending_columns = self.pending_columns
+            self.pending_columns = {field.name: [] for field in OFFER_LOG_SCHEMA}
+
+        if not pending_columns['Price']:
+            return
+
+        offer_table = pa.Table.from_pydict(pending_columns, schema=OFFER_LOG_SCHEMA)
+
+        # Segments are grouped by the month of their first offer and named by the time they are written, so sorting them by name sorts them by time
+        # The process id keeps apart the segments of scraper processes writing at the same time
+        _first_seen_at: datetime = pending_columns['Seen At'][0]
+        segment_path = self.segments_path / _first_seen_at.strftime('%Y-%m') / f"{datetime.now().strftime('%Y-%m-%dT%H%M%S-%f')}-{os.getpid()}.parquet"
+        self.write_table(offer_table, segment_path)
+
+
+    def write_table(self, offer_table: pa.Table, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first, so a crash never leaves a truncated segment behind
+        _temporary_path = path.with_suffix('.tmp')
+        pq.write_table(offer_table, _temporary_path, compression='zstd', use_dictionary=True)
+        _temporary_path.replace(path)
+
+
+    def compact(self) -> None:
+        ''' Merge the segments of each month before the current one into a single file of the month, sorted by product and time '''
+        _current_month = date.today().strftime('%Y-%m')
+
+        for month_path in sorted(self.segments_path.glob('*')):
+            if not month_path.is_dir() or month_path.name >= _current_month:
+                continue
+
+            segment_paths = sorted(month_path.glob('*.parquet'))
+            month_file_path = self.log_path / f"{month_path.name}.parquet"
+
+            # A month compacted before, then reopened by a late segment, is merged again with its new segments
+            _table_paths = ([month_file_path] if month_file_path.exists() else []) + segment_paths
+            offer_table = pa.concat_tables([pq.read_table(path, schema=OFFER_LOG_SCHEMA) for path in _table_paths]).unify_dictionaries()
+
+            # Offers of the same product are kept together, so reading a product decodes fewer pages of the file
+            # Dictionary columns can't be sorted by Arrow, so the sort order is computed on the decoded names
+            _sort_table = pa.table({'Product Name': offer_table['Product Name'].cast(pa.string()), 'Seen At': offer_table['Seen At']})
+            offer_table = offer_table.take(pc.sort_indices(_sort_table, [('Product Name', 'ascending'), ('Seen At', 'ascending')]))
+
+            self.write_table(offer_table, month_file_path)
+
+            for segment_path in segment_paths:
+                segment_path.unlink()
+            month_path.rmdir()
+
+
+    def get_log_paths(self) -> list[str]:
+        return [str(path) for path in sorted(self.log_path.glob('*.parquet'))] + [str(path) for path in sorted(self.segments_path.glob('*/*.parquet'))]
+
+
+    def read_offers(self, product_names: list[str] | None = None, start_date: date | None = None, end_date: date | None = None) -> pd.DataFrame:
+        '''
+        Read the offers of the given products seen between two dates (inclusive), all products or dates if not given.
+        The filters are pushed down to the Parquet files, so only the row groups of the requested products and dates are decoded
+        '''
+        log_paths = self.get_log_paths()
+
+        if not log_paths:
+            return OFFER_LOG_SCHEMA.empty_table().to_pandas()
+
+        offer_filter = None
+
+        if product_names is not None:
+            offer_filter = ds.field('Product Name').isin(product_names)
+
+        if start_date is not None:
+            _start_filter = ds.field('Seen At') >= pd.Timestamp(start_date).to_pydatetime()
+            offer_filter = _start_filter if offer_filter is None else offer_filter & _start_filter
+
+        if end_date is not None:
+            _end_filter = ds.field('Seen At') < (pd.Timestamp(end_date) + pd.Timedelta(days=1)).to_pydatetime()
+            offer_filter = _end_filter if offer_filter is None else offer_filter & _end_filter
+
+        offers_df = ds.dataset(log_paths, schema=OFFER_LOG_SCHEMA, format='parquet').to_table(filter=offer_filter).to_pandas()
+
+        return offers_df.sort_values(by=['Seen At', 'Store', 'Page', 'Position'], kind='stable', ignore_index=True)
+
+
+    def get_daily_offer_spread(self, product_names: list[str] | None = None, start_date: date | None = None, end_date: date | None = None) -> pd.DataFrame:
+        ''' Lowest, median and highest price, number of offers and of distinct titles of each product in each store per day '''
+        offers_df = self.read_offers(product_names, start_date, end_date)
+        offers_df['Date'] = offers_df['Seen At'].dt.normalize()
+
+        offer_spread_df = (offers_df.groupby(['Product Name', 'Store', 'Date'], observed=True)
+                           .agg(**{'Min Price': ('Price', 'min'), 'Median Price': ('Price', 'median'), 'Max Price': ('Price', 'max'),
+                                   'Offers': ('Price', 'size'), 'Distinct Titles': ('Title', 'nunique')})
+                           .reset_index())
+
+        return offer_spread_df
@@ -0,0 +1,278 @@
+from abc import ABC, abstractmethod
+import pandas as pd
+from pathlib import Path
+from termcolor import colored
+import json
+import yaml
+from features.price_alert_sinks import PriceAlertSink, create_price_alert_sink
+from features.price_history_storage import PriceHistoryStorage
+from features.price_summary_index import PriceSummaryIndex
+from monitoring.run_metrics import run_metrics
+
+PRICE_ALERT_STATE_NAME = 'alert_state.json'
+
+
+class PriceAlertRule(ABC):
+    """
+    Base class of the price alert rules: check the prices of today of a product and return the event that fires the alert, if any.
+    Rules without a product apply to every tracked product
+    """
+
+    rule_type = ''
+
+    # Days of past prices the rule compares with, beyond the ones kept in the summary of the product
+    history_days = 0
+
+    def __init__(self, rule_parameters: dict):
+        self.product_name: str | None = rule_parameters.get('product')
+
+
+    def get_rule_key(self) -> str:
+        ''' Identify the rule by its content instead of its position in the config file, so reordering the rules doesn't fire them again '''
+        return f"{self.rule_type}:{self.product_name or '*'}"
+
+
+    @abstractmethod
+    def evaluate(self, price_context: dict) -> tuple[str, str] | None:
+        ''' Event of the alert and its message if the rule holds for the prices of today, the same event is only notified once '''
+
+
+class BelowPriceRule(PriceAlertRule):
+    """
+    Fire when the best price of today is below a target price, once until the price goes back above it
+    """
+
+    rule_type = 'below_price'
+
+    def __init__(self, rule_parameters: dict):
+        super().__init__(rule_parameters)
+        self.target_price: int = rule_parameters['price']
+
+
+    def get_rule_key(self) -> str:
+        return f"{super().get_rule_key()}:{self.target_price}"
+
+
+    def evaluate(self, price_context: dict) -> tuple[str, str] | None:
+        if price_context['Price'] >= self.target_price:
+            return None
+
+        return 'below', f"{price_context['Product Name']} costs R$ {price_context['Price']} at {price_context['Store']}, below R$ {self.target_price}"
+
+
+class PriceDropRule(PriceAlertRule):
+    """
+    Fire when the best price of today dropped at least a percentage from the best price of the previous day or from the lowest best price of the last 7 days,
+    once per day
+    """
+
+    rule_type = 'price_drop'
+
+    # Reference price of each comparison in the price context, and how it is named in the messages
+    references = {'yesterday': ('Previous Price', 'the best price of the previous day'), 'week_min': ('Week Min Price', 'the lowest price of the last 7 days')}
+
+    def __init__(self, rule_parameters: dict):
+        super().__init__(rule_parameters)
+        self.drop_percent: float = rule_parameters['percent']
+        self.reference: str = rule_parameters.get('reference', 'yesterday')
+
+        if self.reference not in self.references:
+            raise ValueError(f"reference must be one of {list(self.references)}")
+
+        # The lowest price of the week is the only reference not kept in the summary
+        if self.reference == 'week_min':
+            self.history_days = 7
+
+
+    def get_rule_key(self) -> str:
+        return f"{super().get_rule_key()}:{self.reference}:{self.drop_percent}"
+
+
+    def evaluate(self, price_context: dict) -> tuple[str, str] | None:
+        _reference_column, _reference_name = self.references[self.reference]
+        reference_price = price_context[_reference_column]
+
+        if reference_price is None:
+            return None
+
+        drop_percent = 100 * (reference_price - price_context['Price']) / reference_price
+        if drop_percent < self.drop_percent:
+            return None
+
+        return (price_context['Date'], f"{price_context['Product Name']} costs R$ {price_context['Price']} at {price_context['Store']}, "
+                                       f"{drop_percent:.0f}% below {_reference_name} (R$ {reference_price})")
+
+
+class HistoricalBestRule(PriceAlertRule):
+    """
+    Fire when the best price of today is lower than every earlier price of the product, once per new historical best price
+    """
+
+    rule_type = 'historical_best'
+
+    def evaluate(self, price_context: dict) -> tuple[str, str] | None:
+        # The first day of a product has no earlier price to beat
+        if (price_context['Historical Price'] is None) or (price_context['Price'] >= price_context['Historical Price']):
+            return None
+
+        return (str(price_context['Price']), f"{price_context['Product Name']} reached its historical best price of R$ {price_context['Price']} at {price_context['Store']}, "
+                                             f"the previous one was R$ {price_context['Historical Price']}")
+
+
+class PriceAlertEngine:
+    """
+    Check the price alert rules of the products updated in a run, right after their price history is updated, and notify the sinks of each new event.
+    Rules are indexed by product, so only the rules of the products with prices in the run are evaluated,
+    and the last event of each rule and product is kept, so an alert isn't notified again while its event lasts
+    """
+
+    rule_classes: dict[str, type[PriceAlertRule]] = {rule_class.rule_type: rule_class for rule_class in [BelowPriceRule, PriceDropRule, HistoricalBestRule]}
+
+    def __init__(self, alert_parameters: dict, data_path: str = 'data'):
+        self.state_path = Path(data_path) / PRICE_ALERT_STATE_NAME
+
+        # Rules of each product, and rules that apply to every product
+        self.product_rules_dict: dict[str, list[PriceAlertRule]] = {}
+        self.all_products_rules: list[PriceAlertRule] = []
+
+        for rule_parameters in alert_parameters.get('rules') or []:
+            rule = self.create_rule(rule_parameters)
+
+            if rule is None:
+                continue
+            elif rule.product_name is None:
+                self.all_products_rules.append(rule)
+            else:
+                self.product_rules_dict.setdefault(rule.product_name, []).append(rule)
+
+        self.sinks: list[PriceAlertSink] = [sink for sink_parameters in alert_parameters.get('sinks') or [{'type': 'stdout'}]
+                                            if (sink := create_price_alert_sink(sink_parameters, data_path)) is not None]
+
+        # Last event notified by each rule for each product
+        self.fired_events: dict[str, str] = self.read_state()
+
+
+    def create_rule(self, rule_parameters: dict) -> PriceAlertRule | None:
+        rule_class = self.rule_classes.get(rule_parameters.get('type'))
+
+        try:
+            if rule_class is None:
+                raise ValueError(f"type must be one of {list(self.rule_classes)}")
+
+            return rule_class(rule_parameters)
+
+        except (KeyError, ValueError) as error:
+            print(colored(f"Warning: Invalid alert rule {rule_parameters} in config/alerts.yaml ({error}). It will be ignored", "yellow"))
+            return None
+
+
+    def read_state(self) -> dict[str, str]:
+        if not self.state_path.exists():
+            return {}
+
+        with open(self.state_path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+
+    def save_state(self) -> None:
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first, so a crash never leaves a truncated state behind
+        _temporary_path = self.state_path.with_suffix('.tmp')
+        _temporary_path.write_text(json.dumps(self.fired_events, indent=2, ensure_ascii=False), encoding='utf-8')
+        _temporary_path.replace(self.state_path)
+
+
+    def get_product_rules(self, product_name: str) -> list[PriceAlertRule]:
+        return self.product_rules_dict.get(product_name, []) + self.all_products_rules
+
+
+    def get_price_context(self, today_df: pd.DataFrame, summary: dict, price_history_storage: PriceHistoryStorage, today: pd.Timestamp, history_days: int) -> dict:
+        '''
+        Best offer of today of a product and the best prices it is compared with. The previous and historical best prices come from the summary of the product,
+        updated with the prices of today, and only the rules comparing with older prices read the days they need from the price history
+        '''
+        today_best_offer = today_df[today_df['Flag Daily Best Price']].iloc[-1]
+        week_min_price = None
+
+        if history_days > 0:
+            recent_df = price_history_storage.read_since(today_best_offer['Product Name'], today - pd.Timedelta(days=history_days))
+            if not recent_df.empty:
+                week_best_df = recent_df[recent_df['Flag Daily Best Price'] & (recent_df['Date'] < today)]
+                week_min_price = int(week_best_df['Price'].min()) if not week_best_df.empty else None
+
+        # The summary of a product seen for the first time has no previous prices
+        return {'Product Name': today_best_offer['Product Name'], 'Date': today.strftime('%Y-%m-%d'), 'Price': int(today_best_offer['Price']),
+                'Store': today_best_offer['Store'], 'Title': today_best_offer['Title'],
+                'Previous Price': int(summary['Previous Price']) if pd.notna(summary['Previous Price']) else None,
+                'Week Min Price': week_min_price,
+                'Historical Price': int(summary['Previous Historical Price']) if pd.notna(summary['Previous Historical Price']) else None}
+
+
+    def evaluate_updated_products(self, today_price_history_list_df: list[pd.DataFrame], price_summary_index: PriceSummaryIndex,
+                                  price_history_storage: PriceHistoryStorage, today: pd.Timestamp) -> list[dict]:
+        ''' Evaluate the rules of each updated product with its prices of today and its summary, notify the new events and return their alerts '''
+        alerts = []
+
+        for today_df in today_price_history_list_df:
+            product_name: str = today_df['Product Name'].iloc[0]
+            product_rules = self.get_product_rules(product_name)
+
+            # Products without rules don't even have their prices compared
+            if not product_rules:
+                continue
+
+            summary = price_summary_index.get_product_summary(product_name)
+            if summary is None:
+                continue
+
+            price_context = self.get_price_context(today_df, summary, price_history_storage, today, max(rule.history_days for rule in product_rules))
+
+            for rule in product_rules:
+                _event_key = f"{rule.get_rule_key()}|{product_name}"
+                rule_event = rule.evaluate(price_context)
+
+                # The event is over, so the next time the rule holds is a new event
+                if rule_event is None:
+                    self.fired_events.pop(_event_key, None)
+                    continue
+
+                event_id, message = rule_event
+                if self.fired_events.get(_event_key) == event_id:
+                    continue
+
+                self.fired_events[_event_key] = event_id
+                alerts.append({'Rule': rule.get_rule_key(), 'Product Name': product_name, 'Date': price_context['Date'], 'Price': price_context['Price'],
+                               'Store': price_context['Store'], 'Title': price_context['Title'], 'Message': message})
+
+        for alert in alerts:
+            self.notify(alert)
+
+        self.save_state()
+
+        return alerts
+
+
+    def notify(self, alert: dict) -> None:
+        run_metrics.increment('alerts_total', rule=alert['Rule'].split(':')[0])
+
+        for sink in self.sinks:
+            sink.send(alert)
+
+
+def read_alerts_config() -> dict:
+    ''' Alert rules and sinks set by the user, none if the config file doesn't exist '''
+    if not Path('config/alerts.yaml').exists():
+        return {}
+
+    with open('config/alerts.yaml', 'r') as file:
+        return yaml.safe_load(file) or {}
+
+
+def create_price_alert_engine(data_path: str = 'data') -> PriceAlertEngine | None:
+    alert_parameters = read_alerts_config()
+
+    if not alert_parameters.get('rules'):
+        return None
+
+    return PriceAlertEngine(alert_parameters, data_path)
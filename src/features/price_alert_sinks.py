@@ -0,0 +1,77 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+from termcolor import colored
+import json
+import urllib.request
+import urllib.error
+
+
+class PriceAlertSink(ABC):
+    """
+    Base class of the destinations of the price alerts: deliver each alert fired by the rules
+    """
+
+    @abstractmethod
+    def send(self, alert: dict) -> None:
+        ''' Deliver an alert fired by the rules '''
+
+
+class StdoutPriceAlertSink(PriceAlertSink):
+    """
+    Show the alerts on the console, next to the messages of the run
+    """
+
+    def send(self, alert: dict) -> None:
+        print(colored(f"Alert: {alert['Message']}", 'yellow'))
+
+
+class FilePriceAlertSink(PriceAlertSink):
+    """
+    Append the alerts to a JSON lines file, to be read by another program or kept as the history of alerts
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+
+
+    def send(self, alert: dict) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(alert, ensure_ascii=False) + '\n')
+
+
+class WebhookPriceAlertSink(PriceAlertSink):
+    """
+    Post each alert as JSON to a webhook URL, for instance a local service that forwards it to a chat or to the phone
+    """
+
+    def __init__(self, url: str, timeout: float = 10):
+        self.url = url
+        self.timeout = timeout
+
+
+    def send(self, alert: dict) -> None:
+        request = urllib.request.Request(self.url, data=json.dumps(alert, ensure_ascii=False).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+
+        # A webhook that is down must not stop the run, the alert is still delivered by the other sinks
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+        except (urllib.error.URLError, OSError) as error:
+            print(colored(f"Warning: Alert could not be posted to {self.url} ({error})", "yellow"))
+
+
+def create_price_alert_sink(sink_parameters: dict, data_path: str = 'data') -> PriceAlertSink | None:
+    match sink_parameters.get('type'):
+        case 'stdout':
+            return StdoutPriceAlertSink()
+        case 'file':
+            # Relative paths are kept in the data directory of the run, so a replay never writes to the alerts of the real runs
+            return FilePriceAlertSink(f"{data_path}/{sink_parameters.get('path', 'alerts.jsonl')}")
+        case 'webhook' if sink_parameters.get('url'):
+            return WebhookPriceAlertSink(sink_parameters['url'], sink_parameters.get('timeout', 10))
+
+    print(colored(f"Warning: Invalid alert sink '{sink_parameters.get('type')}' in config/alerts.yaml. It will be ignored", "yellow"))
+    return None
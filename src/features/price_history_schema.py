@@ -0,0 +1,44 @@
+import pandas as pd
+
+'''
+Declared schema of the price history, used by every stage of the pipeline and preserved by the storage backends
+
+Product and store names repeat in every row, so they are kept as categoricals, prices are whole reais, and dates are
+parsed only once, when read from a text format, so no stage has to compare or re-parse date strings
+'''
+
+PRICE_HISTORY_SCHEMA = {
+    'Product Name': 'category',
+    'Store': 'category',
+    'Price': 'int32',
+    'Title': 'object',
+    'Date': 'datetime64[ns]',
+    'Flag Daily Best Price': 'bool',
+    'Flag Historical Best Price': 'bool',
+}
+
+# Format of the dates in the CSV files, kept so the existing files remain readable and editable by hand
+CSV_DATE_FORMAT = '%d-%m-%Y'
+
+
+def apply_price_history_schema(price_history_df: pd.DataFrame, date_format: str = CSV_DATE_FORMAT) -> pd.DataFrame:
+    ''' Cast the known columns of a price history dataframe to the declared schema, leaving any other column as it is '''
+    if price_history_df.empty:
+        return price_history_df
+
+    price_history_df = price_history_df.copy()
+
+    for column, dtype in PRICE_HISTORY_SCHEMA.items():
+        if column not in price_history_df.columns:
+            continue
+
+        # Dates read from text formats are parsed once here, with an explicit format
+        if column == 'Date' and not pd.api.types.is_datetime64_any_dtype(price_history_df[column]):
+            price_history_df[column] = pd.to_datetime(price_history_df[column], format=date_format)
+            continue
+
+        # Concatenating dataframes with different categories falls back to object, so categoricals may have to be rebuilt
+        if price_history_df[column].dtype != dtype:
+            price_history_df[column] = price_history_df[column].astype(dtype)
+
+    return price_history_df
@@ -0,0 +1,417 @@
+from abc import ABC, abstractmethod
+from contextlib import closing
+import pandas as pd
+from pathlib import Path
+from termcolor import colored
+import sqlite3
+import yaml
+from features.price_history_schema import apply_price_history_schema, CSV_DATE_FORMAT
+
+# Name of the partitions of a single day, e.g. 2024-03-15.parquet, the partitions of a month are named e.g. 2024-03.parquet
+DAY_PARTITION_NAME_PATTERN = '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9].parquet'
+
+
+class PriceHistoryStorage(ABC):
+    """
+    Base class of the storage backends of products price history: read the prices of a product, from the whole history or only from a day on,
+    and save the prices of a day
+    """
+
+    def __init__(self, data_path: str = 'data'):
+        self.data_path = data_path
+
+
+    def get_adjusted_product_name(self, product_name: str) -> str:
+        return product_name.replace(' ', '_')
+
+
+    @abstractmethod
+    def read_price_history(self, product_name: str) -> pd.DataFrame:
+        ''' Read the price history of a product, returning an empty dataframe if there is none yet '''
+
+
+    @abstractmethod
+    def read_since(self, product_name: str, start_date: pd.Timestamp) -> pd.DataFrame:
+        ''' Read the prices of a product from a day on (inclusive), only from the partitions or rows of those days if the backend can '''
+
+
+    @abstractmethod
+    def read_day(self, product_name: str, day: pd.Timestamp) -> pd.DataFrame:
+        ''' Read the prices of a product saved on a day, so an update doesn't need the rest of the history '''
+
+
+    @abstractmethod
+    def save_price_history(self, product_name: str, day_df: pd.DataFrame, day: pd.Timestamp) -> None:
+        ''' Save the prices of a product on a day, replacing the prices saved earlier on the same day '''
+
+
+    @staticmethod
+    def select_since(price_history_df: pd.DataFrame, start_date: pd.Timestamp) -> pd.DataFrame:
+        ''' Prices of a history already read from a day on (inclusive), for backends that can't read only those days '''
+        if price_history_df.empty:
+            return price_history_df
+
+        return price_history_df[price_history_df['Date'] >= start_date].reset_index(drop=True)
+
+
+    @staticmethod
+    def select_day(price_history_df: pd.DataFrame, day: pd.Timestamp) -> pd.DataFrame:
+        if price_history_df.empty:
+            return price_history_df
+
+        return price_history_df[price_history_df['Date'] == day].reset_index(drop=True)
+
+
+    def save_all_price_histories(self, day_list_df: list[pd.DataFrame], day: pd.Timestamp) -> None:
+        ''' Save the prices of a day of all products of the run '''
+        for day_df in day_list_df:
+            product_name: str = day_df['Product Name'].iloc[0]
+            self.save_price_history(product_name, day_df, day)
+
+
+    def import_price_history(self, product_name: str, price_history_df: pd.DataFrame) -> None:
+        ''' Save the whole price history of a product read from another backend, day by day unless the backend can write it at once '''
+        for day, day_df in price_history_df.groupby('Date', sort=False):
+            self.save_price_history(product_name, day_df, day)
+
+
+class CsvPriceHistoryStorage(PriceHistoryStorage):
+    """
+    Store the price history of each product in a single CSV file, rewritten at every update, with dates in the format dd-mm-YYYY.
+    A text file can't be read or written by day, so every read and save goes through the whole history
+    """
+
+    def __init__(self, data_path: str = 'data'):
+        super().__init__(data_path)
+
+        # History of each product read before its prices of the day are saved, so the file is read only once per update
+        self.read_histories_dict: dict[str, pd.DataFrame] = {}
+
+
+    def get_price_history_path(self, product_name: str) -> str:
+        return f"{self.data_path}/{self.get_adjusted_product_name(product_name)}.csv"
+
+
+    def read_price_history(self, product_name: str) -> pd.DataFrame:
+        try:
+            # Read csv file for price history of a product
+            price_history_df = pd.read_csv(self.get_price_history_path(product_name), sep=';', index_col=False)
+
+        except FileNotFoundError:
+            # Create empty dataframe if csv file doesn't already exist
+            return pd.DataFrame()
+
+        return apply_price_history_schema(price_history_df)
+
+
+    def read_since(self, product_name: str, start_date: pd.Timestamp) -> pd.DataFrame:
+        # The whole file is read anyway, so it is kept for the next reads and the save of the day
+        price_history_df = self.read_histories_dict.get(product_name)
+        if price_history_df is None:
+            price_history_df = self.read_price_history(product_name)
+            self.read_histories_dict[product_name] = price_history_df
+
+        return self.select_since(price_history_df, start_date)
+
+
+    def read_day(self, product_name: str, day: pd.Timestamp) -> pd.DataFrame:
+        return self.select_day(self.read_since(product_name, day), day)
+
+
+    def save_price_history(self, product_name: str, day_df: pd.DataFrame, day: pd.Timestamp) -> None:
+        price_history_df = self.read_histories_dict.pop(product_name, None)
+        if price_history_df is None:
+            price_history_df = self.read_price_history(product_name)
+
+        # Replace the prices of the day, keeping them as the last rows of the file
+        if not price_history_df.empty:
+            price_history_df = price_history_df[price_history_df['Date'] != day]
+        price_history_df = apply_price_history_schema(pd.concat([price_history_df, day_df], ignore_index=True))
+
+        # The file keeps the historical best flag, so it is set again on the whole history whenever a day is saved
+        price_history_df['Flag Historical Best Price'] = self.flag_historical_best_price(price_history_df)
+        price_history_df.to_csv(self.get_price_history_path(product_name), sep=';', index=False, date_format=CSV_DATE_FORMAT)
+
+
+    @staticmethod
+    def flag_historical_best_price(price_history_df: pd.DataFrame) -> pd.Series:
+        ''' Flag the most recent daily best price with the lowest price, the same row the summary index holds as historical best price '''
+        daily_best_df = price_history_df[price_history_df['Flag Daily Best Price']].sort_values(by='Date', kind='stable')
+        _index_historical_best_price = daily_best_df.index[daily_best_df['Price'] == daily_best_df['Price'].min()][-1]
+
+        return pd.Series(price_history_df.index == _index_historical_best_price, index=price_history_df.index)
+
+
+class ParquetPriceHistoryStorage(PriceHistoryStorage):
+    """
+    Store the price history of each product as a directory of Parquet partitions, so an update only reads and writes the partition of its day.
+    Days before the one being saved are compacted into a partition per month, so a product keeps a file per month instead of a file per day
+    """
+
+    # The historical best flag depends on the whole history and is recomputed at every update,
+    # so it is not stored, otherwise old partitions would have to be rewritten whenever it moves
+    derived_columns = ['Flag Historical Best Price']
+
+    def get_price_history_directory(self, product_name: str) -> Path:
+        return Path(self.data_path) / 'price_history' / self.get_adjusted_product_name(product_name)
+
+
+    def get_partition_path(self, product_name: str, day: pd.Timestamp) -> Path:
+        # Partitions are named by ISO date, so sorting them by name sorts them by date
+        return self.get_price_history_directory(product_name) / f"{day.strftime('%Y-%m-%d')}.parquet"
+
+
+    def get_month_partition_path(self, product_name: str, month: str) -> Path:
+        return self.get_price_history_directory(product_name) / f"{month}.parquet"
+
+
+    def get_day_partition_paths(self, product_name: str) -> list[Path]:
+        return sorted(self.get_price_history_directory(product_name).glob(DAY_PARTITION_NAME_PATTERN))
+
+
+    def read_partitions(self, partition_paths: list[Path]) -> pd.DataFrame:
+        if not partition_paths:
+            return pd.DataFrame()
+
+        # Parquet keeps the declared types, only the categories of the partitions have to be merged
+        # A month partition sorts after the days of the same month that are not compacted yet, so the rows are sorted by date again
+        price_history_df = apply_price_history_schema(pd.read_parquet(partition_paths))
+
+        return price_history_df.sort_values(by='Date', kind='stable', ignore_index=True)
+
+
+    def read_price_history(self, product_name: str) -> pd.DataFrame:
+        return self.read_partitions(sorted(self.get_price_history_directory(product_name).glob('*.parquet')))
+
+
+    def read_since(self, product_name: str, start_date: pd.Timestamp) -> pd.DataFrame:
+        # Only the partitions of the month of the start date and later are read
+        _start_month, _start_day = start_date.strftime('%Y-%m'), start_date.strftime('%Y-%m-%d')
+        partition_paths = [partition_path for partition_path in sorted(self.get_price_history_directory(product_name).glob('*.parquet'))
+                           if partition_path.stem >= (_start_day if len(partition_path.stem) > len(_start_month) else _start_month)]
+
+        price_history_df = self.read_partitions(partition_paths)
+
+        if price_history_df.empty:
+            return price_history_df
+
+        return price_history_df[price_history_df['Date'] >= start_date].reset_index(drop=True)
+
+
+    def read_day(self, product_name: str, day: pd.Timestamp) -> pd.DataFrame:
+        # The prices of the day being updated are kept in their own partition until a later day is saved
+        day_partition_path = self.get_partition_path(product_name, day)
+        if day_partition_path.exists():
+            return self.read_partitions([day_partition_path])
+
+        # Otherwise the day was compacted into the partition of its month
+        return self.select_day(self.read_since(product_name, day), day)
+
+
+    def save_price_history(self, product_name: str, day_df: pd.DataFrame, day: pd.Timestamp) -> None:
+        # Only the partition of the day is written, after the earlier days are compacted into their months
+        self.compact_day_partitions(product_name, day)
+
+        day_df = day_df[day_df['Date'] == day].drop(columns=self.derived_columns, errors='ignore')
+        month_partition_path = self.get_month_partition_path(product_name, day.strftime('%Y-%m'))
+
+        # A day that is already compacted, for instance saved again by a late run, is replaced in the partition of its month
+        if month_partition_path.exists() and (pd.read_parquet(month_partition_path, columns=['Date'])['Date'] >= day).any():
+            self.write_month_partition(product_name, month_partition_path, [day_df], replaced_days=[day])
+        else:
+            self.write_partition(self.get_partition_path(product_name, day), day_df)
+
+
+    def import_price_history(self, product_name: str, price_history_df: pd.DataFrame) -> None:
+        # Months are written at once, instead of compacting the partition of each day
+        price_history_df = price_history_df.drop(columns=self.derived_columns, errors='ignore')
+
+        for month, month_df in price_history_df.groupby(price_history_df['Date'].dt.strftime('%Y-%m'), sort=False):
+            self.write_month_partition(product_name, self.get_month_partition_path(product_name, month), [month_df], replaced_days=list(month_df['Date'].unique()))
+
+
+    def compact_day_partitions(self, product_name: str, day: pd.Timestamp) -> None:
+        ''' Merge the partitions of the days before the given one into the partitions of their months '''
+        _day_name = day.strftime('%Y-%m-%d')
+        closed_day_paths = [partition_path for partition_path in self.get_day_partition_paths(product_name) if partition_path.stem < _day_name]
+        closed_day_paths_dict: dict[str, list[Path]] = {}
+
+        for partition_path in closed_day_paths:
+            closed_day_paths_dict.setdefault(partition_path.stem[:7], []).append(partition_path)
+
+        for month, day_paths in closed_day_paths_dict.items():
+            day_list_df = [pd.read_parquet(day_path) for day_path in day_paths]
+            self.write_month_partition(product_name, self.get_month_partition_path(product_name, month), day_list_df,
+                                       replaced_days=[pd.Timestamp(day_path.stem) for day_path in day_paths])
+
+            # The days are removed only once they are in the partition of their month, and kept only once if a crash happens in between
+            for day_path in day_paths:
+                day_path.unlink()
+
+
+    def write_month_partition(self, product_name: str, month_partition_path: Path, day_list_df: list[pd.DataFrame], replaced_days: list[pd.Timestamp]) -> None:
+        month_df = pd.read_parquet(month_partition_path) if month_partition_path.exists() else pd.DataFrame()
+
+        if not month_df.empty:
+            month_df = month_df[~month_df['Date'].isin(replaced_days)]
+
+        month_df = apply_price_history_schema(pd.concat([month_df, *day_list_df], ignore_index=True)).sort_values(by='Date', kind='stable')
+        self.write_partition(month_partition_path, month_df)
+
+
+    def write_partition(self, partition_path: Path, partition_df: pd.DataFrame) -> None:
+        partition_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first, so a crash never leaves a truncated partition behind
+        _temporary_path = partition_path.with_suffix('.tmp')
+        partition_df.to_parquet(_temporary_path, index=False)
+        _temporary_path.replace(partition_path)
+
+
+class SqlitePriceHistoryStorage(PriceHistoryStorage):
+    """
+    Store the price history of all products in a local SQLite database, where the prices of today are upserted keeping the lowest price
+    of each store, so several scraper processes can write to it at the same time
+    """
+
+    # Keep the lowest price of the day for each store, even if another process has already saved a price today
+    upsert_query = '''
+        INSERT INTO price_history (product_name, store, date, price, title) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (product_name, store, date) DO UPDATE SET price = excluded.price, title = excluded.title
+        WHERE excluded.price < price_history.price
+    '''
+
+    # The daily best flag is derived from the saved prices: the first store with the lowest price of the day
+    # Columns are qualified by the table name in the queries, since SQLite would also match them with the case-insensitive aliases
+    select_query = '''
+        SELECT product_name AS "Product Name", store AS "Store", price AS "Price", title AS "Title", date AS "Date",
+               ROW_NUMBER() OVER (PARTITION BY price_history.product_name, price_history.date ORDER BY price_history.price, price_history.id) = 1 AS "Flag Daily Best Price"
+        FROM price_history
+    '''
+
+    def __init__(self, data_path: str = 'data'):
+        super().__init__(data_path)
+        self.database_path = f"{data_path}/price_history.db"
+        self.create_tables()
+
+
+    def connect(self) -> sqlite3.Connection:
+        ''' New connection to the database, to be closed by the caller, since using it as a context manager only ends its transaction '''
+        connection = sqlite3.connect(self.database_path, timeout=30)
+
+        # Write-ahead logging lets readers and writers of different processes work without blocking each other
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+
+        return connection
+
+
+    def create_tables(self) -> None:
+        with closing(self.connect()) as connection, connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS price_history (
+                    id INTEGER PRIMARY KEY,
+                    product_name TEXT NOT NULL,
+                    store TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    price INTEGER NOT NULL,
+                    title TEXT
+                )
+            ''')
+            connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_product_store_date ON price_history (product_name, store, date)')
+            connection.execute('CREATE INDEX IF NOT EXISTS idx_product_date ON price_history (product_name, date)')
+
+
+    def to_iso_date(self, day: pd.Timestamp) -> str:
+        return day.strftime('%Y-%m-%d')
+
+
+    def read_price_history(self, product_name: str) -> pd.DataFrame:
+        with closing(self.connect()) as connection, connection:
+            price_history_df = pd.read_sql_query(f"{self.select_query} WHERE price_history.product_name = ? ORDER BY price_history.date, price_history.id", connection, params=[product_name])
+
+        # Dates are stored as ISO text, since SQLite has no date type
+        return apply_price_history_schema(price_history_df, date_format='%Y-%m-%d')
+
+
+    def read_since(self, product_name: str, start_date: pd.Timestamp) -> pd.DataFrame:
+        # The index on product and date reads only the rows of those days
+        with closing(self.connect()) as connection, connection:
+            price_history_df = pd.read_sql_query(f"{self.select_query} WHERE price_history.product_name = ? AND price_history.date >= ? ORDER BY price_history.date, price_history.id",
+                                                 connection, params=[product_name, self.to_iso_date(start_date)])
+
+        return apply_price_history_schema(price_history_df, date_format='%Y-%m-%d')
+
+
+    def read_day(self, product_name: str, day: pd.Timestamp) -> pd.DataFrame:
+        with closing(self.connect()) as connection, connection:
+            day_df = pd.read_sql_query(f"{self.select_query} WHERE price_history.product_name = ? AND price_history.date = ? ORDER BY price_history.id",
+                                       connection, params=[product_name, self.to_iso_date(day)])
+
+        return apply_price_history_schema(day_df, date_format='%Y-%m-%d')
+
+
+    def query_price_histories(self, product_names: list[str], start_date: pd.Timestamp, end_date: pd.Timestamp) -> pd.DataFrame:
+        ''' Read only the prices of the given products between two dates (inclusive), for instance to display in the dashboard '''
+        _placeholders = ', '.join('?' * len(product_names))
+        _query = f"{self.select_query} WHERE price_history.product_name IN ({_placeholders}) AND price_history.date BETWEEN ? AND ? ORDER BY price_history.date, price_history.product_name, price_history.id"
+
+        with closing(self.connect()) as connection, connection:
+            price_history_df = pd.read_sql_query(_query, connection, params=[*product_names, self.to_iso_date(start_date), self.to_iso_date(end_date)])
+
+        return apply_price_history_schema(price_history_df, date_format='%Y-%m-%d')
+
+
+    def save_price_history(self, product_name: str, day_df: pd.DataFrame, day: pd.Timestamp) -> None:
+        self.save_all_price_histories([day_df], day)
+
+
+    def save_all_price_histories(self, day_list_df: list[pd.DataFrame], day: pd.Timestamp) -> None:
+        ''' Upsert the prices of the day of all products in a single transaction '''
+        _iso_day = self.to_iso_date(day)
+        rows = [(row['Product Name'], row['Store'], _iso_day, int(row['Price']), row['Title'])
+                for day_df in day_list_df
+                for row in day_df[day_df['Date'] == day].to_dict('records')]
+
+        with closing(self.connect()) as connection, connection:
+            connection.executemany(self.upsert_query, rows)
+
+
+def read_storage_config() -> dict:
+    with open('config/storage.yaml', 'r') as file:
+        return yaml.safe_load(file)
+
+
+def create_price_history_storage(backend: str, data_path: str = 'data') -> PriceHistoryStorage:
+    match backend:
+        case 'csv':
+            return CsvPriceHistoryStorage(data_path)
+        case 'parquet':
+            return ParquetPriceHistoryStorage(data_path)
+        case 'sqlite':
+            return SqlitePriceHistoryStorage(data_path)
+        case _:
+            raise ValueError(f"Invalid price history backend '{backend}' in config/storage.yaml")
+
+
+def migrate_csv_price_histories(price_history_storage: PriceHistoryStorage, data_path: str = 'data') -> None:
+    ''' Copy the price history CSV file of each product into another storage backend, day by day, leaving the CSV files in place '''
+    _not_price_history_files = ['latest_scraped_offers.csv', 'processed_price_histories.csv']
+
+    if isinstance(price_history_storage, CsvPriceHistoryStorage):
+        print(colored("Warning: The price history backend in config/storage.yaml is already 'csv', there is nothing to migrate", "yellow"))
+        return
+
+    for csv_path in sorted(Path(data_path).glob('*.csv')):
+        if csv_path.name in _not_price_history_files:
+            continue
+
+        price_history_df = apply_price_history_schema(pd.read_csv(csv_path, sep=';', index_col=False))
+
+        if price_history_df.empty:
+            continue
+
+        product_name: str = price_history_df['Product Name'].iloc[0]
+        price_history_storage.import_price_history(product_name, price_history_df)
+
+        print(colored(f"Successfully migrated the price history of {product_name} from {csv_path}", 'green'))
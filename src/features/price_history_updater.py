@@ -1,117 +1,152 @@
 import pandas as pd
 import numpy as np
 from datetime import date
+from time import perf_counter
 from termcolor import colored
+from features.price_history_storage import PriceHistoryStorage
+from features.price_history_schema import apply_price_history_schema, CSV_DATE_FORMAT
+from features.price_summary_index import PriceSummaryIndex
+from features.process_price_history import concat_price_history_dfs
+from monitoring.run_metrics import run_metrics
 
 
 class PriceHistoryUpdater:
     """
-    Identify the daily and historical best prices for products, and then update the price history CSV files
+    Identify the daily and historical best prices for products, and then update the price history in the storage backend
     """
 
-    def __init__(self, best_offers: list[dict]):
-        self.today = date.today().strftime("%d-%m-%Y")
+    def __init__(self, best_offers: list[dict], price_history_storage: PriceHistoryStorage, data_path: str = 'data'):
+        self.today = pd.Timestamp(date.today())
+        self.price_history_storage = price_history_storage
+        self.data_path = data_path
+
+        # Running summary of each product, in order to flag the historical best price without scanning the whole history
+        self.price_summary_index = PriceSummaryIndex(data_path)
 
         self.best_offers_df = self.process_best_offers(best_offers)
         
         self.product_df_list = self.create_df_for_each_product()
 
+        # Rows of today and row of the historical best price of each updated product, so the next stages don't need to scan the whole history
+        self.today_price_history_list_df: list[pd.DataFrame] = []
+        self.historical_best_price_list_df: list[pd.DataFrame] = []
+
 
     def process_best_offers(self, best_offers: list[dict]) -> pd.DataFrame:
         # Transform from dict to dataframe
         best_offers_df = pd.DataFrame(best_offers)
 
-        # Add a date column
+        # Add a date column and cast the columns to the declared schema
         best_offers_df['Date'] = self.today
+        best_offers_df = apply_price_history_schema(best_offers_df)
 
         # Add flag best daily price column
         # True for the first occurence of the minimum price today, False for the rest
-        index_daily_best_price = best_offers_df.groupby(['Product Name']).Price.idxmin()
+        index_daily_best_price = best_offers_df.groupby('Product Name', observed=True).Price.idxmin()
         best_offers_df['Flag Daily Best Price'] = np.where(best_offers_df.index.isin(index_daily_best_price), True, False)
 
         # Save the most recently scraped offers in order to facilitate debugging
-        best_offers_df.to_csv("data/latest_scraped_offers.csv", sep=';', index=False)
+        best_offers_df.to_csv(f"{self.data_path}/latest_scraped_offers.csv", sep=';', index=False, date_format=CSV_DATE_FORMAT)
 
         return best_offers_df
 
 
     def create_df_for_each_product(self) -> list[pd.DataFrame]:
         # Separate best offers dataframe in a dataframe for each product in order to organize history update
-        product_df_list = [product_df for _, product_df in self.best_offers_df.groupby(['Product Name'])]
+        product_df_list = [product_df for _, product_df in self.best_offers_df.groupby('Product Name', observed=True)]
 
         return product_df_list
 
 
     def update_all_products_price_history(self) -> list[pd.DataFrame]:
-        updated_price_history_list_df: list[pd.DataFrame] = []
-
+        ''' Update the prices of today of each product, reading only the prices already saved today and the summary of the product '''
         for product_df in self.product_df_list:
-            # Load price history of a specific product by CSV file
-            price_history_path, product_name = self.get_product_price_history_path(product_df)
-            price_history_df: pd.DataFrame = self.read_price_history_csv(price_history_path)
-    
-            updated_price_history_df = self.update_single_product_price_history(product_df, price_history_df, product_name)
-
-            # Save updated price history of a product
-            updated_price_history_df.to_csv(price_history_path, sep=';', index=False)
-                 
-            updated_price_history_list_df.append(updated_price_history_df)
-
-        return updated_price_history_list_df
-    
-
-    def get_product_price_history_path(self, product_df: pd.DataFrame) -> tuple[str, str]:
-        product_name: str = product_df['Product Name'].unique()[0]
-        adjusted_product_name = product_name.replace(' ', '_')
-        price_history_path = f"data/{adjusted_product_name}.csv"
-
-        return price_history_path, adjusted_product_name
-    
-
-    def read_price_history_csv(self, price_history_path: str) -> pd.DataFrame:
-        try:
-            # Read csv file for price history of a product
-            return pd.read_csv(price_history_path, sep=';', index_col=False)
-        
-        except FileNotFoundError:
-            # Create empty dataframe if csv file doesn't already exist
-            return pd.DataFrame()
-        
+            product_name: str = product_df['Product Name'].unique()[0]
+            _start_time = perf_counter()
 
-    def update_single_product_price_history(self, product_df: pd.DataFrame, price_history_df: pd.DataFrame, product_name: str) -> pd.DataFrame:
-        # Check if the CSV file for price history exists
-        if price_history_df.empty:
-            updated_price_history_df = product_df
-            print(colored(f"A new CSV file for the price history of {product_name} has been created", 'green'))
-        
+            # Load the prices of today of a specific product from the storage backend, saved by an earlier run of the day
+            with run_metrics.time_stage('history_read', product=product_name):
+                saved_today_df: pd.DataFrame = self.price_history_storage.read_day(product_name, self.today)
+
+            today_df = self.update_single_product_price_history(product_df, saved_today_df, product_name)
+
+            self.today_price_history_list_df.append(today_df)
+            run_metrics.observe('product_update_duration_seconds', perf_counter() - _start_time, product=product_name)
+
+        # Save the prices of today and the summary of all products
+        with run_metrics.time_stage('history_save'):
+            self.price_history_storage.save_all_price_histories(self.today_price_history_list_df, self.today)
+
+        with run_metrics.time_stage('summary_save'):
+            self.price_summary_index.save()
+
+        return self.today_price_history_list_df
+
+
+    def update_single_product_price_history(self, product_df: pd.DataFrame, saved_today_df: pd.DataFrame, product_name: str) -> pd.DataFrame:
+        ''' Merge the offers of the run with the prices saved today, update the summary of the product and return its prices of today '''
+        if saved_today_df.empty:
+            today_df = product_df
         else:
-            # Split price history df in two parts: current prices and past prices
-            is_today_price = (price_history_df.Date == self.today)
-            current_prices_df = price_history_df[is_today_price]
-            past_prices_df = price_history_df[~is_today_price]
-
-            # Check if prices for today already exist
-            if current_prices_df.empty:
-                # Concatenate today df with history df along index axis 
-                updated_price_history_df = pd.concat(objs=[past_prices_df, product_df], axis=0, ignore_index=True)
-                
+            # Concatenate the prices saved today with the offers of the run
+            concated_daily_prices_df = pd.concat(objs=[saved_today_df, product_df], axis=0, ignore_index=True)
+
+            # Remove duplicate rows based on store and date, retaining the minimum daily price for each store
+            _index_min_store_daily_price = concated_daily_prices_df.groupby(['Store', 'Date'], observed=True).Price.idxmin()
+            today_df = concated_daily_prices_df.loc[_index_min_store_daily_price]
+
+        # Concatenating prices with different stores turns the categoricals into objects
+        today_df = apply_price_history_schema(today_df.reset_index(drop=True))
+
+        # Flag again the daily best price of today, since the rows of an earlier run of the day may have been kept
+        _index_daily_best_price = today_df['Price'].idxmin()
+        today_df['Flag Daily Best Price'] = (today_df.index == _index_daily_best_price)
+
+        # Update the summary of the product with the daily best offer, building it from the whole history only the first time
+        # or when the summary doesn't match the price history, so a stale index never flags a row that isn't in the history
+        summary = self.price_summary_index.get_product_summary(product_name)
+        if (summary is not None) and not self.is_summary_consistent(summary, saved_today_df, product_name):
+            print(colored(f"Warning: The summary of {product_name} doesn't match its price history. It will be rebuilt from the price history", "yellow"))
+            summary = None
+
+        if summary is None:
+            price_history_df = self.price_history_storage.read_price_history(product_name)
+            if not price_history_df.empty:
+                price_history_df = price_history_df[price_history_df['Date'] != self.today]
+
+            if price_history_df.empty:
+                print(colored(f"A new price history of {product_name} has been created", 'green'))
             else:
-                # Concatenate today df with history df along index axis 
-                concated_daily_prices_df = pd.concat(objs=[current_prices_df, product_df], axis=0, ignore_index=True)
+                print(colored(f"Successfully updated price history of {product_name} with prices of {self.today.strftime(CSV_DATE_FORMAT)}", 'green'))
+
+            summary = self.price_summary_index.build_product_summary(concat_price_history_dfs([price_history_df, today_df]))
+        else:
+            daily_best_offer = today_df.loc[_index_daily_best_price, ['Product Name', 'Store', 'Price', 'Title', 'Date']].to_dict()
+            daily_best_offer['Price'] = int(daily_best_offer['Price'])
+            summary = self.price_summary_index.update_product_summary(daily_best_offer)
+            print(colored(f"Successfully updated price history of {product_name} with prices of {self.today.strftime(CSV_DATE_FORMAT)}", 'green'))
 
-                # Remove duplicate rows based on store and date, retaining the minimum daily price for each store
-                _index_min_store_daily_price = concated_daily_prices_df.groupby(['Store', 'Date']).Price.idxmin()
-                min_current_prices_df = concated_daily_prices_df.loc[_index_min_store_daily_price]
-                updated_price_history_df = pd.concat(objs=[past_prices_df, min_current_prices_df], axis=0, ignore_index=True)
+        # Add flag historical best price from the summary
+        today_df['Flag Historical Best Price'] = self.price_summary_index.is_historical_best_price(today_df, summary).to_numpy()
+        self.historical_best_price_list_df.append(self.price_summary_index.get_historical_best_price_df(summary))
 
-            print(colored(f"Successfully updated price history of {product_name} with prices of {self.today}", 'green'))
+        return today_df
+
+
+    def is_summary_consistent(self, summary: dict, saved_today_df: pd.DataFrame, product_name: str) -> bool:
+        '''
+        Check that the day the summary was last updated and its historical best price are in the price history, reading only the day of the historical best price.
+        They aren't if the index is older or newer than the history, for instance after switching the backend or migrating with an index of other data
+        '''
+        if (summary['Last Seen Date'] > self.today) or ((summary['Last Seen Date'] == self.today) and saved_today_df.empty):
+            return False
+
+        if summary['Historical Date'] == self.today:
+            historical_day_df = saved_today_df
+        else:
+            historical_day_df = self.price_history_storage.read_day(product_name, summary['Historical Date'])
 
-        # Add flag historical best price 
-        # If the historical best price occurs more than one time, consider the most recent
-        masked_df = updated_price_history_df[updated_price_history_df['Flag Daily Best Price'] == True]
-        masked_df = masked_df.sort_values(by='Date', ascending=True)
-        historical_price = masked_df.Price.min()
-        index_historical_best_price = masked_df.where(masked_df['Price'] == historical_price).last_valid_index()
-        updated_price_history_df['Flag Historical Best Price'] = np.where(updated_price_history_df.index == index_historical_best_price, True, False)
+        if historical_day_df.empty:
+            return False
 
-        return updated_price_history_df
\ No newline at end of file
+        return bool(((historical_day_df['Store'] == summary['Historical Store']) & (historical_day_df['Price'] == summary['Historical Price'])).any())
@@ -0,0 +1,143 @@
+import pandas as pd
+from pathlib import Path
+from features.price_history_schema import apply_price_history_schema
+
+PRICE_SUMMARY_INDEX_NAME = 'price_summary_index.parquet'
+
+# Smoothing factor of the weekly average, an exponential moving average over a span of 7 days
+WEEKLY_AVERAGE_ALPHA = 2 / (7 + 1)
+
+
+class PriceSummaryIndex:
+    """
+    Running summary of the price history of each product, built from its daily best prices: the best price of the last day the product was seen,
+    the historical best price and rolling statistics. It is updated with the daily best offer of each run, without scanning the price history
+    """
+
+    summary_columns = ['Product Name', 'Last Seen Date', 'Current Price', 'Current Store', 'Current Title',
+                       'Previous Date', 'Previous Price',
+                       'Historical Price', 'Historical Store', 'Historical Title', 'Historical Date', 'Previous Historical Price',
+                       'Days Count', 'Price Sum', 'Average Price', 'Weekly Average Price', 'Previous Weekly Average Price']
+
+    def __init__(self, data_path: str = 'data'):
+        self.index_path = Path(data_path) / PRICE_SUMMARY_INDEX_NAME
+        self.summaries: dict[str, dict] = self.read_summaries()
+
+
+    def read_summaries(self) -> dict[str, dict]:
+        if not self.index_path.exists():
+            return {}
+
+        # Columns added after the index was saved are left empty until the next day of each product
+        summary_df = pd.read_parquet(self.index_path).reindex(columns=self.summary_columns)
+
+        return {summary['Product Name']: summary for summary in summary_df.to_dict('records')}
+
+
+    def get_product_summary(self, product_name: str) -> dict | None:
+        return self.summaries.get(product_name)
+
+
+    def get_summary_df(self) -> pd.DataFrame:
+        return pd.DataFrame(list(self.summaries.values()), columns=self.summary_columns)
+
+
+    def update_product_summary(self, daily_best_offer: dict) -> dict:
+        ''' Update the summary of a product with its daily best offer of today, which may replace an earlier offer of the same day '''
+        product_name = daily_best_offer['Product Name']
+        today = daily_best_offer['Date']
+        summary = self.summaries[product_name]
+
+        if summary['Last Seen Date'] == today:
+            # The pipeline already ran today, so the offer of today replaces the previous one in the statistics
+            summary['Price Sum'] += daily_best_offer['Price'] - summary['Current Price']
+        else:
+            summary['Previous Date'] = summary['Last Seen Date']
+            summary['Previous Price'] = summary['Current Price']
+            summary['Previous Weekly Average Price'] = summary['Weekly Average Price']
+            summary['Previous Historical Price'] = summary['Historical Price']
+            summary['Days Count'] += 1
+            summary['Price Sum'] += daily_best_offer['Price']
+
+        summary['Last Seen Date'] = today
+        summary['Current Price'] = daily_best_offer['Price']
+        summary['Current Store'] = daily_best_offer['Store']
+        summary['Current Title'] = daily_best_offer['Title']
+        summary['Average Price'] = summary['Price Sum'] / summary['Days Count']
+
+        # The average of the first day is its own price
+        if pd.isna(summary['Previous Weekly Average Price']):
+            summary['Weekly Average Price'] = float(daily_best_offer['Price'])
+        else:
+            summary['Weekly Average Price'] = WEEKLY_AVERAGE_ALPHA * daily_best_offer['Price'] + (1 - WEEKLY_AVERAGE_ALPHA) * summary['Previous Weekly Average Price']
+
+        # If the historical best price occurs more than one time, consider the most recent
+        # A price saved today can only be lowered by a later run of the same day, so this also holds when the pipeline runs again
+        if daily_best_offer['Price'] <= summary['Historical Price']:
+            summary['Historical Price'] = daily_best_offer['Price']
+            summary['Historical Store'] = daily_best_offer['Store']
+            summary['Historical Title'] = daily_best_offer['Title']
+            summary['Historical Date'] = today
+
+        return summary
+
+
+    def build_product_summary(self, price_history_df: pd.DataFrame) -> dict:
+        ''' Build the summary of a product from its whole price history, when it isn't in the index yet '''
+        daily_best_df = price_history_df[price_history_df['Flag Daily Best Price']].sort_values(by='Date', kind='stable')
+        weekly_average_prices = daily_best_df['Price'].ewm(alpha=WEEKLY_AVERAGE_ALPHA, adjust=False).mean()
+
+        current_offer = daily_best_df.iloc[-1]
+        previous_offer = daily_best_df.iloc[-2] if len(daily_best_df) > 1 else None
+
+        # If the historical best price occurs more than one time, consider the most recent
+        historical_offer = daily_best_df[daily_best_df['Price'] == daily_best_df['Price'].min()].iloc[-1]
+
+        summary = {'Product Name': current_offer['Product Name'],
+                   'Last Seen Date': current_offer['Date'],
+                   'Current Price': int(current_offer['Price']),
+                   'Current Store': current_offer['Store'],
+                   'Current Title': current_offer['Title'],
+                   'Previous Date': previous_offer['Date'] if previous_offer is not None else pd.NaT,
+                   'Previous Price': int(previous_offer['Price']) if previous_offer is not None else None,
+                   'Historical Price': int(historical_offer['Price']),
+                   'Historical Store': historical_offer['Store'],
+                   'Historical Title': historical_offer['Title'],
+                   'Historical Date': historical_offer['Date'],
+                   'Previous Historical Price': int(daily_best_df['Price'].iloc[:-1].min()) if previous_offer is not None else None,
+                   'Days Count': len(daily_best_df),
+                   'Price Sum': int(daily_best_df['Price'].sum()),
+                   'Average Price': float(daily_best_df['Price'].mean()),
+                   'Weekly Average Price': float(weekly_average_prices.iloc[-1]),
+                   'Previous Weekly Average Price': float(weekly_average_prices.iloc[-2]) if previous_offer is not None else None}
+
+        self.summaries[summary['Product Name']] = summary
+
+        return summary
+
+
+    @staticmethod
+    def is_historical_best_price(price_history_df: pd.DataFrame, summary: dict) -> pd.Series:
+        ''' Flag the daily best price row of the price history that the summary holds as historical best price '''
+        return (price_history_df['Flag Daily Best Price']
+                & (price_history_df['Date'] == summary['Historical Date'])
+                & (price_history_df['Store'] == summary['Historical Store']))
+
+
+    @staticmethod
+    def get_historical_best_price_df(summary: dict) -> pd.DataFrame:
+        ''' Row of the historical best price of a product as saved in its price history, built from the summary without reading the history '''
+        historical_best_price_df = pd.DataFrame([{'Product Name': summary['Product Name'], 'Store': summary['Historical Store'], 'Price': summary['Historical Price'],
+                                                  'Title': summary['Historical Title'], 'Date': summary['Historical Date'],
+                                                  'Flag Daily Best Price': True, 'Flag Historical Best Price': True}])
+
+        return apply_price_history_schema(historical_best_price_df)
+
+
+    def save(self) -> None:
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first, so a crash never leaves a truncated index behind
+        _temporary_path = self.index_path.with_suffix('.tmp')
+        self.get_summary_df().to_parquet(_temporary_path, index=False)
+        _temporary_path.replace(self.index_path)
@@ -1,30 +1,197 @@
 import pandas as pd
+from pathlib import Path
+from time import time_ns
+from features.price_history_schema import apply_price_history_schema
 
 '''
 Helper functions to prepare price history data for visualization in the web application
+
+The processed price history is kept as a materialized view: a directory with one Parquet partition per month, plus a small index
+with the row flagged as historical best price of each product. A run only rewrites the partition of the current month and,
+when the historical best price of a product moves, the partition that held the previous one, so its cost doesn't grow with the history
 '''
 
+PROCESSED_PRICE_HISTORY_PATH = 'data/processed_price_histories'
+
+# Name of the month partitions, e.g. 2024-03.parquet
+PARTITION_NAME_PATTERN = '[0-9][0-9][0-9][0-9]-[0-9][0-9].parquet'
+HISTORICAL_BEST_INDEX_NAME = 'historical_best_index.parquet'
+
+# Written after every update, so the web application knows when it has to load the data again
+VERSION_STAMP_NAME = 'version'
+
+
 def concat_price_history_dfs(list_df: list[pd.DataFrame]) -> pd.DataFrame:
-    concatenated_df = pd.DataFrame()
+    # Concatenate all dataframes at once, instead of copying the accumulated result for each one
+    list_df = [df for df in list_df if not df.empty]
+    if not list_df:
+        return pd.DataFrame()
+
+    # Categoricals of dataframes with different categories are concatenated as objects, so the schema is applied again
+    return apply_price_history_schema(pd.concat(list_df, ignore_index=True))
 
-    for df in list_df:
-        concatenated_df = pd.concat([concatenated_df, df], ignore_index=True)
 
-    return concatenated_df
+def format_store_name(store: str) -> str:
+    ''' Name of the store as shown in the web application, e.g. mercado_livre as Mercado Livre '''
+    return store.title().replace('_', ' ')
 
 
 def process_price_history(price_history_df: pd.DataFrame) -> pd.DataFrame:
-    # Process store names
-    price_history_df['Store'] = price_history_df['Store'].str.title().replace('_', ' ', regex=True)
+    # Nothing to process, for instance when no row of the updated products is flagged as historical best price
+    if price_history_df.empty:
+        return price_history_df
+
+    price_history_df = price_history_df.copy()
 
-    # Convert date values from str to datetime
-    price_history_df['Date'] = pd.to_datetime(price_history_df['Date'], format='%d-%m-%Y')
+    # Process store names, renaming only the categories instead of every row
+    price_history_df['Store'] = price_history_df['Store'].cat.rename_categories(format_store_name)
 
     # Order by date and product
     price_history_df = price_history_df.sort_values(['Date', 'Product Name'])
 
-    # Create dataref column in format month-year
-    price_history_df['Dateref'] = price_history_df['Date'].apply(lambda x: str(x.month) + "/" + str(x.year))
-    price_history_df['Dateref Datetime'] = pd.to_datetime(price_history_df['Dateref'], format="%m/%Y")
+    # Create dateref column with the month of each date
+    price_history_df['Dateref'] = price_history_df['Date'].dt.to_period('M')
+
+    return price_history_df
+
+
+def get_partition_path(processed_path: str, month: str) -> Path:
+    return Path(processed_path) / f"{month}.parquet"
+
+
+def read_partition(processed_path: str, month: str) -> pd.DataFrame:
+    partition_path = get_partition_path(processed_path, month)
+
+    if not partition_path.exists():
+        return pd.DataFrame()
+
+    return pd.read_parquet(partition_path)
+
+
+def write_partition(processed_path: str, month: str, partition_df: pd.DataFrame) -> None:
+    partition_path = get_partition_path(processed_path, month)
+
+    # Write to a temporary file first, so a crash never leaves a truncated partition behind
+    _temporary_path = partition_path.with_suffix('.tmp')
+    partition_df.to_parquet(_temporary_path, index=False)
+    _temporary_path.replace(partition_path)
+
+
+def get_historical_best_index(processed_df: pd.DataFrame) -> pd.DataFrame:
+    ''' Product, date and store of the row flagged as historical best price of each product '''
+    if processed_df.empty:
+        return pd.DataFrame(columns=['Product Name', 'Date', 'Store'])
+
+    return processed_df.loc[processed_df['Flag Historical Best Price'], ['Product Name', 'Date', 'Store']].reset_index(drop=True)
+
+
+def read_historical_best_index(processed_path: str) -> pd.DataFrame:
+    index_path = Path(processed_path) / HISTORICAL_BEST_INDEX_NAME
+
+    if not index_path.exists():
+        return pd.DataFrame(columns=['Product Name', 'Date', 'Store'])
+
+    return pd.read_parquet(index_path)
+
+
+def write_version_stamp(processed_path: str) -> None:
+    version_stamp_path = Path(processed_path) / VERSION_STAMP_NAME
+
+    _temporary_path = version_stamp_path.with_suffix('.tmp')
+    _temporary_path.write_text(str(time_ns()))
+    _temporary_path.replace(version_stamp_path)
+
+
+def read_version_stamp(processed_path: str = PROCESSED_PRICE_HISTORY_PATH) -> str | None:
+    try:
+        return (Path(processed_path) / VERSION_STAMP_NAME).read_text()
+    except FileNotFoundError:
+        return None
+
+
+def processed_price_history_exists(processed_path: str = PROCESSED_PRICE_HISTORY_PATH) -> bool:
+    return (Path(processed_path) / HISTORICAL_BEST_INDEX_NAME).exists()
+
+
+def rebuild_processed_price_history(price_history_list_df: list[pd.DataFrame], processed_path: str = PROCESSED_PRICE_HISTORY_PATH) -> None:
+    ''' Rebuild the whole processed price history from the complete price history of every product '''
+    processed_df = process_price_history(concat_price_history_dfs(price_history_list_df))
+
+    Path(processed_path).mkdir(parents=True, exist_ok=True)
+
+    # Remove the old partitions, a month may no longer have data
+    for partition_path in Path(processed_path).glob(PARTITION_NAME_PATTERN):
+        partition_path.unlink()
+
+    for month, partition_df in processed_df.groupby('Dateref'):
+        write_partition(processed_path, str(month), partition_df)
+
+    get_historical_best_index(processed_df).to_parquet(Path(processed_path) / HISTORICAL_BEST_INDEX_NAME, index=False)
+    write_version_stamp(processed_path)
+
+
+def update_processed_price_history(today_price_history_list_df: list[pd.DataFrame], historical_best_price_list_df: list[pd.DataFrame], processed_path: str = PROCESSED_PRICE_HISTORY_PATH) -> None:
+    '''
+    Update the processed price history only with the prices of today and the historical best price flags that moved,
+    given the rows of today and the row of historical best price of each updated product
+    '''
+    today_df = concat_price_history_dfs(today_price_history_list_df)
+
+    if today_df.empty:
+        return
+
+    processed_today_df = process_price_history(today_df)
+    updated_products = processed_today_df['Product Name'].unique()
+    current_month = str(processed_today_df['Dateref'].iloc[0])
+
+    # Replace the rows of today in the partition of the current month, in case the pipeline already ran today
+    current_partition_df = read_partition(processed_path, current_month)
+    if not current_partition_df.empty:
+        _is_replaced_row = current_partition_df['Product Name'].isin(updated_products) & (current_partition_df['Date'] == processed_today_df['Date'].iloc[0])
+        current_partition_df = current_partition_df[~_is_replaced_row]
+
+    partitions_dict = {current_month: concat_price_history_dfs([current_partition_df, processed_today_df])}
+
+    new_best_index_df = get_historical_best_index(process_price_history(concat_price_history_dfs(historical_best_price_list_df)))
+    old_best_index_df = read_historical_best_index(processed_path)
+
+    for product in updated_products:
+        old_best_df = old_best_index_df[old_best_index_df['Product Name'] == product]
+        new_best_df = new_best_index_df[new_best_index_df['Product Name'] == product]
+
+        # Nothing to patch if the historical best price is still the same row, compared by value since the categories of both indexes differ
+        if old_best_df.reset_index(drop=True).astype(object).equals(new_best_df.reset_index(drop=True).astype(object)):
+            continue
+
+        # Clear the old flag and set the new one, loading only the partitions that hold them
+        for best_df, flag_value in [(old_best_df, False), (new_best_df, True)]:
+            for _, best_row in best_df.iterrows():
+                month = best_row['Date'].strftime('%Y-%m')
+                if month not in partitions_dict:
+                    partitions_dict[month] = read_partition(processed_path, month)
+
+                partition_df = partitions_dict[month]
+                if partition_df.empty:
+                    continue
+
+                _is_best_row = (partition_df['Product Name'] == product) & (partition_df['Date'] == best_row['Date']) & (partition_df['Store'] == best_row['Store'])
+                partition_df.loc[_is_best_row, 'Flag Historical Best Price'] = flag_value
+
+    Path(processed_path).mkdir(parents=True, exist_ok=True)
+
+    for month, partition_df in partitions_dict.items():
+        write_partition(processed_path, month, partition_df.sort_values(['Date', 'Product Name']))
+
+    # Keep the index of the products that were not updated in this run
+    best_index_df = concat_price_history_dfs([old_best_index_df[~old_best_index_df['Product Name'].isin(updated_products)], new_best_index_df])
+    best_index_df.to_parquet(Path(processed_path) / HISTORICAL_BEST_INDEX_NAME, index=False)
+    write_version_stamp(processed_path)
+
+
+def read_processed_price_history(processed_path: str = PROCESSED_PRICE_HISTORY_PATH) -> pd.DataFrame:
+    partition_paths = sorted(Path(processed_path).glob(PARTITION_NAME_PATTERN))
+
+    if not partition_paths:
+        return pd.DataFrame()
 
-    return price_history_df
\ No newline at end of file
+    return apply_price_history_schema(pd.read_parquet(partition_paths))
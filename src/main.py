@@ -1,30 +1,446 @@
-from data.web_driver_configer import WebDriverConfiger
-from data.store_best_offer_finder import StoreBestOfferFinder
-from features.price_history_updater import PriceHistoryUpdater
-import features.process_price_history as process
+from time import perf_counter
+_start_time = perf_counter()
+
+from datetime import date
+from pathlib import Path
+from termcolor import colored
+import argparse
+import time
+from monitoring.run_metrics import run_metrics
+
+# Longest wait of the daemon between two checks of the queue
+DAEMON_MAX_SLEEP_SECONDS = 300
+
+# The pipeline modules are imported by the stages that use them, so runs that only reprocess data never load Selenium or aiohttp
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Scrape the best offers of the tracked products and update their price history")
+    parser.add_argument('--replay', action='store_true',
+                        help="Run the whole pipeline from the latest saved page snapshots, without fetching any page. Results are saved in data/replay")
+    parser.add_argument('--rebuild-processed', action='store_true',
+                        help="Rebuild the processed price history used by the dashboard from scratch, instead of updating it only with the prices of today")
+    parser.add_argument('--migrate-history', action='store_true',
+                        help="Copy the price history CSV files into the backend set in config/storage.yaml and exit")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Keep running with the browsers open, scraping each product in each store on the intervals set in config/scheduler.yaml")
+    parser.add_argument('--reprocess', action='store_true',
+                        help="Rebuild the processed price history and the summary index from the stored price history and exit, without scraping")
+    parser.add_argument('--fresh', action='store_true',
+                        help="Scrape every product again, ignoring the pairs of product and store already done today by an interrupted run")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Split the scrape among this number of worker processes, which take the products from a shared work queue in data/scrape_queue.db")
+    parser.add_argument('--worker', action='store_true',
+                        help="Run a single worker of the shared work queue, to start more workers by hand, also in other hosts sharing the data directory on a filesystem with file locks")
+
+    return parser.parse_args()
+
 
 def main():
-    # Instance responsable to provide the web driver and the tracked products list set by the user
-    web_driver_configer = WebDriverConfiger()
-    driver = web_driver_configer.driver
+    args = parse_arguments()
+
+    if args.migrate_history:
+        from features.price_history_storage import read_storage_config, create_price_history_storage, migrate_csv_price_histories
+        migrate_csv_price_histories(create_price_history_storage(read_storage_config()['backend']))
+        return
+
+    if args.reprocess:
+        reprocess_price_history('data')
+        return
+
+    if args.daemon and args.replay:
+        print(colored("Error: The daemon mode scrapes the stores continuously and can't be used with --replay", "red"))
+        return
+
+    if (args.workers or args.worker) and (args.daemon or args.replay):
+        print(colored("Error: The workers share the scrape of the day through the work queue and can't be used with --daemon or --replay", "red"))
+        return
+
+    if args.workers:
+        run_workers(args.workers, args.fresh)
+        return
+
+    # A replay never touches the real price history
+    data_path = 'data/replay' if args.replay else 'data'
+    Path(data_path).mkdir(parents=True, exist_ok=True)
+
+    from data.web_driver_configer import WebDriverConfiger
+    from data.store_best_offer_finder import StoreBestOfferFinder
+    from data.page_snapshot_cache import PageSnapshotCache
+
+    # Instance responsable to provide the web driver pool and the tracked products list set by the user
+    with run_metrics.time_stage('configuration'):
+        web_driver_configer = WebDriverConfiger()
+    driver_pool = web_driver_configer.driver_pool
+    http_page_fetcher = web_driver_configer.http_page_fetcher
+    fetch_strategies: dict[str, str] = web_driver_configer.fetch_strategies
     tracked_products_list: list[dict] = web_driver_configer.tracked_products_list
 
+    # Instance responsable to reuse recently fetched pages, or all saved pages in replay mode
+    page_snapshot_cache = PageSnapshotCache(web_driver_configer.snapshot_ttl_minutes, replay=args.replay, save_snapshots=web_driver_configer.save_snapshots,
+                                            retention_days=web_driver_configer.snapshot_retention_days, keep_per_url=web_driver_configer.snapshot_keep_per_url)
+
+    # Instance responsable to keep every matching ad seen by the scrapes, if enabled
+    offer_log = create_offer_log(data_path)
+
     # Instance responsable to provide the best offer from each store for tracked products list
-    store_best_offer_finder = StoreBestOfferFinder(driver, tracked_products_list)
-    best_offers: list[dict] = store_best_offer_finder.get_store_best_offers_for_all_products()
+    store_best_offer_finder = StoreBestOfferFinder(driver_pool, http_page_fetcher, fetch_strategies, page_snapshot_cache, tracked_products_list,
+                                                   web_driver_configer.max_pages, web_driver_configer.page_parser_pool, offer_log)
+
+    # Time until the first page can be fetched, the browsers themselves are only started by the first page that needs them
+    report_startup_time()
+
+    if args.daemon:
+        run_daemon(store_best_offer_finder, data_path)
+        return
+
+    if args.worker:
+        try:
+            run_worker(store_best_offer_finder, data_path)
+
+        finally:
+            driver_pool.quit_all()
+            store_best_offer_finder.page_parser_pool.shutdown()
+        return
+
+    # The run report is saved even if a stage fails, so failed runs also show up in the metrics
+    try:
+        # A replay always starts over, since its snapshots may differ from the ones of the interrupted run
+        run_streaming_scrape(store_best_offer_finder, data_path, args.fresh or args.replay, args.rebuild_processed)
+
+    finally:
+        # Close the web drivers and the parser processes after completing the web scraping
+        driver_pool.quit_all()
+        store_best_offer_finder.page_parser_pool.shutdown()
+        save_run_metrics(data_path)
+
+
+def create_offer_log(data_path: str):
+    from features.price_history_storage import read_storage_config
+
+    if not read_storage_config().get('offer_log', False):
+        return None
+
+    from features.offer_log import OfferLog
+    return OfferLog(data_path)
 
-    # Update the price history csv file of tracked products with newly scraped data and create a dataframe for each product
+
+def report_startup_time() -> None:
+    _startup_seconds = perf_counter() - _start_time
+    run_metrics.observe('stage_duration_seconds', _startup_seconds, stage='startup')
+    print(f"Started in {_startup_seconds:.2f} s")
+
+
+def save_run_metrics(data_path: str) -> None:
+    ''' Save the timings and counters of the run as a JSON report and a Prometheus text file, appending the report to the history of runs '''
+    run_metrics.save(f'{data_path}/run_report.json', f'{data_path}/metrics.prom', f'{data_path}/run_reports.jsonl')
+    print(colored(f"Successfully saved the run report in {data_path}/run_report.json and {data_path}/metrics.prom", 'green'))
+
+
+def run_streaming_scrape(store_best_offer_finder, data_path: str, fresh: bool = False, rebuild_processed: bool = False) -> None:
+    '''
+    Scrape the tracked products in batches, saving the best offers of each batch in the price history before scraping the next one,
+    so only a batch of offers is held in memory and a crash loses at most the batch being scraped, whose offers are kept by the checkpoint
+    '''
+    from data.scrape_checkpoint import ScrapeCheckpoint
+    from features.price_history_storage import read_storage_config
+    import features.process_price_history as process
+
+    batch_products: int = read_storage_config().get('batch_products', 25)
+    checkpoint = ScrapeCheckpoint(data_path, fresh)
+
+    # The processed price history is rebuilt once at the end, since a rebuild from a single batch would only hold its products
+    processed_path = f'{data_path}/processed_price_histories'
+    rebuild_processed = rebuild_processed or not process.processed_price_history_exists(processed_path)
+
+    # Offers found by an interrupted run but not saved yet are saved first
+    unsaved_best_offers = checkpoint.get_unsaved_best_offers()
+    if unsaved_best_offers:
+        update_price_history(unsaved_best_offers, data_path, update_processed=not rebuild_processed)
+        checkpoint.record_saved_offers(unsaved_best_offers)
+
+    pending_scraping_jobs = checkpoint.get_pending_scraping_jobs(store_best_offer_finder.get_scraping_jobs())
+
+    for scraping_jobs in store_best_offer_finder.split_scraping_jobs_in_batches(pending_scraping_jobs, batch_products):
+        # Each best offer is written to the checkpoint as soon as it is found
+        with run_metrics.time_stage('scraping'):
+            best_offers = store_best_offer_finder.get_store_best_offers(scraping_jobs, on_best_offer=checkpoint.record_best_offer)
+
+        if best_offers:
+            update_price_history(best_offers, data_path, update_processed=not rebuild_processed)
+            checkpoint.record_saved_offers(best_offers)
+
+    # Every pair was scraped and saved, so the next run of the day starts over instead of resuming
+    checkpoint.mark_complete()
+
+    if rebuild_processed:
+        with run_metrics.time_stage('processed_rebuild'):
+            reprocess_price_history(data_path)
+
+    # The segments of the offer log of past months are merged into one file per month
+    if store_best_offer_finder.offer_log is not None:
+        store_best_offer_finder.offer_log.compact()
+
+    # Snapshots beyond the retention and the pages they referred to are removed
+    store_best_offer_finder.page_snapshot_cache.collect_garbage()
+
+
+def update_price_history(best_offers: list[dict], data_path: str, update_processed: bool = True) -> None:
+    from features.price_history_updater import PriceHistoryUpdater
+    from features.price_history_storage import read_storage_config, create_price_history_storage
+    from features.price_alert_engine import create_price_alert_engine
+    import features.process_price_history as process
+
+    # Update the price history of tracked products with newly scraped data and create a dataframe for each product
     # If there is already a store price today, save the lowest price
-    price_history_updater = PriceHistoryUpdater(best_offers)
-    updated_price_history_list_df = price_history_updater.update_all_products_price_history()
+    with run_metrics.time_stage('history_update'):
+        price_history_storage = create_price_history_storage(read_storage_config()['backend'], data_path)
+        price_history_updater = PriceHistoryUpdater(best_offers, price_history_storage, data_path)
+        today_price_history_list_df = price_history_updater.update_all_products_price_history()
+
+    # Check the price alerts of the products updated right now, before the dashboard data is updated
+    with run_metrics.time_stage('alerts'):
+        price_alert_engine = create_price_alert_engine(data_path)
+        if price_alert_engine is not None:
+            price_alert_engine.evaluate_updated_products(today_price_history_list_df, price_history_updater.price_summary_index, price_history_storage, price_history_updater.today)
+
+    # Update the processed price history for visualization in dashboard only with the prices of today
+    # It is rebuilt from the stored price history if it doesn't exist yet, unless the caller rebuilds it later
+    processed_path = f'{data_path}/processed_price_histories'
+    if not update_processed:
+        return
+
+    if not process.processed_price_history_exists(processed_path):
+        with run_metrics.time_stage('processed_rebuild'):
+            reprocess_price_history(data_path)
+    else:
+        with run_metrics.time_stage('processed_update'):
+            process.update_processed_price_history(today_price_history_list_df, price_history_updater.historical_best_price_list_df, processed_path)
+
+
+def reprocess_price_history(data_path: str) -> None:
+    ''' Rebuild the processed price history and the summary index of the tracked products from their stored price history '''
+    from features.price_history_storage import read_storage_config, create_price_history_storage
+    from features.price_summary_index import PriceSummaryIndex
+    from data.tracked_products_loader import TrackedProductsLoader, read_tracked_products_files
+    import features.process_price_history as process
+
+    tracked_products_list, _ = TrackedProductsLoader(read_tracked_products_files()).load(verbose=False)
+    product_names: list[str] = [product['name'] for product in tracked_products_list if product.get('name')]
+
+    price_history_storage = create_price_history_storage(read_storage_config()['backend'], data_path)
+    price_history_list_df = [price_history_storage.read_price_history(product_name) for product_name in product_names]
+    price_history_list_df = [price_history_df for price_history_df in price_history_list_df if not price_history_df.empty]
+
+    if not price_history_list_df:
+        print(colored("Warning: No stored price history to reprocess", "yellow"))
+        return
+
+    # Summaries are built again from the whole history, and flag the historical best price of each product
+    price_summary_index = PriceSummaryIndex(data_path)
+    for price_history_df in price_history_list_df:
+        summary = price_summary_index.build_product_summary(price_history_df)
+        price_history_df['Flag Historical Best Price'] = price_summary_index.is_historical_best_price(price_history_df, summary).to_numpy()
+    price_summary_index.save()
+
+    process.rebuild_processed_price_history(price_history_list_df, f'{data_path}/processed_price_histories')
+
+    print(colored(f"Successfully reprocessed the price history of {len(price_history_list_df)} products in {perf_counter() - _start_time:.2f} s", 'green'))
+
+
+def run_workers(workers: int, fresh: bool = False) -> None:
+    ''' Start worker processes that share the scrape of the day through the work queue, and wait for all of them to finish '''
+    from data.scrape_work_queue import ScrapeWorkQueue
+    import subprocess
+    import socket
+    import json
+    import sys
+
+    work_queue = ScrapeWorkQueue('data')
+    run_date = date.today().isoformat()
+
+    # The queue keeps the jobs done today, so a new run only takes the missing ones unless it starts over
+    if fresh:
+        work_queue.reset_jobs(run_date)
+
+    worker_processes = [subprocess.Popen([sys.executable, __file__, '--worker']) for _ in range(workers)]
+    failed_workers = sum(worker_process.wait() != 0 for worker_process in worker_processes)
+
+    # The report of the run sums the reports of its workers, each one removed once it is merged
+    for worker_process in worker_processes:
+        worker_report_path = Path(get_worker_report_path('data', f"{socket.gethostname()}-{worker_process.pid}"))
+        if worker_report_path.exists():
+            run_metrics.merge_report(json.loads(worker_report_path.read_text(encoding='utf-8')))
+            worker_report_path.unlink()
+
+    run_metrics.save('data/run_report.json', 'data/metrics.prom')
+    print(colored("Successfully saved the run report of the workers in data/run_report.json and data/metrics.prom", 'green'))
+
+    job_counts = work_queue.get_job_counts(run_date)
+    if failed_workers:
+        print(colored(f"Warning: {failed_workers} of {workers} workers failed. Jobs of today: {job_counts}", "yellow"))
+    else:
+        print(colored(f"Successfully finished the scrape with {workers} workers. Jobs of today: {job_counts}", 'green'))
+
+
+def get_worker_report_path(data_path: str, worker_id: str) -> str:
+    return f'{data_path}/run_report.worker-{worker_id}.json'
+
+
+def run_worker(store_best_offer_finder, data_path: str) -> None:
+    '''
+    Scrape the products leased from the work queue shared with the other workers, saving the best offers of each lease in the price history
+    while holding the merge lock, until no job of today is left
+    '''
+    from data.scrape_work_queue import ScrapeWorkQueue
+    from data.scrape_scheduler import read_scheduler_config
+    from features.price_history_storage import read_storage_config
+    import features.process_price_history as process
+    import socket
+    import os
+
+    scheduler_parameters = read_scheduler_config()
+    work_queue = ScrapeWorkQueue(data_path, scheduler_parameters.get('worker_lease_minutes', 15), scheduler_parameters.get('worker_max_attempts', 2))
+    batch_products: int = read_storage_config().get('batch_products', 25)
+    processed_path = f'{data_path}/processed_price_histories'
+
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    run_date = date.today().isoformat()
+
+    # Every worker adds the jobs of today, only the first one actually creates them
+    scraping_jobs_dict = {(product_info['name'], site_info['name']): (product_info, site_info) for product_info, site_info in store_best_offer_finder.get_scraping_jobs()}
+    work_queue.enqueue_jobs(list(scraping_jobs_dict.values()), run_date)
+
+    try:
+        while True:
+            leased_jobs = work_queue.lease_jobs(worker_id, run_date, batch_products)
+
+            if not leased_jobs:
+                # Jobs leased by other workers may belong to a crashed one, so the worker waits for them to be done or to expire before stopping
+                _seconds_until_lease_expiry = work_queue.get_seconds_until_lease_expiry(run_date)
+                if _seconds_until_lease_expiry is None:
+                    break
+
+                time.sleep(min(_seconds_until_lease_expiry + 1, 5))
+                continue
+
+            with run_metrics.time_stage('scraping'):
+                best_offers = store_best_offer_finder.get_store_best_offers([scraping_jobs_dict[job] for job in leased_jobs if job in scraping_jobs_dict])
+
+            # One worker at a time updates the price history, and the processed price history only if it exists, otherwise it is rebuilt at the end
+            with work_queue.merge_lock():
+                if best_offers:
+                    update_price_history(best_offers, data_path, update_processed=process.processed_price_history_exists(processed_path))
+
+            work_queue.complete_jobs(worker_id, run_date, leased_jobs, {(best_offer['Product Name'], best_offer['Store']) for best_offer in best_offers})
+
+        with work_queue.merge_lock():
+            if not process.processed_price_history_exists(processed_path):
+                with run_metrics.time_stage('processed_rebuild'):
+                    reprocess_price_history(data_path)
+
+            store_best_offer_finder.page_snapshot_cache.collect_garbage()
+
+        print(colored(f"Worker {worker_id} finished, no job of today is left", 'green'))
+
+    finally:
+        # Each worker saves a report of its own, summed into the report of the run by run_workers, and only the history of reports is shared
+        with work_queue.merge_lock():
+            run_metrics.save(get_worker_report_path(data_path, worker_id), None, f'{data_path}/run_reports.jsonl')
+
+
+def save_best_offers_as_found(best_offer_queue, data_path: str) -> None:
+    '''
+    Update the price history with the best offers put in the queue as soon as they arrive, together with the ones that arrived while the previous ones
+    were saved, until None is put in the queue
+    '''
+    from queue import Empty
+
+    is_stopping = False
+
+    while not is_stopping:
+        queued_offers = [best_offer_queue.get()]
+        while True:
+            try:
+                queued_offers.append(best_offer_queue.get_nowait())
+            except Empty:
+                break
+
+        best_offers = [best_offer for best_offer in queued_offers if best_offer is not None]
+        is_stopping = len(best_offers) < len(queued_offers)
+
+        # A failed update loses only these offers, the next ones are still saved
+        try:
+            if best_offers:
+                update_price_history(best_offers, data_path)
+        except Exception as error:
+            run_metrics.increment('failures_total', stage='history_update')
+            print(colored(f"Error: The price history could not be updated with {len(best_offers)} best offers ({type(error).__name__}: {error})", "red"))
+        finally:
+            for _ in queued_offers:
+                best_offer_queue.task_done()
+
+
+def run_daemon(store_best_offer_finder, data_path: str) -> None:
+    ''' Scrape the pairs of product and store as they become due, updating the price history as each listing is crawled, until interrupted '''
+    from data.scrape_scheduler import ScrapeScheduler, read_scheduler_config
+    from queue import Queue
+    from threading import Thread
+
+    scheduler = ScrapeScheduler(store_best_offer_finder.get_scraping_jobs(), read_scheduler_config())
+    min_rescrape_minutes = scheduler.get_min_rescrape_minutes()
+
+    # The best offers are saved by another thread as soon as each listing is crawled, so a slow store doesn't delay the prices and alerts of the others
+    best_offer_queue: Queue = Queue()
+    saver_thread = Thread(target=save_best_offers_as_found, args=(best_offer_queue, data_path), daemon=True)
+    saver_thread.start()
+
+    try:
+        # Without jobs the queue would stay empty forever, so there is nothing to wait for
+        if min_rescrape_minutes is None:
+            print(colored("Error: No pair of product and store to scrape in daemon mode", "red"))
+            return
+
+        # A snapshot saved by a scrape must expire before the next scrape of the same page, otherwise that scrape would only read the same prices again
+        if store_best_offer_finder.page_snapshot_cache.limit_ttl(min_rescrape_minutes / 2):
+            print(colored(f"Warning: Snapshot TTL lowered to {min_rescrape_minutes / 2:g} minutes, half of the shortest time between two scrapes of a product in a store", "yellow"))
+
+        while True:
+            due_jobs = scheduler.pop_due_jobs()
+
+            if due_jobs:
+                # The web drivers stay open between scrapes, so only the first scrape pays for starting the browsers
+                with run_metrics.time_stage('scraping'):
+                    store_best_offer_finder.get_store_best_offers(due_jobs, on_best_offer=best_offer_queue.put)
+
+                # The report of the scrape includes the saves of all its offers
+                best_offer_queue.join()
+
+                if store_best_offer_finder.offer_log is not None:
+                    store_best_offer_finder.offer_log.compact()
+
+                store_best_offer_finder.page_snapshot_cache.collect_garbage()
+
+                scheduler.reschedule_jobs(due_jobs)
+                scheduler.save_next_run_queue(f'{data_path}/next_run_queue.json')
+
+                # Each scrape is reported as a run of its own, while the Prometheus counters keep growing for the whole life of the daemon
+                save_run_metrics(data_path)
+                run_metrics.reset_report()
+
+            # The wait is capped, so a far away or missing next run never becomes an endless or invalid sleep
+            time.sleep(min(scheduler.get_seconds_until_next_run(), DAEMON_MAX_SLEEP_SECONDS))
+
+    except KeyboardInterrupt:
+        print(colored("Daemon mode stopped", 'green'))
 
-    # Concat and process all price history dfs for visualization in dashboard
-    concatenated_df = process.concat_price_history_dfs(updated_price_history_list_df)
-    processed_price_history_df = process.process_price_history(concatenated_df)
+    finally:
+        # The offers already found are saved before stopping
+        best_offer_queue.put(None)
+        saver_thread.join()
 
-    # Save final price history dataframe
-    processed_price_history_df.to_csv('data/processed_price_histories.csv', sep=';', index=False)
+        store_best_offer_finder.driver_pool.quit_all()
+        store_best_offer_finder.page_parser_pool.shutdown()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,203 @@
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+from typing import Iterator
+import bisect
+import json
+
+# Name prefix of the metrics in the Prometheus text format
+METRIC_PREFIX = 'price_monitoring_'
+
+# Type and description of each metric recorded by the pipeline
+METRIC_DEFINITIONS = {
+    'stage_duration_seconds': ('histogram', "Duration of each stage of the pipeline, by store or product when the stage handles one"),
+    'page_duration_seconds': ('histogram', "Time from requesting the page of a store to having its offers matched with the tracked products"),
+    'product_update_duration_seconds': ('histogram', "Time to update the price history of a product"),
+    'pages_total': ('counter', "Store pages processed, by where the page came from: snapshot, http or browser"),
+    'pages_skipped_total': ('counter', "Result pages of listings sorted by price left uncrawled, since they could only have higher prices"),
+    'ads_seen_total': ('counter', "Product ads found in the store pages"),
+    'ads_matched_total': ('counter', "Ads whose title matched the keywords of a tracked product"),
+    'ads_rejected_total': ('counter', "Ads discarded, by reason: price (no price found) or title (matched no tracked product)"),
+    'best_offers_total': ('counter', "Best offers found for a product in a store"),
+    'failures_total': ('counter', "Failures, by stage where they happened"),
+    'alerts_total': ('counter', "Price alerts notified, by type of rule"),
+}
+
+
+class RunMetrics:
+    """
+    Counters and latency histograms of a run of the pipeline, labeled by stage, store and product, recorded by the threads that fetch pages
+    and exported at the end of the run as a JSON report and a file in the Prometheus text format
+    """
+
+    # Upper bounds of the latency histogram buckets in seconds, from parsing a page to waiting for a slow store
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+
+    def reset(self) -> None:
+        # Values by metric name and sorted label pairs, so the same labels in any order are the same series
+        # The Prometheus file exports the values since the process started, so counters only grow as Prometheus expects
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], dict] = {}
+
+        self.reset_report()
+
+
+    def reset_report(self) -> None:
+        ''' Start a new report, keeping the values exported to Prometheus, so a long-running process reports each cycle as a run of its own '''
+        with self.lock:
+            self.started_at = datetime.now()
+
+            # Values since the report started, with the same keys as the values since the process started
+            self.report_counters: dict[tuple[str, tuple], float] = {}
+            self.report_histograms: dict[tuple[str, tuple], dict] = {}
+
+
+    def increment(self, name: str, value: float = 1, **labels: str) -> None:
+        _key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            for counters in (self.counters, self.report_counters):
+                counters[_key] = counters.get(_key, 0) + value
+
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        _key = (name, tuple(sorted(labels.items())))
+
+        # Only the first bucket that holds the value is counted here, the buckets are made cumulative when exported
+        _bucket = bisect.bisect_left(self.latency_buckets, seconds)
+
+        with self.lock:
+            for histograms in (self.histograms, self.report_histograms):
+                histogram = histograms.setdefault(_key, {'bucket_counts': [0] * len(self.latency_buckets), 'count': 0, 'sum': 0.0, 'max': 0.0})
+
+                if _bucket < len(self.latency_buckets):
+                    histogram['bucket_counts'][_bucket] += 1
+
+                histogram['count'] += 1
+                histogram['sum'] += seconds
+                histogram['max'] = max(histogram['max'], seconds)
+
+
+    @contextmanager
+    def time_stage(self, stage: str, **labels: str) -> Iterator[None]:
+        ''' Observe how long the block takes as a stage of the pipeline, even if it raises '''
+        _start_time = perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe('stage_duration_seconds', perf_counter() - _start_time, stage=stage, **labels)
+
+
+    def get_cumulative_buckets(self, histogram: dict) -> list[tuple[str, int]]:
+        cumulative_buckets, _count = [], 0
+
+        for upper_bound, bucket_count in zip(self.latency_buckets, histogram['bucket_counts']):
+            _count += bucket_count
+            cumulative_buckets.append((str(upper_bound), _count))
+
+        cumulative_buckets.append(('+Inf', histogram['count']))
+
+        return cumulative_buckets
+
+
+    def get_report(self) -> dict:
+        ''' Every counter and histogram since the report started, with the mean and maximum of each histogram to read the report without a graphing tool '''
+        finished_at = datetime.now()
+
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.report_counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': histogram['count'], 'sum': histogram['sum'],
+                           'mean': histogram['sum'] / histogram['count'], 'max': histogram['max'],
+                           'buckets': dict(self.get_cumulative_buckets(histogram))}
+                          for (name, labels), histogram in sorted(self.report_histograms.items())]
+
+        return {'started_at': self.started_at.isoformat(timespec='seconds'), 'finished_at': finished_at.isoformat(timespec='seconds'),
+                'duration_seconds': (finished_at - self.started_at).total_seconds(), 'counters': counters, 'histograms': histograms}
+
+
+    def format_labels(self, labels: tuple, extra_labels: tuple = ()) -> str:
+        _labels = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels + extra_labels]
+
+        return '{' + ','.join(f'{key}="{value}"' for key, value in _labels) + '}' if _labels else ''
+
+
+    def get_prometheus_text(self) -> str:
+        ''' Metrics in the Prometheus text exposition format, to be collected for instance by the textfile collector of the node exporter '''
+        lines = []
+
+        with self.lock:
+            for name, (metric_type, description) in METRIC_DEFINITIONS.items():
+                _metric_name = f"{METRIC_PREFIX}{name}"
+                lines += [f"# HELP {_metric_name} {description}", f"# TYPE {_metric_name} {metric_type}"]
+
+                if metric_type == 'counter':
+                    lines += [f"{_metric_name}{self.format_labels(labels)} {value:g}"
+                              for (counter_name, labels), value in sorted(self.counters.items()) if counter_name == name]
+                    continue
+
+                for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+
+                    lines += [f"{_metric_name}_bucket{self.format_labels(labels, (('le', upper_bound),))} {count}"
+                              for upper_bound, count in self.get_cumulative_buckets(histogram)]
+                    lines += [f"{_metric_name}_sum{self.format_labels(labels)} {histogram['sum']:.6f}",
+                              f"{_metric_name}_count{self.format_labels(labels)} {histogram['count']}"]
+
+        return '\n'.join(lines) + '\n'
+
+
+    def merge_report(self, report: dict) -> None:
+        ''' Add the counters and histograms of a saved report to the ones of this run, for instance to sum the reports of the workers of a run '''
+        with self.lock:
+            for counter in report['counters']:
+                _key = (counter['name'], tuple(sorted(counter['labels'].items())))
+                for counters in (self.counters, self.report_counters):
+                    counters[_key] = counters.get(_key, 0) + counter['value']
+
+            for saved_histogram in report['histograms']:
+                _key = (saved_histogram['name'], tuple(sorted(saved_histogram['labels'].items())))
+
+                # The buckets of a report are cumulative, so each bucket count is the difference to the bucket before it
+                _cumulative_counts = [saved_histogram['buckets'][str(upper_bound)] for upper_bound in self.latency_buckets]
+                _bucket_counts = [_count - _previous_count for _count, _previous_count in zip(_cumulative_counts, [0] + _cumulative_counts[:-1])]
+
+                for histograms in (self.histograms, self.report_histograms):
+                    histogram = histograms.setdefault(_key, {'bucket_counts': [0] * len(self.latency_buckets), 'count': 0, 'sum': 0.0, 'max': 0.0})
+                    histogram['bucket_counts'] = [_count + _added_count for _count, _added_count in zip(histogram['bucket_counts'], _bucket_counts)]
+                    histogram['count'] += saved_histogram['count']
+                    histogram['sum'] += saved_histogram['sum']
+                    histogram['max'] = max(histogram['max'], saved_histogram['max'])
+
+
+    def save(self, report_path: str, prometheus_path: str | None, report_history_path: str | None = None) -> None:
+        '''
+        Save the JSON report and the Prometheus file of the run, if given, replacing the previous ones, and append the report to the history of reports
+        so the health of the scraping can be followed over time
+        '''
+        report = self.get_report()
+        report_files = [(report_path, json.dumps(report, indent=2))] + ([(prometheus_path, self.get_prometheus_text())] if prometheus_path is not None else [])
+
+        for path, content in report_files:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+            # Write to a temporary file first, so a collector never reads a truncated file
+            _temporary_path = Path(path).with_suffix('.tmp')
+            _temporary_path.write_text(content, encoding='utf-8')
+            _temporary_path.replace(path)
+
+        if report_history_path is not None:
+            with open(report_history_path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(report) + '\n')
+
+
+# Metrics shared by every stage of the run, recorded from any module without passing them around
+run_metrics = RunMetrics()
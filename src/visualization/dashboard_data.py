@@ -0,0 +1,218 @@
+import pandas as pd
+from pathlib import Path
+from threading import Event, Lock, Thread
+import features.process_price_history as process
+import visualization.price_chart_data as chart
+
+
+class DashboardData:
+    """
+    Data of the web application for one version of the processed price history, prepared once: the daily best prices in date order,
+    a slice of them for each product, from which the chart, the table and the cards of the products are all computed
+    """
+
+    # Days before the current date used to compute the changes of the current price
+    delta_periods = {'Delta Day': 1, 'Delta Week': 7, 'Delta Month': 30}
+
+    max_cached_chart_series = 1000
+
+    # Prices shown in the card of each product
+    metric_columns = ['Last Seen Date', 'Current Price', 'Current Store', 'Current Title', 'Historical Price', 'Historical Store', 'Historical Title', 'Historical Date']
+
+    def __init__(self, version: str, processed_path: str):
+        self.version = version
+
+        # The processed price history is stored with its types, so dates and months don't need to be parsed again
+        price_history_df = process.read_processed_price_history(processed_path)
+
+        if price_history_df.empty:
+            self.best_prices_df = pd.DataFrame(columns=['Product Name', 'Store', 'Price', 'Title', 'Date', 'Dateref'])
+        else:
+            self.best_prices_df = price_history_df[price_history_df['Flag Daily Best Price']].sort_values(by='Date', ascending=True, kind='stable')
+
+        # Selecting products only joins their slices, instead of filtering the whole price history
+        self.product_best_prices: dict[str, pd.DataFrame] = {product: product_df for product, product_df in self.best_prices_df.groupby('Product Name', observed=True)}
+
+        # Rollups of the chart are computed the first time they are selected, then kept with the data of this version
+        # The data is shared by every session of the web application, so the caches are only changed while holding the lock
+        self.product_rollups: dict[str, dict[str, pd.DataFrame]] = {}
+        self.chart_series: dict[tuple, pd.DataFrame] = {}
+        self.cache_lock = Lock()
+
+
+    def get_products(self) -> list[str]:
+        return list(self.product_best_prices)
+
+
+    def get_best_prices_of_products(self, products: list[str]) -> pd.DataFrame:
+        product_dfs = [self.product_best_prices[product] for product in products if product in self.product_best_prices]
+
+        if not product_dfs:
+            return self.best_prices_df.iloc[0:0]
+
+        return pd.concat(product_dfs).sort_values(by='Date', kind='stable')
+
+
+    def get_product_rollups(self, rollup: str) -> dict[str, pd.DataFrame]:
+        product_rollups = self.product_rollups.get(rollup)
+
+        # Computed outside the lock, so other sessions keep reading the cache meanwhile, the first session to finish keeps its rollup
+        if product_rollups is None:
+            rollup_df = chart.rollup_best_prices(self.best_prices_df, rollup)
+            product_rollups = {product: product_df for product, product_df in rollup_df.groupby('Product Name', observed=True)}
+
+            with self.cache_lock:
+                product_rollups = self.product_rollups.setdefault(rollup, product_rollups)
+
+        return product_rollups
+
+
+    def get_chart_df(self, products: list[str], first_month: pd.Period, last_month: pd.Period, rollup: str, statistic: str, max_points: int) -> pd.DataFrame:
+        ''' Price of the products in each period of the rollup between two months, downsampled to at most max_points for each product '''
+        product_rollups = self.get_product_rollups(rollup)
+        price_column = chart.ROLLUP_STATISTICS[statistic]
+        series_dfs: list[pd.DataFrame] = []
+
+        for product in products:
+            if product not in product_rollups:
+                continue
+
+            # Each series is downsampled once for each selection, so adding a product to the chart only downsamples the new one
+            series_key = (product, first_month, last_month, rollup, statistic, max_points)
+            series_df = self.chart_series.get(series_key)
+
+            if series_df is None:
+                product_df = product_rollups[product]
+                is_in_month_interval = (product_df['Date'] >= first_month.start_time) & (product_df['Date'] <= last_month.end_time)
+                series_df = product_df.loc[is_in_month_interval, ['Product Name', 'Date', price_column]].rename(columns={price_column: 'Price'})
+                series_df = chart.downsample_series(series_df, 'Price', max_points)
+
+                with self.cache_lock:
+                    # Keep the cache bounded, swapping in a new dict so sessions reading the old one are not affected, and old selections are computed again
+                    if len(self.chart_series) >= self.max_cached_chart_series:
+                        self.chart_series = {}
+
+                    self.chart_series[series_key] = series_df
+
+            series_dfs.append(series_df)
+
+        if not series_dfs:
+            return pd.DataFrame(columns=['Product Name', 'Date', 'Price'])
+
+        return pd.concat(series_dfs, ignore_index=True)
+
+
+    def get_price_metrics_df(self, products: list[str], first_month: pd.Period, last_month: pd.Period) -> pd.DataFrame:
+        '''
+        Current and best prices of the products in the month interval, and the change of the current price since the day, week and month before,
+        computed for all products at once from the same version of the processed price history as the chart
+        '''
+        best_prices_df = self.get_best_prices_of_products(products)
+        interval_prices_df = best_prices_df[(best_prices_df['Dateref'] >= first_month) & (best_prices_df['Dateref'] <= last_month)]
+
+        # Products without prices in the interval are only shown in the graph
+        metrics_df = self.get_interval_metrics_df(interval_prices_df)
+        if metrics_df.empty:
+            return metrics_df
+
+        # Cards keep the order of the selection
+        _product_positions = {product: position for position, product in enumerate(products)}
+        metrics_df = metrics_df.sort_values(by='Product Name', key=lambda product_names: product_names.map(_product_positions), kind='stable').reset_index(drop=True)
+
+        metrics_df['Current Store'] = metrics_df['Current Store'].map(process.format_store_name)
+        metrics_df['Historical Store'] = metrics_df['Historical Store'].map(process.format_store_name)
+
+        # Daily best prices of the products in the interval ordered by date, to look up the price of each product at a reference date
+        reference_prices_df = (interval_prices_df[['Product Name', 'Date', 'Price']]
+                               .astype({'Product Name': str})
+                               .rename(columns={'Date': 'Reference Date', 'Price': 'Reference Price'})
+                               .sort_values(by='Reference Date', kind='stable'))
+
+        for delta_column, days in self.delta_periods.items():
+            reference_dates_df = pd.DataFrame({'Product Name': metrics_df['Product Name'].astype(str),
+                                               'Reference Date': metrics_df['Last Seen Date'] - pd.Timedelta(days=days)})
+
+            # Latest price of each product at the reference date or up to the length of the period before it, e.g. only yesterday for the day
+            reference_dates_df = pd.merge_asof(reference_dates_df.reset_index().sort_values(by='Reference Date', kind='stable'), reference_prices_df,
+                                               on='Reference Date', by='Product Name', direction='backward', tolerance=pd.Timedelta(days=days-1))
+            reference_prices = reference_dates_df.set_index('index')['Reference Price'].sort_index()
+
+            # Products without a price at the reference date have no change
+            metrics_df[delta_column] = (100*(metrics_df['Current Price']/reference_prices - 1)).round().fillna(0).astype(int)
+
+        return metrics_df
+
+
+    def get_interval_metrics_df(self, interval_prices_df: pd.DataFrame) -> pd.DataFrame:
+        ''' Latest and lowest daily best prices of each product in the interval, the most recent one if the lowest price repeats, as the summary does '''
+        if interval_prices_df.empty:
+            return pd.DataFrame(columns=['Product Name'] + self.metric_columns)
+
+        _current_df = interval_prices_df.groupby('Product Name', observed=True).tail(1).set_index('Product Name')
+        _historical_df = (interval_prices_df.sort_values(by=['Price', 'Date'], ascending=[True, False], kind='stable')
+                          .groupby('Product Name', observed=True).head(1).set_index('Product Name'))
+
+        interval_metrics_df = pd.DataFrame({'Last Seen Date': _current_df['Date'], 'Current Price': _current_df['Price'],
+                                            'Current Store': _current_df['Store'], 'Current Title': _current_df['Title']})
+        interval_metrics_df = interval_metrics_df.join(pd.DataFrame({'Historical Price': _historical_df['Price'], 'Historical Store': _historical_df['Store'],
+                                                                     'Historical Title': _historical_df['Title'], 'Historical Date': _historical_df['Date']}))
+
+        return interval_metrics_df.rename_axis('Product Name').reset_index().astype({'Product Name': str})
+
+
+class DashboardDataLoader:
+    """
+    Keep the data of the web application in memory between reruns, loading it again only when the pipeline writes a new version
+    of the processed price history, optionally watching for it in a background thread so the next rerun finds it already loaded
+    """
+
+    def __init__(self, processed_path: str = process.PROCESSED_PRICE_HISTORY_PATH):
+        self.processed_path = processed_path
+        self.dashboard_data: DashboardData | None = None
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.reload_thread: Thread | None = None
+
+
+    def get_data_version(self) -> str:
+        ''' Version stamp written by the pipeline, or the modification times of the data files if there is none '''
+        version = process.read_version_stamp(self.processed_path)
+
+        if version is not None:
+            return version
+
+        data_paths = sorted(Path(self.processed_path).glob(process.PARTITION_NAME_PATTERN))
+
+        return ';'.join(f"{path.name}:{path.stat().st_mtime_ns}" for path in data_paths if path.exists())
+
+
+    def get_dashboard_data(self) -> DashboardData:
+        version = self.get_data_version()
+
+        # Only one rerun or the background thread loads a new version, the others wait and reuse it
+        with self.lock:
+            if self.dashboard_data is None or self.dashboard_data.version != version:
+                self.dashboard_data = DashboardData(version, self.processed_path)
+
+            return self.dashboard_data
+
+
+    def start_background_reload(self, interval_seconds: float) -> None:
+        if self.reload_thread is not None:
+            return
+
+        self.reload_thread = Thread(target=self.reload_periodically, args=(interval_seconds,), daemon=True)
+        self.reload_thread.start()
+
+
+    def reload_periodically(self, interval_seconds: float) -> None:
+        while not self.stop_event.wait(interval_seconds):
+            try:
+                self.get_dashboard_data()
+            except (OSError, ValueError):
+                # The pipeline may be writing the files right now, the next check loads them
+                continue
+
+
+    def stop_background_reload(self) -> None:
+        self.stop_event.set()
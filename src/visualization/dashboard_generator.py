@@ -1,20 +1,42 @@
 import streamlit as st
 import plotly.express as px
 import pandas as pd
-from datetime import datetime, timedelta
-from dateutil.relativedelta import relativedelta
-import re
+from pathlib import Path
+import sys
+import yaml
+
+# Streamlit only adds the folder of this script to the path, the shared modules are in the src folder
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from visualization.dashboard_data import DashboardDataLoader
+import visualization.price_chart_data as chart
 
 # Web application to visualize products price history data
 
+METRIC_CARDS_PER_ROW = 4
+
+@st.cache_data
+def read_dashboard_config() -> dict:
+    with open('config/dashboard.yaml', 'r') as file:
+        return yaml.safe_load(file)
+
+
+@st.cache_resource
+def get_dashboard_data_loader() -> DashboardDataLoader:
+    ''' A single loader shared by every session and rerun, so the data is only read when the pipeline writes a new version '''
+    dashboard_data_loader = DashboardDataLoader()
+    background_reload_seconds = read_dashboard_config().get('background_reload_seconds', 0)
+
+    if background_reload_seconds > 0:
+        dashboard_data_loader.start_background_reload(background_reload_seconds)
+
+    return dashboard_data_loader
+
+
 def set_up_init_configurations():
     st.set_page_config(layout="wide")
 
-    price_history_df = pd.read_csv('data/processed_price_histories.csv', sep=';', index_col=False)
-    best_prices_df = price_history_df[price_history_df['Flag Daily Best Price'] == True].sort_values(by='Date', ascending=True)
-    best_prices_df['Date'] = pd.to_datetime(best_prices_df['Date'], format='%Y-%m-%d')
-    best_prices_df['Dateref Datetime'] = pd.to_datetime(best_prices_df['Dateref Datetime'], format='%Y-%m-%d')
-    st.session_state['best_prices_df'] = best_prices_df
+    # The data is shared between reruns and must not be modified
+    st.session_state['dashboard_data'] = get_dashboard_data_loader().get_dashboard_data()
 
     st.markdown("# Price Monitoring")
 
@@ -23,14 +45,13 @@ def implement_sidebar_filters():
     # Filters in sidebar
     st.sidebar.title("Filters")
 
-    best_prices_df = st.session_state['best_prices_df']
+    dashboard_data = st.session_state['dashboard_data']
 
     # Multi Select Products to display prices
     selected_products = st.sidebar.multiselect(label = "Select products to display prices",
-                                               options = best_prices_df['Product Name'].unique())
+                                               options = dashboard_data.get_products())
 
-    product_mask = best_prices_df['Product Name'].isin(selected_products)
-    filtered_products_df = best_prices_df[product_mask]
+    filtered_products_df = dashboard_data.get_best_prices_of_products(selected_products)
     st.session_state['selected_products'] = selected_products
 
     st.sidebar.write("#")
@@ -43,31 +64,35 @@ def implement_sidebar_filters():
 
         # If there is data for only one month, include the next month for selection in the slider to prevent errors during iteration
         if (min_date == max_date):
-            # Convert string to datetime in order to add one month
-            formatted_max_date = datetime.strptime(max_date, "%m/%Y").date()
-            correct_max_date = formatted_max_date + relativedelta(months=1)
-
-            # Convert back to string
-            correct_max_date_str = correct_max_date.strftime('%m/%Y')
-            max_date = re.sub('^0', '', correct_max_date_str) # Remove the leading zero from the month to standardize the patterns
+            max_date = min_date + 1
             monthYear_list.append(max_date)
 
-        min_selected, max_selected = st.sidebar.select_slider(label = "Move sliders to select month interval",
-                                                              options = monthYear_list,
-                                                              value = (min_date, max_date))
+        # Months are shown as month/year, e.g. 3/2024
+        month_labels_dict = {f"{month.month}/{month.year}": month for month in monthYear_list}
+        min_label, max_label = st.sidebar.select_slider(label = "Move sliders to select month interval",
+                                                        options = list(month_labels_dict),
+                                                        value = (f"{min_date.month}/{min_date.year}", f"{max_date.month}/{max_date.year}"))
+        min_selected, max_selected = month_labels_dict[min_label], month_labels_dict[max_label]
+        st.session_state['selected_month_interval'] = (min_selected, max_selected)
 
-        # Convert string to datetime in order to filter dataframe by selected month interval
-        min_selected_datetime = datetime.strptime(min_selected, "%m/%Y")
-        max_selected_datetime = datetime.strptime(max_selected, "%m/%Y")
-
-        dataref_mask = (filtered_products_df['Dateref Datetime'] >= min_selected_datetime) & (filtered_products_df['Dateref Datetime'] <= max_selected_datetime)
+        dataref_mask = (filtered_products_df['Dateref'] >= min_selected) & (filtered_products_df['Dateref'] <= max_selected)
         filtered_products_dateref_df = filtered_products_df[dataref_mask]
         st.session_state['filtered_products_dateref_df'] = filtered_products_dateref_df
+
+        st.sidebar.write("#")
+
+        # Radio buttons to select how the prices are aggregated in the chart
+        rollup = st.sidebar.radio(label = "Chart aggregation", options = list(chart.ROLLUP_FREQUENCIES), horizontal = True)
+        statistic = st.sidebar.radio(label = "Price in each period", options = list(chart.ROLLUP_STATISTICS), horizontal = True, disabled = (rollup == 'Daily'))
+
+        # The chart is aggregated and downsampled on the server, so its size doesn't grow with the price history
+        st.session_state['chart_df'] = dashboard_data.get_chart_df(selected_products, min_selected, max_selected, rollup, statistic,
+                                                                   read_dashboard_config().get('chart_max_points', 500))
     
     else:
         st.session_state['filtered_products_dateref_df'] = pd.DataFrame()
 
-    for i in range(11):
+    for i in range(5):
         st.sidebar.write("#")
 
     st.sidebar.markdown("Develop by Gabriel Corrêa de Oliveira")
@@ -76,98 +101,54 @@ def implement_sidebar_filters():
 
 def get_price_metrics():
     selected_products = st.session_state['selected_products']
-    filtered_products_dateref_df = st.session_state['filtered_products_dateref_df']
-    product_infos: list[dict] = []
 
-    for count, product in enumerate(selected_products):
-        # Limit of two product infos to show in app
-        if (count >= 2):
-            continue
+    first_month, last_month = st.session_state['selected_month_interval']
 
-        product_dict: dict = {}
-        
-        # Current price information
-        product_df = filtered_products_dateref_df[filtered_products_dateref_df['Product Name'] == product]
-        product_df = product_df.sort_values(by='Date', ascending=True)
-        index_current_price = product_df['Date'].idxmax()
-        product_dict['Current Name'] = product_df.loc[index_current_price, 'Product Name']
-        product_dict['Current Price'] = product_df.loc[index_current_price, 'Price']
-        product_dict['Current Store'] = product_df.loc[index_current_price, 'Store']
-        product_dict['Current Title'] = product_df.loc[index_current_price, 'Title']
-        product_dict['Current Date'] = product_df.loc[index_current_price, 'Date']
-
-        # Yesterday price information
-        yesterday = product_dict['Current Date'] - timedelta(days=1)
-        if yesterday in product_df['Date'].values:
-            yesterday_price = product_df.loc[product_df['Date'] == yesterday, 'Price'].item()
-            product_dict['Delta Day'] = round(100*(product_dict['Current Price']/yesterday_price - 1))
-        else:
-            product_dict['Delta Day'] = 0
-
-        # Historical price information
-        historical_price = product_df['Price'].min()
-        index_historical_price = product_df.where(product_df['Price'] == historical_price).last_valid_index()
-        product_dict['Historical Price'] = product_df.loc[index_historical_price, 'Price']
-        product_dict['Historical Store'] = product_df.loc[index_historical_price, 'Store']
-        product_dict['Historical Title'] = product_df.loc[index_historical_price, 'Title']
-        product_dict['Historical Date'] = product_df.loc[index_historical_price, 'Date'] 
-
-        product_infos.append(product_dict)
-
-    st.session_state['product_infos'] = product_infos
+    # Metrics of all selected products in a single pass, within the month interval selected in the sidebar
+    st.session_state['price_metrics_df'] = st.session_state['dashboard_data'].get_price_metrics_df(selected_products, first_month, last_month)
+
+
+def plot_product_metrics(product_metrics: dict):
+    st.subheader(f'{product_metrics["Product Name"]}')
+    con_info = st.container(border=True)
+    con_info.metric(label='Current Price', value=f'R$ {product_metrics["Current Price"]}', delta=f'{product_metrics["Delta Day"]}%', delta_color="inverse")
+    con_info.markdown(f'Week: **{product_metrics["Delta Week"]}%** | Month: **{product_metrics["Delta Month"]}%**')
+    con_info.metric(label='Store', value=product_metrics["Current Store"])
+    con_info.metric(label='Date', value=product_metrics["Last Seen Date"].strftime("%d/%m/%y"))
+    con_info.caption(f'Title: {product_metrics["Current Title"]}')
+
+    con_info.divider()
+
+    con_info.markdown(f'Historical Price: **R$ {product_metrics["Historical Price"]}**')
+    con_info.markdown(f'Store: **{product_metrics["Historical Store"]}**')
+    con_info.markdown(f'Date: **{product_metrics["Historical Date"].strftime("%d/%m/%y")}**')
+    con_info.caption(f'Title: {product_metrics["Historical Title"]}')
 
 
 def plot_graphs_and_metrics():
-    col1, col2, col3 = st.columns([5,2,2])
-    product_infos = st.session_state['product_infos']
-    number_products_selected = len(product_infos)
-    filtered_products_dateref_df = st.session_state['filtered_products_dateref_df']
-
-    with col1:
-        st.header('Best Price History per Product')
-        con_graph1 = st.container(border=True)
-        fig_date = px.line(data_frame=filtered_products_dateref_df, x='Date', y='Price', color='Product Name')
-        con_graph1.plotly_chart(fig_date, use_container_width=True)
-    
-    if (number_products_selected >= 1):
-        with col2:
-            product_1: dict = product_infos[0]
-            st.header(f'{product_1["Current Name"]}')
-            con_info1 = st.container(border=True)
-            con_info1.metric(label='Current Price', value=f'R$ {product_1["Current Price"]}', delta=f'{product_1["Delta Day"]}%', delta_color="inverse")
-            con_info1.metric(label='Store', value=product_1["Current Store"])
-            con_info1.metric(label='Date', value=product_1["Current Date"].strftime("%d/%m/%y"))
-            con_info1.caption(f'Title: {product_1["Current Title"]}')
-
-            con_info1.divider()
-
-            con_info1.markdown(f'Historical Price: **R$ {product_1["Historical Price"]}**')
-            con_info1.markdown(f'Store: **{product_1["Historical Store"]}**')
-            con_info1.markdown(f'Date: **{product_1["Historical Date"].strftime("%d/%m/%y")}**')
-            con_info1.caption(f'Title: {product_1["Historical Title"]}')
-            
-    if (number_products_selected >= 2):
-        with col3:
-            product_2: dict = product_infos[1]
-            st.header(f'{product_2["Current Name"]}')
-            con_info2 = st.container(border=True)
-            con_info2.metric(label='Current Price', value=f'R$ {product_2["Current Price"]}', delta=f'{product_2["Delta Day"]}%', delta_color="inverse")
-            con_info2.metric(label='Store', value=product_2["Current Store"])
-            con_info2.metric(label='Date', value=product_2["Current Date"].strftime("%d/%m/%y"))
-            con_info2.caption(f'Title: {product_2["Current Title"]}')
-
-            con_info2.divider()
-
-            con_info2.markdown(f'Historical Price: **R$ {product_2["Historical Price"]}**')
-            con_info2.markdown(f'Store: **{product_2["Historical Store"]}**')
-            con_info2.markdown(f'Date: **{product_2["Historical Date"].strftime("%d/%m/%y")}**')
-            con_info2.caption(f'Title: {product_2["Historical Title"]}')
+    price_metrics_df = st.session_state['price_metrics_df']
+
+    st.header('Best Price History per Product')
+    con_graph1 = st.container(border=True)
+    fig_date = px.line(data_frame=st.session_state['chart_df'], x='Date', y='Price', color='Product Name')
+    con_graph1.plotly_chart(fig_date, use_container_width=True)
+
+    # Cards of the selected products in rows, so any number of products can be compared
+    product_metrics_list: list[dict] = price_metrics_df.to_dict('records')
+
+    for row_start in range(0, len(product_metrics_list), METRIC_CARDS_PER_ROW):
+        columns = st.columns(METRIC_CARDS_PER_ROW)
+
+        for column, product_metrics in zip(columns, product_metrics_list[row_start:row_start + METRIC_CARDS_PER_ROW]):
+            with column:
+                plot_product_metrics(product_metrics)
 
 
 def plot_filtered_dataframe():
-    filtered_products_dateref_df = st.session_state['filtered_products_dateref_df']
+    # Format a copy, the filtered dataframe may share data with the cached one
+    filtered_products_dateref_df = st.session_state['filtered_products_dateref_df'].copy()
     filtered_products_dateref_df['Date'] = filtered_products_dateref_df['Date'].dt.strftime('%d/%m/%Y')
-    filtered_products_dateref_df = filtered_products_dateref_df.drop('Dateref Datetime', axis=1)
+    filtered_products_dateref_df['Dateref'] = filtered_products_dateref_df['Dateref'].dt.strftime('%m/%Y')
     df_expander = st.expander("Price History DataFrame", expanded=False)
 
     with df_expander:
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+'''
+Helper functions to prepare the price history chart of the web application on the server: the daily best prices are aggregated by day, week
+or month, and each product series is downsampled to a maximum number of points, so the chart sent to the browser stays small however long the history is
+'''
+
+# Period of each rollup, as pandas period frequency
+ROLLUP_FREQUENCIES = {'Daily': 'D', 'Weekly': 'W', 'Monthly': 'M'}
+
+# Price column of the rollup for each statistic
+ROLLUP_STATISTICS = {'Minimum': 'Min Price', 'Average': 'Average Price', 'Maximum': 'Max Price'}
+
+
+def rollup_best_prices(best_prices_df: pd.DataFrame, rollup: str) -> pd.DataFrame:
+    ''' Minimum, average and maximum daily best price of each product in each period, dated by the first day of the period '''
+    period_start_dates = best_prices_df['Date'].dt.to_period(ROLLUP_FREQUENCIES[rollup]).dt.start_time.rename('Date')
+
+    rollup_df = (best_prices_df.groupby([best_prices_df['Product Name'], period_start_dates], observed=True, sort=True)['Price']
+                 .agg(['min', 'mean', 'max'])
+                 .rename(columns={'min': 'Min Price', 'mean': 'Average Price', 'max': 'Max Price'})
+                 .reset_index())
+
+    return rollup_df
+
+
+def get_lttb_indexes(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    '''
+    Indexes of the points kept by the Largest-Triangle-Three-Buckets downsampling: the first and last points, and from each bucket in between,
+    the point that forms the largest triangle with the point kept in the previous bucket and the average of the next bucket, which keeps the peaks and valleys
+    '''
+    n_points = len(x)
+
+    if max_points >= n_points or max_points < 3:
+        return np.arange(n_points)
+
+    # The points between the first and the last are split in buckets of about the same size
+    bucket_edges = np.linspace(1, n_points - 1, max_points - 1).astype(int)
+    kept_indexes = np.empty(max_points, dtype=int)
+    kept_indexes[0] = 0
+    kept_indexes[-1] = n_points - 1
+
+    previous_index = 0
+    for bucket in range(max_points - 2):
+        bucket_start, bucket_end = bucket_edges[bucket], bucket_edges[bucket + 1]
+
+        # Average point of the next bucket, or the last point for the last bucket
+        next_start, next_end = bucket_end, bucket_edges[bucket + 2] if bucket + 2 < len(bucket_edges) else n_points
+        next_x, next_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+
+        # Twice the area of the triangles formed by each point of the bucket
+        areas = np.abs((x[previous_index] - next_x) * (y[bucket_start:bucket_end] - y[previous_index])
+                       - (x[previous_index] - x[bucket_start:bucket_end]) * (next_y - y[previous_index]))
+
+        previous_index = bucket_start + int(np.argmax(areas))
+        kept_indexes[bucket + 1] = previous_index
+
+    return kept_indexes
+
+
+def downsample_series(series_df: pd.DataFrame, price_column: str, max_points: int) -> pd.DataFrame:
+    ''' Downsample the price series of a product, ordered by date, to at most max_points points '''
+    # Dates in days, so the triangle areas don't depend on the time unit
+    x = series_df['Date'].to_numpy(dtype='datetime64[D]').astype(float)
+    y = series_df[price_column].to_numpy(dtype=float)
+
+    return series_df.iloc[get_lttb_indexes(x, y, max_points)]